@@ -0,0 +1,340 @@
+# John Eargle
+# 2017
+
+import functools
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import scipy.sparse
+
+from sysbiokit.element import Molecule
+from sysbiokit.importer import read_sbml, read_json, column_reactions
+from sysbiokit.matrix import StoichioMatrix
+
+
+# Compiled StoichioMatrices saved as memory-mapped arrays
+
+CACHE_VERSION = 2
+
+
+def model_hash(source, chunk_size=1 << 20):
+    """
+    Hex SHA-1 digest of a model file's contents, salted with the cache
+    format version so that a format change also invalidates old caches.
+    """
+    digest = hashlib.sha1('sysbiokit-cache-%d\n' % CACHE_VERSION)
+    with open(source, 'rb') as handle:
+        chunk = handle.read(chunk_size)
+        while chunk:
+            digest.update(chunk)
+            chunk = handle.read(chunk_size)
+    return digest.hexdigest()
+
+
+def cached_model(source, reader=None, directory=None, registry=None,
+                 mmap_mode='r', factorize=False):
+    """
+    StoichioMatrix for a model file, loaded from its compiled cache when
+    one exists for the file's current contents and otherwise read with
+    reader and then cached.
+    source: model file name
+    reader: function(source, registry) returning a StoichioMatrix;
+      defaults to read_json for .json files and read_sbml otherwise
+    directory: cache directory; defaults to .sysbiokit-cache next to the
+      source file
+    factorize: compute the factorization before caching a newly read
+      model, so that later loads get its subspaces for free
+
+    The cache is keyed by the file contents, the reader and factorize,
+    so a model read another way is cached separately.  The reader must
+    be a module-level function or a functools.partial of one; lambdas
+    and closures cannot be told apart and raise ValueError.
+    """
+    if reader is None:
+        reader = read_json if source.endswith('.json') else read_sbml
+    reader_key = _reader_key(reader)
+    if reader_key is None:
+        raise ValueError('Cannot cache a model read by %r; pass a '
+                         'module-level function or a functools.partial '
+                         'of one' % (reader,))
+    digest = hashlib.sha1(model_hash(source))
+    digest.update('\n%s\nfactorize=%r\n' % (reader_key, bool(factorize)))
+    key = digest.hexdigest()
+    if directory is None:
+        directory = os.path.join(os.path.dirname(os.path.abspath(source)),
+                                 '.sysbiokit-cache')
+    path = os.path.join(directory, key)
+    smatrix = load_model(path, key, registry, mmap_mode)
+    if smatrix is None:
+        smatrix = reader(source, registry)
+        if factorize:
+            smatrix.factorize()
+        save_model(smatrix, path, key)
+    return smatrix
+
+
+def _reader_key(reader):
+    """
+    Stable description of a model reader: module and name of the
+    function, followed by the arguments bound by functools.partial.
+    None if the reader cannot be identified by name.
+    """
+    if isinstance(reader, functools.partial):
+        func_key = _reader_key(reader.func)
+        if func_key is None:
+            return None
+        args = [repr(a) for a in reader.args]
+        args.extend('%s=%r' % (name, value)
+                    for name, value in sorted((reader.keywords or {}).items()))
+        return '%s(%s)' % (func_key, ', '.join(args))
+    module = getattr(reader, '__module__', None)
+    name = getattr(reader, '__name__', None)
+    if (module is None or name is None or
+        getattr(sys.modules.get(module), name, None) is not reader):
+        return None
+    return '%s.%s' % (module, name)
+
+
+def save_model(smatrix, directory, key=None):
+    """
+    Write a StoichioMatrix to a directory holding one .npy file per array
+    and an index.json describing them: the matrix, flux bounds and
+    objective, the row and column labels as fixed-width name, formula and
+    charge arrays, and the cached factorization if it is current.
+    key: content hash of the source model, checked by load_model()
+
+    The cache is written to a new hidden directory next to directory,
+    and directory is a symlink to it.  A replacement swaps the link with
+    a single rename, so processes loading the cache always find a
+    complete one, old or new.  A current cache for the same key is left
+    in place.
+    """
+    directory = os.path.abspath(directory)
+    parent = os.path.dirname(directory)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    staging = tempfile.mkdtemp(prefix='.%s-' % os.path.basename(directory),
+                               dir=parent)
+    try:
+        index = {
+            'version': CACHE_VERSION,
+            'key': key,
+            'sparse': smatrix.sparse,
+            'method': smatrix.method,
+            'tol': smatrix.tol,
+            'refactor': smatrix.refactor,
+            'arrays': {},
+        }
+        arrays = index['arrays']
+        _save(staging, arrays, 'matrix', smatrix.matrix)
+        _save(staging, arrays, 'lower_bounds', smatrix.lower_bounds)
+        _save(staging, arrays, 'upper_bounds', smatrix.upper_bounds)
+        _save(staging, arrays, 'objective', smatrix.objective)
+
+        if smatrix.molecules is not None:
+            molecules = smatrix.molecules
+            _save(staging, arrays, 'molecule_names',
+                  _strings([m.name for m in molecules]))
+            _save(staging, arrays, 'molecule_abbrs',
+                  _strings([m.abbr for m in molecules]))
+            _save(staging, arrays, 'molecule_formulas',
+                  _strings([m.formula for m in molecules]))
+            _save(staging, arrays, 'molecule_charges',
+                  np.array([m.charge for m in molecules], dtype=np.int32))
+        if smatrix.reactions is not None:
+            _save(staging, arrays, 'reaction_names',
+                  _strings([r.name for r in smatrix.reactions]))
+
+        # Only a factorization of the current matrix is worth keeping
+        if (smatrix._factored is smatrix.matrix and
+            smatrix._factor_key == (smatrix.method, smatrix.tol)):
+            index['rank'] = int(smatrix._factors['rank'])
+            index['factors'] = []
+            for name, value in smatrix._factors.items():
+                if name != 'rank':
+                    _save(staging, arrays, 'factor_' + name, value)
+                    index['factors'].append(name)
+            for name in ('U', 'S', 'V'):
+                if getattr(smatrix, name) is not None:
+                    _save(staging, arrays, name, getattr(smatrix, name))
+
+        with open(os.path.join(staging, 'index.json'), 'w') as handle:
+            json.dump(index, handle, indent=1, sort_keys=True)
+
+        if key is not None and _cache_key(directory) == key:
+            # Another process cached the same model first
+            shutil.rmtree(staging)
+            return
+        _publish(staging, directory)
+    except:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+
+def load_model(directory, key=None, registry=None, mmap_mode='r',
+               labels=True):
+    """
+    StoichioMatrix saved by save_model(), or None if there is no cache in
+    directory or it is stale: written by another cache format version or,
+    when key is given, for other model contents.
+    mmap_mode: passed to np.load; with 'r' the matrix and factorization
+      are read-only memory maps, paged in on use and shared by every
+      process loading the same cache
+    labels: restore the Molecules and Reactions labeling the matrix; the
+      name arrays alone are cheap to map, but building labels costs time
+      proportional to the model size.  Molecules already in the registry
+      from an earlier load are reused, so loading a model repeatedly
+      does not grow the registry.
+
+    Flux bounds and the objective are small and loaded as writable
+    copies.  Reactions get back their inputs and outputs but not their
+    enzymes or rates.
+    """
+    # Read every file from the cache the link points to now, even if it
+    # is replaced during the load
+    directory = os.path.realpath(directory)
+    try:
+        return _load_model(directory, key, registry, mmap_mode, labels)
+    except (IOError, OSError):
+        # Missing, or removed by a replacement while loading
+        return None
+
+
+def _load_model(directory, key, registry, mmap_mode, labels):
+    with open(os.path.join(directory, 'index.json')) as handle:
+        index = json.load(handle)
+    if (index.get('version') != CACHE_VERSION or
+        (key is not None and index.get('key') != key)):
+        return None
+
+    arrays = index['arrays']
+    def load(name):
+        return _load(directory, arrays, name, mmap_mode)
+
+    matrix = load('matrix')
+    molecules = None
+    reactions = None
+    if labels and 'molecule_names' in arrays:
+        molecules = Molecule.bulk(
+            _unstrings(load('molecule_names')),
+            _unstrings(load('molecule_formulas')),
+            [int(c) for c in load('molecule_charges')],
+            _unstrings(load('molecule_abbrs')), registry, reuse=True)
+        if 'reaction_names' in arrays:
+            reactions = column_reactions(matrix, molecules,
+                                         _unstrings(load('reaction_names')))
+
+    smatrix = StoichioMatrix(matrix, molecules, reactions,
+                             sparse=index['sparse'], method=index['method'],
+                             tol=index['tol'], refactor=index['refactor'])
+    smatrix.lower_bounds = np.array(load('lower_bounds'))
+    smatrix.upper_bounds = np.array(load('upper_bounds'))
+    smatrix.objective = np.array(load('objective'))
+
+    if 'rank' in index:
+        smatrix._factors['rank'] = index['rank']
+        for name in index['factors']:
+            smatrix._factors[name] = load('factor_' + name)
+        for name in ('U', 'S', 'V'):
+            if name in arrays:
+                setattr(smatrix, name, load(name))
+        smatrix._factored = smatrix.matrix
+        smatrix._factor_key = (smatrix.method, smatrix.tol)
+    return smatrix
+
+
+def _cache_key(directory):
+    """
+    Key of a current cache in directory, or None.
+    """
+    try:
+        with open(os.path.join(directory, 'index.json')) as handle:
+            index = json.load(handle)
+    except (IOError, ValueError):
+        return None
+    if index.get('version') != CACHE_VERSION:
+        return None
+    return index.get('key')
+
+
+def _publish(staging, directory):
+    """
+    Point the directory symlink at staging with one atomic rename, then
+    remove the cache it replaced.
+    """
+    parent = os.path.dirname(directory)
+    old = None
+    if os.path.islink(directory):
+        old = os.path.join(parent, os.readlink(directory))
+    link = staging + '.link'
+    os.symlink(os.path.basename(staging), link)
+    try:
+        os.rename(link, directory)
+    except OSError:
+        # A plain directory from an older cache cannot be swapped
+        # atomically; move it aside first
+        if not os.path.isdir(directory) or os.path.islink(directory):
+            os.remove(link)
+            raise
+        old = tempfile.mkdtemp(prefix='.old-', dir=parent)
+        os.rename(directory, os.path.join(old, 'cache'))
+        os.rename(link, directory)
+    if old is not None and os.path.realpath(old) != staging:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def _save(directory, arrays, name, value):
+    """
+    Save a dense or sparse array, recording how to rebuild it in arrays.
+    Sparse matrices are stored as their CSR or CSC component arrays.
+    """
+    if scipy.sparse.issparse(value):
+        if value.format not in ('csr', 'csc'):
+            value = value.tocsr()
+        arrays[name] = {'format': value.format, 'shape': value.shape}
+        for part in ('data', 'indices', 'indptr'):
+            np.save(os.path.join(directory, '%s.%s.npy' % (name, part)),
+                    getattr(value, part))
+    else:
+        arrays[name] = {'format': ('matrix' if isinstance(value, np.matrix)
+                                   else 'array')}
+        np.save(os.path.join(directory, name + '.npy'), np.asarray(value))
+
+
+def _load(directory, arrays, name, mmap_mode):
+    """
+    Array saved by _save(), memory mapped with mmap_mode.
+    """
+    info = arrays[name]
+    if info['format'] in ('csr', 'csc'):
+        parts = [np.load(os.path.join(directory, '%s.%s.npy' % (name, part)),
+                         mmap_mode=mmap_mode)
+                 for part in ('data', 'indices', 'indptr')]
+        if info['format'] == 'csr':
+            return scipy.sparse.csr_matrix(tuple(parts),
+                                           shape=tuple(info['shape']))
+        return scipy.sparse.csc_matrix(tuple(parts),
+                                       shape=tuple(info['shape']))
+    value = np.load(os.path.join(directory, name + '.npy'),
+                    mmap_mode=mmap_mode)
+    if info['format'] == 'matrix':
+        return np.asmatrix(value)
+    return value
+
+
+def _strings(values):
+    """
+    Fixed-width byte string array, which unlike an object array can be
+    memory mapped.  Unicode is stored as UTF-8.
+    """
+    return np.array([v.encode('utf-8') if isinstance(v, unicode) else v
+                     for v in values], dtype=np.string_)
+
+
+def _unstrings(values):
+    return [str(v) for v in values]
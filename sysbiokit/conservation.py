@@ -0,0 +1,149 @@
+# John Eargle
+# 2017
+
+from fractions import Fraction
+
+import numpy as np
+import scipy.sparse
+
+
+# Conserved moieties and the reduced systems they leave behind
+
+
+class ConservationLaws():
+    """
+    Conservation laws of a StoichioMatrix and the reduced system they
+    give for kinetic models.
+
+    Each law is a row g of the conservation matrix G with gS = 0, so g.x
+    is constant along any trajectory of dx/dt = Sv (the total of a moiety
+    pool such as ATP + ADP + AMP).  G is the reduced row echelon form of
+    the left null space, which makes one dependent molecule per law with
+    unit coefficient.  Entries are rationalized where that is exact within
+    tolerance, so G is usually an integer or small rational matrix.
+
+    With x split into independent and dependent molecules,
+
+      x_dep = T + L0 x_ind        S = L Nr        dx_ind/dt = Nr v(x)
+
+    where T = G_dep x (the pool totals, G_dep being the identity on the
+    dependent molecules), L0 = -G_ind, L = [I; L0] is the link matrix and
+    Nr holds the independent rows of S.  Integrating only x_ind drops the
+    singular directions of the full Jacobian.
+    """
+
+    def __init__(self, smatrix, tol=1e-9, max_denominator=1000):
+        """
+        smatrix: StoichioMatrix
+        tol: magnitude below which entries of the conservation matrix are
+          zero, and the largest change allowed when rationalizing them
+        max_denominator: largest denominator tried when rationalizing
+        """
+        self.smatrix = smatrix
+        self.tol = tol
+        rows = smatrix.matrix.shape[0]
+
+        basis = smatrix.left_null_space
+        if scipy.sparse.issparse(basis):
+            basis = basis.toarray()
+        basis = np.asarray(basis, dtype=float).T
+        echelon, pivots = _rref(basis, tol)
+        self.matrix = _rationalize(echelon, tol, max_denominator)
+
+        self.dependent = np.array(pivots, dtype=int)
+        is_dependent = np.zeros(rows, dtype=bool)
+        is_dependent[self.dependent] = True
+        self.independent = np.nonzero(~is_dependent)[0]
+
+        self.link0 = 0.0 - self.matrix[:,self.independent]
+        self.link = np.zeros((rows, len(self.independent)))
+        self.link[self.independent, np.arange(len(self.independent))] = 1.0
+        self.link[self.dependent,:] = self.link0
+        self.reduced = smatrix.matrix[self.independent,:]
+        if not scipy.sparse.issparse(self.reduced):
+            self.reduced = np.asarray(self.reduced, dtype=float)
+
+    def __len__(self):
+        return len(self.dependent)
+
+    def totals(self, x):
+        """
+        Pool totals T of a full concentration vector.
+        """
+        return np.dot(self.matrix, np.asarray(x, dtype=float))
+
+    def reduce(self, x):
+        """
+        Independent concentrations of a full concentration vector.
+        """
+        return np.asarray(x, dtype=float)[self.independent]
+
+    def expand(self, x_ind, totals):
+        """
+        Full concentration vector from independent concentrations and the
+        pool totals.
+        """
+        x = np.zeros(self.link.shape[0])
+        x[self.independent] = x_ind
+        x[self.dependent] = totals + np.dot(self.link0, x_ind)
+        return x
+
+    def rhs(self, rates, totals):
+        """
+        Right hand side f(x_ind, t) of the reduced system for rates(x, t),
+        a function returning the flux vector v at full concentrations x.
+        The argument order matches scipy.integrate.odeint.
+        """
+        def f(x_ind, t):
+            return self.reduced.dot(rates(self.expand(x_ind, totals), t))
+        return f
+
+    def jacobian(self, rate_jacobian, totals):
+        """
+        Jacobian of the reduced system, Nr (dv/dx) L, for
+        rate_jacobian(x, t) returning dv/dx at full concentrations x.
+        """
+        def jac(x_ind, t):
+            dv = rate_jacobian(self.expand(x_ind, totals), t)
+            return np.asarray(self.reduced.dot(np.dot(dv, self.link)))
+        return jac
+
+
+def _rref(a, tol):
+    """
+    Reduced row echelon form of a full row rank matrix by Gauss-Jordan
+    elimination with complete pivoting.  Returns the echelon matrix and
+    the pivot column of each row.
+    """
+    a = a.copy()
+    rows, cols = a.shape
+    pivots = []
+    free = np.ones(cols, dtype=bool)
+    for i in range(rows):
+        # Largest remaining entry in the unreduced rows
+        block = np.abs(a[i:,:]) * free
+        r, c = np.unravel_index(np.argmax(block), block.shape)
+        if block[r, c] <= tol:
+            break
+        r += i
+        a[[i, r],:] = a[[r, i],:]
+        a[i,:] /= a[i, c]
+        others = np.arange(rows) != i
+        a[others,:] -= np.outer(a[others, c], a[i,:])
+        a[np.abs(a) <= tol] = 0.0
+        pivots.append(c)
+        free[c] = False
+    return a[0:len(pivots),:], pivots
+
+
+def _rationalize(a, tol, max_denominator):
+    """
+    Replace each entry by the nearest fraction with a bounded denominator
+    when that moves it by no more than tol.
+    """
+    out = a.copy()
+    for index in zip(*np.nonzero(a)):
+        value = float(Fraction(a[index]).limit_denominator(max_denominator))
+        if abs(value - a[index]) <= tol:
+            out[index] = value
+    return out
@@ -1,91 +1,609 @@
 # John Eargle
 # 2016-2017
 
+import array
+import collections
+import re
+
+import numpy as np
+
 
 # Element and Molecule information
 
 
-class Element():
+class Registry():
+    """
+    Columnar storage for Elements and Molecules.
+
+    Element and Molecule objects are small views holding only their
+    registry and index.  The data behind them lives here in flat arrays:
+    element names, symbols and atomic numbers; molecule names and
+    abbreviations (interned), charges, and composition ids.  Each distinct
+    composition is stored once, CSR-style, as offsets into parallel arrays
+    of element indices and counts, so isomers share their composition.
+    Formulas are built on first use and cached per composition.
+    """
+
+    def __init__(self):
+        self.element_names = []
+        self.symbols = []
+        self.atomic_numbers = array.array('i')
+        self.symbol2index = {}
+
+        self.names = []
+        self.abbrs = []
+        self.charges = array.array('i')
+        self.composition_ids = array.array('i')
+        self.offsets = array.array('l', [0])
+        self.composition_elements = array.array('i')
+        self.composition_counts = array.array('i')
+        self.composition2id = {}
+        self.formulas = {}
+        # (name, abbr, charge, composition id) to index, built on the
+        # first add_molecules() with reuse
+        self.molecule_keys = None
+
+    def add_element(self, name, symbol, atomic_number):
+        """
+        Store an element and return its index.
+        """
+        index = len(self.symbols)
+        self.element_names.append(intern(name))
+        self.symbols.append(intern(symbol))
+        self.atomic_numbers.append(atomic_number)
+        self.symbol2index[symbol] = index
+        return index
+
+    def add_molecule(self, name, composition, charge=0, abbr=None):
+        """
+        Store a molecule and return its index.  The composition is a list
+        of (element, count) tuples, elements given by symbol or Element.
+        """
+        # Resolve the composition first so a bad element leaves the
+        # columns untouched
+        composition_id = self.composition_id(composition)
+        index = len(self.names)
+        name = intern(name)
+        self.names.append(name)
+        self.abbrs.append(intern(abbr) if abbr is not None else name)
+        self.charges.append(charge)
+        self.composition_ids.append(composition_id)
+        if self.molecule_keys is not None:
+            self.molecule_keys.setdefault(self._molecule_key(index), index)
+        return index
+
+    def add_molecules(self, names, formulas, charges=None, abbrs=None,
+                      reuse=False):
+        """
+        Store columns of molecule records in one pass and return their
+        indices.  Each distinct formula string is parsed once.
+        names, formulas: sequences of strings
+        charges: sequence of charges; None, or None entries, take the
+          charge written in the formula
+        abbrs: sequence of abbreviations; None entries default to the name
+        reuse: return the index of an already stored molecule with the
+          same name, abbreviation, charge and composition instead of
+          storing it again
+        """
+        start = len(self.names)
+        parsed = {}
+        ids = array.array('i')
+        formula_charges = array.array('i')
+        for formula in formulas:
+            entry = parsed.get(formula)
+            if entry is None:
+                composition, charge = parse_formula(formula)
+                entry = (self.composition_id(composition), charge)
+                parsed[formula] = entry
+            ids.append(entry[0])
+            formula_charges.append(entry[1])
+
+        names = [intern(name) for name in names]
+        if len(names) != len(ids):
+            raise ValueError('Expected %d names, got %d' %
+                             (len(ids), len(names)))
+        if charges is not None and len(charges) != len(ids):
+            raise ValueError('Expected %d charges, got %d' %
+                             (len(ids), len(charges)))
+        if abbrs is not None and len(abbrs) != len(ids):
+            raise ValueError('Expected %d abbrs, got %d' %
+                             (len(ids), len(abbrs)))
+        if abbrs is None:
+            abbrs = names
+        else:
+            abbrs = [intern(abbr) if abbr is not None else name
+                     for name, abbr in zip(names, abbrs)]
+        if charges is not None:
+            formula_charges = array.array(
+                'i', [c if c is not None else f
+                      for c, f in zip(charges, formula_charges)])
+
+        if reuse:
+            if self.molecule_keys is None:
+                self.molecule_keys = {}
+                for index in range(len(self.names)):
+                    self.molecule_keys.setdefault(self._molecule_key(index),
+                                                  index)
+            indices = []
+            for key in zip(names, abbrs, formula_charges, ids):
+                index = self.molecule_keys.get(key)
+                if index is None:
+                    index = len(self.names)
+                    self.names.append(key[0])
+                    self.abbrs.append(key[1])
+                    self.charges.append(key[2])
+                    self.composition_ids.append(key[3])
+                    self.molecule_keys[key] = index
+                indices.append(index)
+            return indices
+
+        self.names.extend(names)
+        self.abbrs.extend(abbrs)
+        self.charges.extend(formula_charges)
+        self.composition_ids.extend(ids)
+        if self.molecule_keys is not None:
+            for index in range(start, len(self.names)):
+                self.molecule_keys.setdefault(self._molecule_key(index),
+                                              index)
+        return range(start, len(self.names))
+
+    def _molecule_key(self, index):
+        return (self.names[index], self.abbrs[index], self.charges[index],
+                self.composition_ids[index])
+
+    def composition_id(self, composition):
+        """
+        Id of a composition, given as (element, count) tuples, storing it
+        if it is new.  Repeated elements are summed.
+        """
+        if isinstance(composition, tuple):
+            # Parsed formulas come back as the same tuples
+            composition_id = self.composition2id.get(composition)
+            if composition_id is not None:
+                return composition_id
+
+        totals = {}
+        order = []
+        symbol2index = self.symbol2index
+        for element, count in composition:
+            if isinstance(element, Element):
+                element = element.index
+            else:
+                element = symbol2index[element]
+            if element in totals:
+                totals[element] += count
+            else:
+                totals[element] = count
+                order.append(element)
+        key = tuple([(e, totals[e]) for e in order])
+
+        composition_id = self.composition2id.get(key)
+        if composition_id is None:
+            composition_id = len(self.offsets) - 1
+            self.composition2id[key] = composition_id
+            self.composition_elements.extend(order)
+            self.composition_counts.extend([totals[e] for e in order])
+            self.offsets.append(len(self.composition_elements))
+        if isinstance(composition, tuple):
+            self.composition2id[composition] = composition_id
+        return composition_id
+
+    def composition(self, index):
+        """
+        Element indices and counts of a molecule.
+        """
+        composition_id = self.composition_ids[index]
+        start = self.offsets[composition_id]
+        stop = self.offsets[composition_id + 1]
+        return (self.composition_elements[start:stop],
+                self.composition_counts[start:stop])
+
+    def formula(self, index):
+        """
+        Formula string of a molecule, built once and cached.
+        """
+        composition_id = self.composition_ids[index]
+        formula = self.formulas.get(composition_id)
+        if formula is None:
+            elements, counts = self.composition(index)
+            formula = ''.join(['%s%d' % (self.symbols[e], c)
+                               if c > 1
+                               else self.symbols[e]
+                               for e, c in zip(elements, counts)])
+            self.formulas[composition_id] = formula
+        return formula
+
+    def compositions(self, indices):
+        """
+        Compositions of the molecules at the given indices, flattened in
+        stored order.  Returns (positions, elements, counts) where
+        positions index into indices.
+        """
+        ids = _array(self.composition_ids)[indices]
+        offsets = _array(self.offsets)
+        starts = offsets[ids]
+        lengths = offsets[ids + 1] - starts
+        positions = np.repeat(np.arange(len(starts)), lengths)
+        flat = (np.repeat(starts - np.cumsum(lengths) + lengths, lengths) +
+                np.arange(lengths.sum()))
+        return (positions, _array(self.composition_elements)[flat],
+                _array(self.composition_counts)[flat])
+
+    def charge_vector(self, indices):
+        """
+        Charges of the molecules at the given indices.
+        """
+        return _array(self.charges)[indices]
+
+
+def _memoize(maxsize):
+    """
+    Least recently used cache for a function of one hashable argument.
+    Entries sit in a circular doubly linked list, most recent last, next
+    to a dict from keys to list links.
+    """
+    def decorate(function):
+        cache = {}
+        root = []
+        root[:] = [root, root, None, None]  # [previous, next, key, value]
+
+        def memoized(key):
+            link = cache.get(key)
+            if link is not None:
+                previous, following = link[0], link[1]
+                previous[1] = following
+                following[0] = previous
+            else:
+                value = function(key)
+                if len(cache) >= maxsize:
+                    oldest = root[1]
+                    root[1] = oldest[1]
+                    oldest[1][0] = root
+                    del cache[oldest[2]]
+                link = [None, None, key, value]
+                cache[key] = link
+            last = root[0]
+            last[1] = link
+            link[0] = last
+            link[1] = root
+            root[0] = link
+            return link[3]
+
+        memoized.__doc__ = function.__doc__
+        memoized.cache = cache
+        return memoized
+    return decorate
+
+
+_FORMULA_FLAT = re.compile(r'(?:[A-Z][a-z]?\d*)*$')
+_FORMULA_ATOM = re.compile(r'([A-Z][a-z]?)(\d*)')
+_FORMULA_TOKEN = re.compile(r'([A-Z][a-z]?)(\d*)|([(\[{])|([)\]}])(\d*)')
+_FORMULA_CHARGE = re.compile(r'(?:\^(\d*)([+-])|\^?([+-])(\d*))$')
+_FORMULA_PARTS = re.compile(r'[.*]')
+_FORMULA_MULTIPLIER = re.compile(r'\d*')
+
+
+@_memoize(1 << 17)
+def parse_formula(formula):
+    """
+    Composition and charge of a chemical formula string.  Returns
+    (((symbol, count), ...), charge) with repeated elements summed in order
+    of first appearance.
+
+    Groups in (), [] or {} take a trailing multiplier, and hydrates or
+    adducts are joined by '.' or '*' with an optional leading multiplier,
+    e.g. 'Ca(OH)2', 'CuSO4.5H2O'.  A charge goes at the end as a sign with
+    an optional magnitude after it ('NH4+', 'HPO4-2') or, with a caret,
+    before it ('Fe^2+').  Results are memoized.
+    """
+    charge = 0
+    body = formula
+    match = _FORMULA_CHARGE.search(formula)
+    if match is not None:
+        if match.group(2) is not None:
+            magnitude, sign = match.group(1), match.group(2)
+        else:
+            sign, magnitude = match.group(3), match.group(4)
+        charge = int(magnitude) if magnitude else 1
+        if sign == '-':
+            charge = -charge
+        body = formula[0:match.start()]
+
+    totals = {}
+    order = []
+    if _FORMULA_FLAT.match(body):
+        # Plain run of element symbols and counts
+        for symbol, count in _FORMULA_ATOM.findall(body):
+            if symbol not in totals:
+                totals[symbol] = 0
+                order.append(symbol)
+            totals[symbol] += int(count) if count else 1
+        return tuple([(e, totals[e]) for e in order]), charge
+
+    for part in _FORMULA_PARTS.split(body):
+        multiplier = _FORMULA_MULTIPLIER.match(part).group(0)
+        part = part[len(multiplier):]
+        multiplier = int(multiplier) if multiplier else 1
+
+        # Stack of (counts, order) for each open group
+        stack = [({}, [])]
+        position = 0
+        while position < len(part):
+            token = _FORMULA_TOKEN.match(part, position)
+            if token is None:
+                raise ValueError('Cannot parse formula: %s' % (formula))
+            symbol, count, opening, closing, group_count = token.groups()
+            if symbol is not None:
+                _add_count(stack[-1], symbol, int(count) if count else 1)
+            elif opening is not None:
+                stack.append(({}, []))
+            else:
+                if len(stack) == 1:
+                    raise ValueError('Unbalanced formula: %s' % (formula))
+                counts, group_order = stack.pop()
+                group_multiplier = int(group_count) if group_count else 1
+                for symbol in group_order:
+                    _add_count(stack[-1], symbol,
+                               counts[symbol] * group_multiplier)
+            position = token.end()
+        if len(stack) != 1:
+            raise ValueError('Unbalanced formula: %s' % (formula))
+
+        counts, part_order = stack[0]
+        for symbol in part_order:
+            _add_count((totals, order), symbol, counts[symbol] * multiplier)
+    return tuple([(e, totals[e]) for e in order]), charge
+
+
+def _add_count(group, symbol, count):
+    counts, order = group
+    if symbol not in counts:
+        counts[symbol] = 0
+        order.append(symbol)
+    counts[symbol] += count
+
+
+def _array(values):
+    """
+    NumPy copy of an array.array.  The copy is needed because the array's
+    buffer moves when it grows.
+    """
+    return np.frombuffer(values, dtype=np.dtype(values.typecode)).copy()
+
+
+# Registry backing the built-in Elements and Molecules below and any
+# created without an explicit registry
+default_registry = Registry()
+
+
+def get_registry(registry=None):
+    """
+    The given registry, or the default registry once the built-in
+    Elements are in it so that formulas can use their symbols.
+    """
+    if registry is None:
+        elements.load()
+        return default_registry
+    return registry
+
+
+class _LazyTable(collections.Mapping):
+    """
+    Readonly dict of built-in objects, built on first access so importing
+    this module stays cheap for processes that never use them.
+    """
+
+    def __init__(self, build):
+        self._build = build
+        self._table = None
+
+    def load(self):
+        """
+        Build the table if it has not been built.  Objects created while
+        building see an empty table rather than rebuilding it.
+        """
+        if self._table is None:
+            self._table = {}
+            try:
+                self._table = self._build()
+            except:
+                self._table = None
+                raise
+        return self._table
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+
+class Element(object):
     """
     Readonly information for a chemical element.
     """
 
-    def __init__(self, name, symbol, atomic_number):
-        self.name = name
-        self.symbol = symbol
-        self.atomic_number = atomic_number
+    __slots__ = ('registry', 'index')
+
+    def __init__(self, name, symbol, atomic_number, registry=None):
+        registry = get_registry(registry)
+        self.registry = registry
+        self.index = registry.add_element(name, symbol, atomic_number)
+
+    @classmethod
+    def view(cls, registry, index):
+        """
+        Element already stored at index of a registry.
+        """
+        element = cls.__new__(cls)
+        element.registry = registry
+        element.index = index
+        return element
+
+    @property
+    def name(self):
+        return self.registry.element_names[self.index]
+
+    @property
+    def symbol(self):
+        return self.registry.symbols[self.index]
+
+    @property
+    def atomic_number(self):
+        return self.registry.atomic_numbers[self.index]
+
+    def __eq__(self, other):
+        return (isinstance(other, Element) and
+                self.registry is other.registry and self.index == other.index)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.registry), self.index))
 
     def __str__(self):
         return str(self.name)
 
 
-elements = {
-    e.symbol: e
-    for e in [
-            Element('hydrogen', 'H', 1),
-            Element('helium', 'He', 2),
-            Element('lithium', 'Li', 3),
-            Element('beryllium', 'Be', 4),
-            Element('boron', 'B', 5),
-            Element('carbon', 'C', 6),
-            Element('nitrogen', 'N', 7),
-            Element('oxygen', 'O', 8),
-            Element('fluorine', 'F', 9),
-            Element('neon', 'Ne', 10),
-            Element('sodium', 'Na', 11),
-            Element('magnesium', 'Mg', 12),
-            Element('aluminum', 'Al', 13),
-            Element('silicon', 'Si', 14),
-            Element('phosphorus', 'P', 15),
-            Element('sulfur', 'S', 16),
-            Element('chlorine', 'Cl', 17),
-            Element('argon', 'Ar', 18),
-            Element('potassium', 'K', 19),
-            Element('calcium', 'Ca', 20),
-            Element('manganese', 'Mn', 25),
-            Element('iron', 'Fe', 26),
-            Element('copper', 'Cu', 29),
-            Element('zinc', 'Zn', 30),
-            Element('selenium', 'Se', 34),
-            Element('bromine', 'Br', 35),
-            Element('element1', 'Ea', 1),
-            Element('element2', 'Eb', 2),
-            Element('element3', 'Ec', 3),
-            Element('element4', 'Ed', 4),
-            Element('element5', 'Ee', 5),
-    ]
-}
-
-
-class Molecule():
+def _elements():
+    """
+    Built-in Elements keyed by symbol.
+    """
+    return {
+        e.symbol: e
+        for e in [
+                Element('hydrogen', 'H', 1),
+                Element('helium', 'He', 2),
+                Element('lithium', 'Li', 3),
+                Element('beryllium', 'Be', 4),
+                Element('boron', 'B', 5),
+                Element('carbon', 'C', 6),
+                Element('nitrogen', 'N', 7),
+                Element('oxygen', 'O', 8),
+                Element('fluorine', 'F', 9),
+                Element('neon', 'Ne', 10),
+                Element('sodium', 'Na', 11),
+                Element('magnesium', 'Mg', 12),
+                Element('aluminum', 'Al', 13),
+                Element('silicon', 'Si', 14),
+                Element('phosphorus', 'P', 15),
+                Element('sulfur', 'S', 16),
+                Element('chlorine', 'Cl', 17),
+                Element('argon', 'Ar', 18),
+                Element('potassium', 'K', 19),
+                Element('calcium', 'Ca', 20),
+                Element('manganese', 'Mn', 25),
+                Element('iron', 'Fe', 26),
+                Element('copper', 'Cu', 29),
+                Element('zinc', 'Zn', 30),
+                Element('selenium', 'Se', 34),
+                Element('bromine', 'Br', 35),
+                Element('element1', 'Ea', 1),
+                Element('element2', 'Eb', 2),
+                Element('element3', 'Ec', 3),
+                Element('element4', 'Ed', 4),
+                Element('element5', 'Ee', 5),
+        ]
+    }
+
+elements = _LazyTable(_elements)
+
+
+class Molecule(object):
     """
     Readonly information for a molecule.
     """
 
-    def __init__(self, name, composition, charge=0, abbr=None):
+    __slots__ = ('registry', 'index')
+
+    def __init__(self, name, composition, charge=None, abbr=None,
+                 registry=None):
         """
-        The chemical composition is a list of (Element, number) tuples.
-        The formula is a string built from the composition.
+        The chemical composition is a list of (Element, number) tuples,
+        Elements given by symbol, or a formula string (see parse_formula).
+        The charge defaults to the one in the formula, or 0.  The formula
+        is a string built from the composition.
         """
-        self.name = name
-        if abbr is not None:
-            self.abbr = abbr
-        else:
-            self.abbr = self.name
-        self.composition = [(elements[c[0]], c[1]) for c in composition]
-        self.charge = charge
-        self.formula = ''.join(['%s%d' % (c[0].symbol, c[1])
-                                if c[1] > 1
-                                else c[0].symbol
-                                for c in self.composition])
+        registry = get_registry(registry)
+        if isinstance(composition, basestring):
+            composition, formula_charge = parse_formula(composition)
+            if charge is None:
+                charge = formula_charge
+        if charge is None:
+            charge = 0
+        self.registry = registry
+        self.index = registry.add_molecule(name, composition, charge, abbr)
+
+    @classmethod
+    def view(cls, registry, index):
+        """
+        Molecule already stored at index of a registry.
+        """
+        molecule = cls.__new__(cls)
+        molecule.registry = registry
+        molecule.index = index
+        return molecule
+
+    @classmethod
+    def bulk(cls, names, formulas, charges=None, abbrs=None, registry=None,
+             reuse=False):
+        """
+        List of new Molecules from columns of names, formula strings,
+        charges and abbreviations (see Registry.add_molecules).
+        reuse: view identical molecules already in the registry instead
+          of adding them again
+        """
+        registry = get_registry(registry)
+        return [cls.view(registry, index)
+                for index in registry.add_molecules(names, formulas,
+                                                    charges, abbrs, reuse)]
+
+    @property
+    def name(self):
+        return self.registry.names[self.index]
+
+    @property
+    def abbr(self):
+        return self.registry.abbrs[self.index]
+
+    @property
+    def charge(self):
+        return self.registry.charges[self.index]
+
+    @property
+    def composition(self):
+        """
+        List of (Element, count) tuples.
+        """
+        elements, counts = self.registry.composition(self.index)
+        return [(Element.view(self.registry, e), c)
+                for e, c in zip(elements, counts)]
+
+    @property
+    def formula(self):
+        return self.registry.formula(self.index)
 
     @property
     def elements(self):
         """
         Iterator of Elements within the Molecule.
         """
-        for element, _ in self.composition:
-            yield element
+        for element in self.registry.composition(self.index)[0]:
+            yield Element.view(self.registry, element)
+
+    def __eq__(self, other):
+        return (isinstance(other, Molecule) and
+                self.registry is other.registry and self.index == other.index)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.registry), self.index))
 
     def __str__(self):
         return str(self.name)
@@ -102,217 +620,225 @@ class Molecule():
         return s
 
 
-molecules = {
-    m.name: m
-    for m in [
-            Molecule('proton', [('H', 1)], charge=1),
-            Molecule('hydrogen', [('H', 2)]),
-            Molecule('oxygen', [('O', 2)]),
-            Molecule('water', [('H', 2), ('O', 1)]),
-            Molecule('carbon dioxide', [('C', 1), ('O', 2)]),
-            Molecule('hydrogen peroxide', [('H', 2), ('O', 2)]),
-            Molecule('methane', [('C', 1), ('H', 4)]),
-            Molecule('methanol', [('C', 1), ('H', 4), ('O', 1)]),
-            Molecule('ethanol', [('C', 1), ('H', 5), ('O', 1)]),
-            Molecule('ammonia', [('N', 1), ('H', 3)]),
-            Molecule('ammonium', [('N', 1), ('H', 4)], charge=1),
-            Molecule('phosphate', [('H', 1), ('P', 1), ('O', 4)], charge=1, abbr='Pi'),
-            # Small-molecule metabolites
-            Molecule('citrate', [('C', 6), ('H', 5), ('O', 7)]),
-            Molecule('glucose', [('C', 6), ('H', 12), ('O', 6)]),
-            Molecule('glucose-6-phosphate',
-                     [('C', 6), ('H', 11), ('O', 9), ('P', 1)]),
-            Molecule('fructose-6-phosphate',
-                     [('C', 6), ('H', 11), ('O', 9), ('P', 1)]),
-            Molecule('fructose-1,6-phosphate',
-                     [('C', 6), ('H', 10), ('O', 12), ('P', 2)]),
-            Molecule('dihydroxyacetone phosphate',
-                     [('C', 3), ('H', 5), ('O', 6), ('P', 1)]),
-            Molecule('glyceraldehyde-3-phosphate',
-                     [('C', 3), ('H', 5), ('O', 6), ('P', 1)]),
-            Molecule('1,3-diphosphoglycerate',
-                     [('C', 3), ('H', 4), ('O', 10), ('P', 2)]),
-            Molecule('2,3-diphosphoglycerate',
-                     [('C', 3), ('H', 3), ('O', 10), ('P', 2)]),
-            Molecule('2-phosphoglycerate',
-                     [('C', 3), ('H', 4), ('O', 7), ('P', 1)]),
-            Molecule('3-phosphoglycerate',
-                     [('C', 3), ('H', 4), ('O', 7), ('P', 1)]),
-            Molecule('phosphoenolpyruvate',
-                     [('C', 3), ('H', 5), ('O', 6), ('P', 1)]),
-            Molecule('pyruvate',
-                     [('C', 3), ('H', 3), ('O', 3)]),
-            Molecule('lactate',
-                     [('C', 3), ('H', 5), ('O', 3)]),
-            Molecule('6-phosphogluco-lactone',
-                     [('C', 6), ('H', 9), ('O', 9), ('P', 1)]),
-            Molecule('6-phosphogluconate',
-                     [('C', 6), ('H', 10), ('O', 10), ('P', 1)]),
-            Molecule('ribulose-5-phosphate',
-                     [('C', 5), ('H', 9), ('O', 8), ('P', 1)]),
-            Molecule('xylulose-5-phosphate',
-                     [('C', 5), ('H', 9), ('O', 8), ('P', 1)]),
-            Molecule('ribose-1-phosphate',
-                     [('C', 5), ('H', 9), ('O', 8), ('P', 1)]),
-            Molecule('ribose-5-phosphate',
-                     [('C', 5), ('H', 9), ('O', 8), ('P', 1)]),
-            Molecule('5-phosphoribosyl 1-pyrophosphate',
-                     [('C', 5), ('H', 8), ('O', 14), ('P', 3)]),
-            Molecule('erythrose-4-phosphate',
-                     [('C', 4), ('H', 7), ('O', 7), ('P', 1)]),
-            Molecule('sedoheptulose-7-phosphate',
-                     [('C', 7), ('H', 13), ('O', 10), ('P', 1)]),
-            Molecule('inosine',
-                     [('C', 10), ('H', 12), ('N', 4), ('O', 5)]),
-            Molecule('inosine monophosphate',
-                     [('C', 10), ('H', 12), ('N', 4), ('O', 8), ('P', 1)]),
-            Molecule('hypoxanthine',
-                     [('C', 5), ('H', 4), ('N', 4), ('O', 1)]),
-            # Amino acids
-            Molecule('alanine',
-                     [('C', 3), ('H', 7), ('N', 1), ('O', 2)]),
-            Molecule('arginine',
-                     [('C', 6), ('H', 14), ('N', 4), ('O', 2)]),
-            Molecule('asparagine',
-                     [('C', 4), ('H', 8), ('N', 2), ('O', 3)]),
-            Molecule('aspartic acid',
-                     [('C', 4), ('H', 7), ('N', 1), ('O', 4)]),
-            Molecule('cysteine',
-                     [('C', 3), ('H', 7), ('N', 1), ('O', 2), ('S', 1)]),
-            Molecule('glutamic acid',
-                     [('C', 5), ('H', 9), ('N', 1), ('O', 4)]),
-            Molecule('glutamine',
-                     [('C', 5), ('H', 10), ('N', 2), ('O', 3)]),
-            Molecule('glycine',
-                     [('C', 2), ('H', 5), ('N', 1), ('O', 2)]),
-            Molecule('histidine',
-                     [('C', 6), ('H', 9), ('N', 3), ('O', 2)]),
-            Molecule('isoleucine',
-                     [('C', 6), ('H', 13), ('N', 1), ('O', 2)]),
-            Molecule('leucine',
-                     [('C', 6), ('H', 13), ('N', 1), ('O', 2)]),
-            Molecule('lysine',
-                     [('C', 6), ('H', 14), ('N', 2), ('O', 2)]),
-            Molecule('methionine',
-                     [('C', 5), ('H', 11), ('N', 1), ('O', 2)], ('S', 1)),
-            Molecule('phenylalanine',
-                     [('C', 9), ('H', 11), ('N', 1), ('O', 2)]),
-            Molecule('proline',
-                     [('C', 5), ('H', 9), ('N', 1), ('O', 2)]),
-            Molecule('serine',
-                     [('C', 3), ('H', 7), ('N', 1), ('O', 3)]),
-            Molecule('threonine',
-                     [('C', 4), ('H', 9), ('N', 1), ('O', 3)]),
-            Molecule('tryptophan',
-                     [('C', 11), ('H', 12), ('N', 2), ('O', 2)]),
-            Molecule('tyrosine',
-                     [('C', 9), ('H', 11), ('N', 1), ('O', 3)]),
-            Molecule('valine',
-                     [('C', 5), ('H', 11), ('N', 1), ('O', 2)]),
-            Molecule('selenocysteine',
-                     [('C', 3), ('H', 7), ('N', 1), ('O', 2), ('Se', 1)]),
-            # Nucleic acids
-            Molecule('adenine',
-                     [('C', 5), ('H', 5), ('N', 5)]),
-            Molecule('cytosine',
-                     [('C', 4), ('H', 5), ('N', 3), ('O', 1)]),
-            Molecule('guanine',
-                     [('C', 5), ('H', 5), ('N', 5), ('O', 1)]),
-            Molecule('thymine',
-                     [('C', 5), ('H', 6), ('N', 2), ('O', 2)]),
-            Molecule('uracil',
-                     [('C', 4), ('H', 4), ('N', 2), ('O', 2)]),
-            Molecule('adenosine',
-                     [('C', 10), ('H', 13), ('N', 5), ('O', 4)]),
-            Molecule('cytidine',
-                     [('C', 9), ('H', 13), ('N', 3), ('O', 5)]),
-            Molecule('guanosine',
-                     [('C', 10), ('H', 13), ('N', 5), ('O', 5)]),
-            Molecule('thymidine',
-                     [('C', 10), ('H', 14), ('N', 2), ('O', 6)]),
-            Molecule('uridine',
-                     [('C', 9), ('H', 12), ('N', 2), ('O', 6)]),
-            Molecule('adenosine monophosphate',
-                     [('C', 10), ('H', 12), ('N', 5), ('O', 7), ('P', 1)],
-                     charge=-2, abbr='AMP'),
-            Molecule('cytosine monophosphate',
-                     [('C', 9), ('H', 12), ('N', 3), ('O', 8), ('P', 1)],
-                     charge=-2, abbr='CMP'),
-            Molecule('guanine monophosphate',
-                     [('C', 10), ('H', 12), ('N', 5), ('O', 8), ('P', 1)],
-                     charge=-2, abbr='GMP'),
-            Molecule('thymine monophosphate',
-                     [('C', 10), ('H', 13), ('N', 2), ('O', 9), ('P', 1)],
-                     charge=-2, abbr='TMP'),
-            Molecule('uracil monophosphate',
-                     [('C', 9), ('H', 11), ('N', 2), ('O', 9), ('P', 1)],
-                     charge=-2, abbr='UMP'),
-            Molecule('adenosine diphosphate',
-                     [('C', 10), ('H', 12), ('N', 5), ('O', 10), ('P', 2)],
-                     charge=-3, abbr='ADP'),
-            Molecule('cytosine diphosphate',
-                     [('C', 9), ('H', 12), ('N', 3), ('O', 11), ('P', 2)],
-                     charge=-3, abbr='CDP'),
-            Molecule('guanine diphosphate',
-                     [('C', 10), ('H', 12), ('N', 5), ('O', 11), ('P', 2)],
-                     charge=-3, abbr='GDP'),
-            Molecule('thymine diphosphate',
-                     [('C', 10), ('H', 13), ('N', 2), ('O', 12), ('P', 2)],
-                     charge=-3, abbr='TDP'),
-            Molecule('uracil diphosphate',
-                     [('C', 9), ('H', 11), ('N', 2), ('O', 12), ('P', 2)],
-                     charge=-3, abbr='UDP'),
-            Molecule('adenosine triphosphate',
-                     [('C', 10), ('H', 12), ('N', 5), ('O', 13), ('P', 3)],
-                     charge=-4, abbr='ATP'),
-            Molecule('cytosine triphosphate',
-                     [('C', 9), ('H', 12), ('N', 3), ('O', 14), ('P', 3)],
-                     charge=-4, abbr='CTP'),
-            Molecule('guanine triphosphate',
-                     [('C', 10), ('H', 12), ('N', 5), ('O', 14), ('P', 3)],
-                     charge=-4, abbr='GTP'),
-            Molecule('thymine triphosphate',
-                     [('C', 10), ('H', 13), ('N', 2), ('O', 15), ('P', 3)],
-                     charge=-4, abbr='CTP'),
-            Molecule('uracil triphosphate',
-                     [('C', 9), ('H', 11), ('N', 2), ('O', 15), ('P', 3)],
-                     charge=-4, abbr='UTP'),
-            Molecule('nicotinamide adenine dinucleotide',
-                     [('C', 21), ('H', 27), ('N', 7), ('O', 14), ('P', 2)],
-                     abbr='NAD'),
-            Molecule('nicotinamide adenine dinucleotide H',
-                     [('C', 21), ('H', 28), ('N', 7), ('O', 14), ('P', 2)],
-                     abbr='NADH'),
-            Molecule('nicotinamide adenine dinucleotide phosphate',
-                     [('C', 21), ('H', 27), ('N', 7), ('O', 17), ('P', 3)],
-                     abbr='NADP'),
-            Molecule('nicotinamide adenine dinucleotide phosphate H',
-                     [('C', 21), ('H', 28), ('N', 7), ('O', 17), ('P', 3)],
-                     abbr='NADPH'),
-            Molecule('molecule1',
-                     [('Ea', 1), ('Eb', 2)],
-                     abbr='mol1'),
-            Molecule('molecule2',
-                     [('Ea', 2), ('Ec', 2)],
-                     abbr='mol2'),
-            Molecule('molecule3',
-                     [('Ea', 2), ('Ed', 1)],
-                     abbr='mol3'),
-            Molecule('molecule4',
-                     [('Eb', 2), ('Ed', 3)],
-                     abbr='mol4'),
-            Molecule('molecule5',
-                     [('Eb', 2), ('Ee', 4)],
-                     abbr='mol5'),
-    ]
-}
-
-
-class Reaction():
+def _molecules():
+    """
+    Built-in Molecules keyed by name.
+    """
+    return {
+        m.name: m
+        for m in [
+                Molecule('proton', [('H', 1)], charge=1),
+                Molecule('hydrogen', [('H', 2)]),
+                Molecule('oxygen', [('O', 2)]),
+                Molecule('water', [('H', 2), ('O', 1)]),
+                Molecule('carbon dioxide', [('C', 1), ('O', 2)]),
+                Molecule('hydrogen peroxide', [('H', 2), ('O', 2)]),
+                Molecule('methane', [('C', 1), ('H', 4)]),
+                Molecule('methanol', [('C', 1), ('H', 4), ('O', 1)]),
+                Molecule('ethanol', [('C', 1), ('H', 5), ('O', 1)]),
+                Molecule('ammonia', [('N', 1), ('H', 3)]),
+                Molecule('ammonium', [('N', 1), ('H', 4)], charge=1),
+                Molecule('phosphate', [('H', 1), ('P', 1), ('O', 4)], charge=1, abbr='Pi'),
+                # Small-molecule metabolites
+                Molecule('citrate', [('C', 6), ('H', 5), ('O', 7)]),
+                Molecule('glucose', [('C', 6), ('H', 12), ('O', 6)]),
+                Molecule('glucose-6-phosphate',
+                         [('C', 6), ('H', 11), ('O', 9), ('P', 1)]),
+                Molecule('fructose-6-phosphate',
+                         [('C', 6), ('H', 11), ('O', 9), ('P', 1)]),
+                Molecule('fructose-1,6-phosphate',
+                         [('C', 6), ('H', 10), ('O', 12), ('P', 2)]),
+                Molecule('dihydroxyacetone phosphate',
+                         [('C', 3), ('H', 5), ('O', 6), ('P', 1)]),
+                Molecule('glyceraldehyde-3-phosphate',
+                         [('C', 3), ('H', 5), ('O', 6), ('P', 1)]),
+                Molecule('1,3-diphosphoglycerate',
+                         [('C', 3), ('H', 4), ('O', 10), ('P', 2)]),
+                Molecule('2,3-diphosphoglycerate',
+                         [('C', 3), ('H', 3), ('O', 10), ('P', 2)]),
+                Molecule('2-phosphoglycerate',
+                         [('C', 3), ('H', 4), ('O', 7), ('P', 1)]),
+                Molecule('3-phosphoglycerate',
+                         [('C', 3), ('H', 4), ('O', 7), ('P', 1)]),
+                Molecule('phosphoenolpyruvate',
+                         [('C', 3), ('H', 5), ('O', 6), ('P', 1)]),
+                Molecule('pyruvate',
+                         [('C', 3), ('H', 3), ('O', 3)]),
+                Molecule('lactate',
+                         [('C', 3), ('H', 5), ('O', 3)]),
+                Molecule('6-phosphogluco-lactone',
+                         [('C', 6), ('H', 9), ('O', 9), ('P', 1)]),
+                Molecule('6-phosphogluconate',
+                         [('C', 6), ('H', 10), ('O', 10), ('P', 1)]),
+                Molecule('ribulose-5-phosphate',
+                         [('C', 5), ('H', 9), ('O', 8), ('P', 1)]),
+                Molecule('xylulose-5-phosphate',
+                         [('C', 5), ('H', 9), ('O', 8), ('P', 1)]),
+                Molecule('ribose-1-phosphate',
+                         [('C', 5), ('H', 9), ('O', 8), ('P', 1)]),
+                Molecule('ribose-5-phosphate',
+                         [('C', 5), ('H', 9), ('O', 8), ('P', 1)]),
+                Molecule('5-phosphoribosyl 1-pyrophosphate',
+                         [('C', 5), ('H', 8), ('O', 14), ('P', 3)]),
+                Molecule('erythrose-4-phosphate',
+                         [('C', 4), ('H', 7), ('O', 7), ('P', 1)]),
+                Molecule('sedoheptulose-7-phosphate',
+                         [('C', 7), ('H', 13), ('O', 10), ('P', 1)]),
+                Molecule('inosine',
+                         [('C', 10), ('H', 12), ('N', 4), ('O', 5)]),
+                Molecule('inosine monophosphate',
+                         [('C', 10), ('H', 12), ('N', 4), ('O', 8), ('P', 1)]),
+                Molecule('hypoxanthine',
+                         [('C', 5), ('H', 4), ('N', 4), ('O', 1)]),
+                # Amino acids
+                Molecule('alanine',
+                         [('C', 3), ('H', 7), ('N', 1), ('O', 2)]),
+                Molecule('arginine',
+                         [('C', 6), ('H', 14), ('N', 4), ('O', 2)]),
+                Molecule('asparagine',
+                         [('C', 4), ('H', 8), ('N', 2), ('O', 3)]),
+                Molecule('aspartic acid',
+                         [('C', 4), ('H', 7), ('N', 1), ('O', 4)]),
+                Molecule('cysteine',
+                         [('C', 3), ('H', 7), ('N', 1), ('O', 2), ('S', 1)]),
+                Molecule('glutamic acid',
+                         [('C', 5), ('H', 9), ('N', 1), ('O', 4)]),
+                Molecule('glutamine',
+                         [('C', 5), ('H', 10), ('N', 2), ('O', 3)]),
+                Molecule('glycine',
+                         [('C', 2), ('H', 5), ('N', 1), ('O', 2)]),
+                Molecule('histidine',
+                         [('C', 6), ('H', 9), ('N', 3), ('O', 2)]),
+                Molecule('isoleucine',
+                         [('C', 6), ('H', 13), ('N', 1), ('O', 2)]),
+                Molecule('leucine',
+                         [('C', 6), ('H', 13), ('N', 1), ('O', 2)]),
+                Molecule('lysine',
+                         [('C', 6), ('H', 14), ('N', 2), ('O', 2)]),
+                Molecule('methionine',
+                         [('C', 5), ('H', 11), ('N', 1), ('O', 2), ('S', 1)]),
+                Molecule('phenylalanine',
+                         [('C', 9), ('H', 11), ('N', 1), ('O', 2)]),
+                Molecule('proline',
+                         [('C', 5), ('H', 9), ('N', 1), ('O', 2)]),
+                Molecule('serine',
+                         [('C', 3), ('H', 7), ('N', 1), ('O', 3)]),
+                Molecule('threonine',
+                         [('C', 4), ('H', 9), ('N', 1), ('O', 3)]),
+                Molecule('tryptophan',
+                         [('C', 11), ('H', 12), ('N', 2), ('O', 2)]),
+                Molecule('tyrosine',
+                         [('C', 9), ('H', 11), ('N', 1), ('O', 3)]),
+                Molecule('valine',
+                         [('C', 5), ('H', 11), ('N', 1), ('O', 2)]),
+                Molecule('selenocysteine',
+                         [('C', 3), ('H', 7), ('N', 1), ('O', 2), ('Se', 1)]),
+                # Nucleic acids
+                Molecule('adenine',
+                         [('C', 5), ('H', 5), ('N', 5)]),
+                Molecule('cytosine',
+                         [('C', 4), ('H', 5), ('N', 3), ('O', 1)]),
+                Molecule('guanine',
+                         [('C', 5), ('H', 5), ('N', 5), ('O', 1)]),
+                Molecule('thymine',
+                         [('C', 5), ('H', 6), ('N', 2), ('O', 2)]),
+                Molecule('uracil',
+                         [('C', 4), ('H', 4), ('N', 2), ('O', 2)]),
+                Molecule('adenosine',
+                         [('C', 10), ('H', 13), ('N', 5), ('O', 4)]),
+                Molecule('cytidine',
+                         [('C', 9), ('H', 13), ('N', 3), ('O', 5)]),
+                Molecule('guanosine',
+                         [('C', 10), ('H', 13), ('N', 5), ('O', 5)]),
+                Molecule('thymidine',
+                         [('C', 10), ('H', 14), ('N', 2), ('O', 6)]),
+                Molecule('uridine',
+                         [('C', 9), ('H', 12), ('N', 2), ('O', 6)]),
+                Molecule('adenosine monophosphate',
+                         [('C', 10), ('H', 12), ('N', 5), ('O', 7), ('P', 1)],
+                         charge=-2, abbr='AMP'),
+                Molecule('cytosine monophosphate',
+                         [('C', 9), ('H', 12), ('N', 3), ('O', 8), ('P', 1)],
+                         charge=-2, abbr='CMP'),
+                Molecule('guanine monophosphate',
+                         [('C', 10), ('H', 12), ('N', 5), ('O', 8), ('P', 1)],
+                         charge=-2, abbr='GMP'),
+                Molecule('thymine monophosphate',
+                         [('C', 10), ('H', 13), ('N', 2), ('O', 9), ('P', 1)],
+                         charge=-2, abbr='TMP'),
+                Molecule('uracil monophosphate',
+                         [('C', 9), ('H', 11), ('N', 2), ('O', 9), ('P', 1)],
+                         charge=-2, abbr='UMP'),
+                Molecule('adenosine diphosphate',
+                         [('C', 10), ('H', 12), ('N', 5), ('O', 10), ('P', 2)],
+                         charge=-3, abbr='ADP'),
+                Molecule('cytosine diphosphate',
+                         [('C', 9), ('H', 12), ('N', 3), ('O', 11), ('P', 2)],
+                         charge=-3, abbr='CDP'),
+                Molecule('guanine diphosphate',
+                         [('C', 10), ('H', 12), ('N', 5), ('O', 11), ('P', 2)],
+                         charge=-3, abbr='GDP'),
+                Molecule('thymine diphosphate',
+                         [('C', 10), ('H', 13), ('N', 2), ('O', 12), ('P', 2)],
+                         charge=-3, abbr='TDP'),
+                Molecule('uracil diphosphate',
+                         [('C', 9), ('H', 11), ('N', 2), ('O', 12), ('P', 2)],
+                         charge=-3, abbr='UDP'),
+                Molecule('adenosine triphosphate',
+                         [('C', 10), ('H', 12), ('N', 5), ('O', 13), ('P', 3)],
+                         charge=-4, abbr='ATP'),
+                Molecule('cytosine triphosphate',
+                         [('C', 9), ('H', 12), ('N', 3), ('O', 14), ('P', 3)],
+                         charge=-4, abbr='CTP'),
+                Molecule('guanine triphosphate',
+                         [('C', 10), ('H', 12), ('N', 5), ('O', 14), ('P', 3)],
+                         charge=-4, abbr='GTP'),
+                Molecule('thymine triphosphate',
+                         [('C', 10), ('H', 13), ('N', 2), ('O', 15), ('P', 3)],
+                         charge=-4, abbr='CTP'),
+                Molecule('uracil triphosphate',
+                         [('C', 9), ('H', 11), ('N', 2), ('O', 15), ('P', 3)],
+                         charge=-4, abbr='UTP'),
+                Molecule('nicotinamide adenine dinucleotide',
+                         [('C', 21), ('H', 27), ('N', 7), ('O', 14), ('P', 2)],
+                         abbr='NAD'),
+                Molecule('nicotinamide adenine dinucleotide H',
+                         [('C', 21), ('H', 28), ('N', 7), ('O', 14), ('P', 2)],
+                         abbr='NADH'),
+                Molecule('nicotinamide adenine dinucleotide phosphate',
+                         [('C', 21), ('H', 27), ('N', 7), ('O', 17), ('P', 3)],
+                         abbr='NADP'),
+                Molecule('nicotinamide adenine dinucleotide phosphate H',
+                         [('C', 21), ('H', 28), ('N', 7), ('O', 17), ('P', 3)],
+                         abbr='NADPH'),
+                Molecule('molecule1',
+                         [('Ea', 1), ('Eb', 2)],
+                         abbr='mol1'),
+                Molecule('molecule2',
+                         [('Ea', 2), ('Ec', 2)],
+                         abbr='mol2'),
+                Molecule('molecule3',
+                         [('Ea', 2), ('Ed', 1)],
+                         abbr='mol3'),
+                Molecule('molecule4',
+                         [('Eb', 2), ('Ed', 3)],
+                         abbr='mol4'),
+                Molecule('molecule5',
+                         [('Eb', 2), ('Ee', 4)],
+                         abbr='mol5'),
+        ]
+    }
+
+molecules = _LazyTable(_molecules)
+
+
+class Reaction(object):
     """
     Readonly information for a chemical reaction.
     """
 
+    __slots__ = ('name', 'inputs', 'outputs', 'enzyme', 'rate')
+
     def __init__(self, name, inputs, outputs, enzyme=None, rate=None):
         """
         The inputs and outputs are lists of tuples (Molecule, count) holding
@@ -349,20 +875,174 @@ class Reaction():
         return eq_str
 
 
-reactions = {
-    r.name: r
-    for r in [
-            Reaction('reaction1',
-                     [(molecules['molecule1'], 2), (molecules['molecule2'], 1)],
-                     [(molecules['molecule3'], 2)]),
-            Reaction('reaction2',
-                     [(molecules['molecule1'], 2), (molecules['molecule2'], 2)],
-                     [(molecules['molecule4'], 2), (molecules['molecule5'], 2)]),
-            Reaction('reaction3',
-                     [(molecules['molecule2'], 1)],
-                     [(molecules['molecule3'], 2), (molecules['molecule5'], 2)]),
-            Reaction('reaction4',
-                     [(molecules['water'], 2), (molecules['oxygen'], 1)],
-                     [(molecules['hydrogen peroxide'], 2)]),
-    ]
-}
+class ReactionIndex():
+    """
+    Inverted index from each Molecule to the Reactions producing and
+    consuming it, kept current as Reactions are added and removed.
+
+    Producer and consumer lookups are a dict access plus a copy of the
+    answer, and neighborhood queries only touch the Reactions around the
+    Molecules they reach, so neither scans the whole set of Reactions.
+    """
+
+    def __init__(self, reactions=None):
+        """
+        reactions: iterable of Reactions to index
+        """
+        self.reactions = set()
+        self.produced_by = {}
+        self.consumed_by = {}
+        if reactions is not None:
+            for reaction in reactions:
+                self.add(reaction)
+
+    def __len__(self):
+        return len(self.reactions)
+
+    def __contains__(self, reaction):
+        return reaction in self.reactions
+
+    def add(self, reaction):
+        """
+        Index a Reaction under the Molecules it produces and consumes.  A
+        Molecule listed more than once on a side gets its counts summed.
+        """
+        if reaction in self.reactions:
+            return
+        self.reactions.add(reaction)
+        for side, table in ((reaction.inputs, self.consumed_by),
+                            (reaction.outputs, self.produced_by)):
+            for molecule, count in _side_counts(side):
+                table.setdefault(molecule, []).append((reaction, count))
+
+    def remove(self, reaction):
+        """
+        Drop a Reaction from the index.
+        """
+        self.reactions.remove(reaction)
+        for side, table in ((reaction.inputs, self.consumed_by),
+                            (reaction.outputs, self.produced_by)):
+            for molecule, count in _side_counts(side):
+                entries = table[molecule]
+                for i in range(len(entries)):
+                    if entries[i][0] is reaction:
+                        del entries[i]
+                        break
+                if not entries:
+                    del table[molecule]
+
+    def producers(self, molecule):
+        """
+        List of (Reaction, count) for Reactions with molecule as an output.
+        """
+        return list(self.produced_by.get(molecule, ()))
+
+    def consumers(self, molecule):
+        """
+        List of (Reaction, count) for Reactions with molecule as an input.
+        """
+        return list(self.consumed_by.get(molecule, ()))
+
+    def neighbors(self, molecule, direction='both'):
+        """
+        Set of Molecules one Reaction away from molecule.
+        direction: 'forward' follows Reactions consuming molecule to their
+          outputs, 'backward' follows Reactions producing it to their
+          inputs, and 'both' does both and also includes co-reactants
+        """
+        found = set()
+        for reaction in self._adjacent(molecule, direction):
+            for side in self._sides(reaction, direction):
+                for other, count in side:
+                    found.add(other)
+        found.discard(molecule)
+        return found
+
+    def neighborhood(self, molecule, hops, direction='both', skip=None):
+        """
+        Dict of Molecule to its distance in Reactions from molecule, for
+        every Molecule within hops (breadth-first search).
+        direction: as in neighbors()
+        skip: Molecules that are reported but not expanded, usually
+          currency metabolites like water and ATP that would otherwise
+          connect everything within a couple of hops
+        """
+        if skip is None:
+            skip = ()
+        distances = {molecule: 0}
+        frontier = [molecule]
+        for hop in range(1, hops + 1):
+            reached = []
+            for current in frontier:
+                if current in skip and current is not molecule:
+                    continue
+                for other in self.neighbors(current, direction):
+                    if other not in distances:
+                        distances[other] = hop
+                        reached.append(other)
+            if not reached:
+                break
+            frontier = reached
+        return distances
+
+    def _adjacent(self, molecule, direction):
+        """
+        Reactions a search in the given direction leaves molecule through.
+        """
+        if direction not in ('forward', 'backward', 'both'):
+            raise ValueError('Unknown direction: %s' % (direction))
+        reactions = []
+        if direction != 'backward':
+            reactions.extend(r for r, count
+                             in self.consumed_by.get(molecule, ()))
+        if direction != 'forward':
+            reactions.extend(r for r, count
+                             in self.produced_by.get(molecule, ()))
+        return reactions
+
+    def _sides(self, reaction, direction):
+        if direction == 'forward':
+            return (reaction.outputs,)
+        if direction == 'backward':
+            return (reaction.inputs,)
+        return (reaction.inputs, reaction.outputs)
+
+
+def _side_counts(side):
+    """
+    (Molecule, total count) pairs for one side of a Reaction, in order of
+    first appearance.
+    """
+    totals = {}
+    order = []
+    for molecule, count in side:
+        if molecule not in totals:
+            totals[molecule] = 0
+            order.append(molecule)
+        totals[molecule] += count
+    return [(molecule, totals[molecule]) for molecule in order]
+
+
+def _reactions():
+    """
+    Built-in Reactions keyed by name.
+    """
+    return {
+        r.name: r
+        for r in [
+                Reaction('reaction1',
+                         [(molecules['molecule1'], 2), (molecules['molecule2'], 1)],
+                         [(molecules['molecule3'], 2)]),
+                Reaction('reaction2',
+                         [(molecules['molecule1'], 2), (molecules['molecule2'], 2)],
+                         [(molecules['molecule4'], 2), (molecules['molecule5'], 2)]),
+                Reaction('reaction3',
+                         [(molecules['molecule2'], 1)],
+                         [(molecules['molecule3'], 2), (molecules['molecule5'], 2)]),
+                Reaction('reaction4',
+                         [(molecules['water'], 2), (molecules['oxygen'], 1)],
+                         [(molecules['hydrogen peroxide'], 2)]),
+        ]
+    }
+
+reactions = _LazyTable(_reactions)
@@ -0,0 +1,134 @@
+# John Eargle
+# 2017
+
+import numpy as np
+
+
+# Headless export of transcription network trajectories
+
+
+def lttb(x, y, threshold):
+    """
+    Downsample a trace to threshold points with Largest-Triangle-Three-
+    Buckets (Steinarsson, 2013).  The first and last points are kept and
+    the rest are split into threshold-2 buckets.  From each bucket the
+    point making the largest triangle with the previously kept point and
+    the mean of the next bucket is kept, which preserves peaks and steps.
+    x: increasing times
+    y: values at x
+
+    Returns the kept (x, y); traces of threshold points or fewer are
+    returned whole.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    size = len(x)
+    if threshold >= size or threshold < 3:
+        return x, y
+
+    # Bucket i holds interior points edges[i] to edges[i+1]
+    edges = np.linspace(1, size - 1, threshold - 1).astype(int)
+    counts = np.diff(edges).astype(float)
+    mean_x = np.add.reduceat(x[1:-1], edges[:-1] - 1) / counts
+    mean_y = np.add.reduceat(y[1:-1], edges[:-1] - 1) / counts
+    mean_x = np.append(mean_x[1:], x[-1])
+    mean_y = np.append(mean_y[1:], y[-1])
+
+    kept = np.empty(threshold, dtype=int)
+    kept[0] = 0
+    kept[-1] = size - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, stop = edges[i], edges[i+1]
+        area = np.abs((x[a] - mean_x[i]) * (y[start:stop] - y[a]) -
+                      (x[a] - x[start:stop]) * (mean_y[i] - y[a]))
+        a = start + np.argmax(area)
+        kept[i+1] = a
+    return x[kept], y[kept]
+
+
+def column_traces(names, times, values):
+    """
+    Traces from an array with one row per time and one column per node,
+    e.g. from Network.simulate() or PiecewiseTrajectory.evaluate().
+    names: node names, e.g. [p.name for p in network.products]
+
+    Returns a list of (name, times, values).
+    """
+    values = np.asarray(values)
+    return [(name, times, values[:,i]) for i, name in enumerate(names)]
+
+
+def product_traces(products, times):
+    """
+    Traces of solved (or solvable) LogicProducts or SimpleProducts at
+    times, as a list of (name, times, values).
+    """
+    times = np.asarray(times, dtype=float)
+    return [(p.name, times, p.evaluate(times)) for p in products]
+
+
+def render(traces, path=None, max_points=2000, title=None, xlabel='time',
+           ylabel='concentration', legend=None, size=(8.0, 5.0), dpi=100):
+    """
+    Draw traces on one set of axes with the non-interactive Agg canvas,
+    so nothing is shown and no display is needed.
+    traces: list of (name, times, values)
+    path: image file to write, in the format of its extension; None only
+      returns the Figure
+    max_points: longer traces are downsampled with lttb() first; None
+      draws them whole
+    legend: whether to label the traces (default for 10 or fewer)
+
+    Returns the matplotlib Figure.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figure = Figure(figsize=size, dpi=dpi)
+    canvas = FigureCanvasAgg(figure)
+    axes = figure.add_subplot(111)
+    for name, t, y in traces:
+        if max_points is not None:
+            t, y = lttb(t, y, max_points)
+        axes.plot(t, y, label=name)
+    axes.set_xlabel(xlabel)
+    axes.set_ylabel(ylabel)
+    if title is not None:
+        axes.set_title(title)
+    axes.grid()
+    if legend is None:
+        legend = len(traces) <= 10
+    if legend and traces:
+        axes.legend(loc='best')
+    if path is not None:
+        canvas.print_figure(path)
+    return figure
+
+
+def save_npz(path, traces, max_points=None):
+    """
+    Write traces to a compressed .npz file for plotting elsewhere: the
+    names, and times_i and values_i for trace i.
+    max_points: downsample longer traces with lttb(); None keeps the
+      raw arrays
+    """
+    arrays = {'names': np.array([name for name, t, y in traces])}
+    for i, (name, t, y) in enumerate(traces):
+        if max_points is not None:
+            t, y = lttb(t, y, max_points)
+        arrays['times_%d' % (i)] = np.asarray(t, dtype=float)
+        arrays['values_%d' % (i)] = np.asarray(y, dtype=float)
+    np.savez_compressed(path, **arrays)
+
+
+def load_npz(path):
+    """
+    Traces written by save_npz(), as a list of (name, times, values).
+    """
+    data = np.load(path)
+    try:
+        return [(name, data['times_%d' % (i)], data['values_%d' % (i)])
+                for i, name in enumerate(data['names'].tolist())]
+    finally:
+        data.close()
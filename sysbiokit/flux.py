@@ -0,0 +1,293 @@
+# John Eargle
+# 2017
+
+import multiprocessing
+
+import numpy as np
+import scipy.sparse
+
+from sysbiokit.matrix import FLUX_LIMIT
+from sysbiokit.sharedmem import share, attach
+from sysbiokit.simplex import Simplex
+
+
+# Constraint-based flux analysis of metabolic networks
+
+
+class FluxBalance():
+    """
+    Flux balance analysis on a StoichioMatrix.
+
+      maximize c.v  subject to  Sv = 0
+                                lower <= v <= upper
+
+    Bounds and objective coefficients are read from the StoichioMatrix
+    (lower_bounds, upper_bounds, objective) each time a problem is solved.
+    Infinite bounds are clipped to +/- flux_limit.
+
+    The constraint matrix is handed to a Simplex once.  Knockout
+    screens reuse it and restart every LP from the wild-type optimal basis,
+    whose LU factorization is also reused.  Flux variability analysis
+    spreads its LPs over a process pool whose workers read the problem
+    from shared memory.
+    """
+
+    def __init__(self, smatrix, flux_limit=FLUX_LIMIT, tol=1e-9):
+        """
+        smatrix: StoichioMatrix with bounds and objective set
+        flux_limit: magnitude used in place of infinite bounds
+        tol: tolerance passed on to the LP solver
+        """
+        self.smatrix = smatrix
+        self.flux_limit = flux_limit
+        self.tol = tol
+        self.simplex = Simplex(smatrix.matrix, tol=tol)
+
+        self.status = None
+        self.objective = None
+        self.fluxes = None
+        self.basis = None
+
+    def bounds(self):
+        """
+        Lower and upper flux bounds with infinities clipped.
+        """
+        lower = np.clip(self.smatrix.lower_bounds,
+                        -self.flux_limit, self.flux_limit)
+        upper = np.clip(self.smatrix.upper_bounds,
+                        -self.flux_limit, self.flux_limit)
+        return lower, upper
+
+    def solve(self):
+        """
+        Solve the wild-type problem.  Returns the optimal objective value,
+        or nan if the bounds are infeasible.
+        """
+        lower, upper = self.bounds()
+        self.status = self.simplex.solve(-self.smatrix.objective,
+                                         lower, upper, basis=self.basis)
+        if self.status != 'optimal':
+            self.objective = np.nan
+            self.fluxes = None
+            self.basis = None
+            return self.objective
+
+        self.fluxes = self.simplex.x
+        self.objective = np.dot(self.smatrix.objective, self.fluxes)
+        self.basis = self.simplex.basis
+        return self.objective
+
+    def flux(self, reaction):
+        """
+        Optimal flux through a Reaction, Reaction name or column.
+        """
+        if self.fluxes is None:
+            self.solve()
+        return self.fluxes[self.smatrix.reaction_index(reaction)]
+
+    def _knockout(self, cols, basis, lower, upper):
+        """
+        Objective value and solution with the given columns fixed at zero,
+        warm-started from basis.
+        """
+        saved_lower = lower[cols].copy()
+        saved_upper = upper[cols].copy()
+        lower[cols] = 0.0
+        upper[cols] = 0.0
+        status = self.simplex.solve(-self.smatrix.objective,
+                                    lower, upper, basis=basis)
+        lower[cols] = saved_lower
+        upper[cols] = saved_upper
+        if status != 'optimal':
+            return np.nan, None, None
+        value = np.dot(self.smatrix.objective, self.simplex.x)
+        return value, self.simplex.x, self.simplex.basis
+
+    def _columns(self, reactions):
+        if reactions is None:
+            return np.arange(self.smatrix.matrix.shape[1])
+        return np.array([self.smatrix.reaction_index(r) for r in reactions])
+
+    def knockouts(self, reactions=None):
+        """
+        Optimal objective value with each reaction knocked out in turn.
+        reactions: Reactions, names or columns to screen (default all)
+
+        Reactions carrying no flux in the wild-type optimum cannot change
+        it and are not re-solved.  When the wild type is infeasible every
+        knockout is solved from scratch, since removing a reaction whose
+        bounds exclude zero can make the problem feasible.
+        """
+        if self.basis is None:
+            self.solve()
+        cols = self._columns(reactions)
+        values = np.ones(len(cols)) * self.objective
+
+        lower, upper = self.bounds()
+        for i, col in enumerate(cols):
+            if self.basis is None or abs(self.fluxes[col]) > self.tol:
+                values[i] = self._knockout([col], self.basis,
+                                           lower, upper)[0]
+        return values
+
+    def double_knockouts(self, reactions=None):
+        """
+        Optimal objective value for every pair of reactions knocked out
+        together.
+        reactions: Reactions, names or columns to screen (default all)
+
+        Returns (pairs, values) where pairs holds the column indices of
+        each knocked out pair.  Pairs are solved from the optimal basis of
+        the first single knockout, and only when the second reaction
+        carries flux there.  Pairs whose first single knockout is
+        infeasible are each solved from the wild-type basis, or from
+        scratch when the wild type is infeasible too.
+        """
+        if self.basis is None:
+            self.solve()
+        cols = self._columns(reactions)
+        first, second = np.triu_indices(len(cols), 1)
+        pairs = np.column_stack([cols[first], cols[second]])
+        values = np.ones(len(pairs)) * self.objective
+
+        lower, upper = self.bounds()
+        start = 0
+        for i, col in enumerate(cols[:-1]):
+            stop = start + len(cols) - i - 1
+            if self.basis is not None and abs(self.fluxes[col]) <= self.tol:
+                value, fluxes, basis = (self.objective, self.fluxes,
+                                        self.basis)
+            else:
+                value, fluxes, basis = self._knockout([col], self.basis,
+                                                      lower, upper)
+            values[start:stop] = value
+            if basis is None:
+                # The pair can still be feasible, e.g. when the partner's
+                # bounds exclude zero, so solve it from the wild type
+                for k in range(start, stop):
+                    values[k] = self._knockout([col, pairs[k, 1]],
+                                               self.basis, lower, upper)[0]
+            else:
+                for k in range(start, stop):
+                    other = pairs[k, 1]
+                    if abs(fluxes[other]) > self.tol:
+                        values[k] = self._knockout([col, other], basis,
+                                                   lower, upper)[0]
+            start = stop
+        return pairs, values
+
+    def variability(self, fraction=1.0, reactions=None, processes=None,
+                    chunk_size=32):
+        """
+        Flux variability analysis: the minimum and maximum flux through each
+        reaction over all solutions whose objective is within fraction of
+        the optimum.
+        reactions: Reactions, names or columns to analyze (default all)
+        processes: size of the process pool (default one per CPU); 1 runs
+          in this process
+        chunk_size: reactions per pool task
+
+        Returns (minimum, maximum) arrays.  Every LP starts from the
+        wild-type optimal basis with the objective row appended.
+        """
+        if self.basis is None:
+            self.solve()
+        cols = self._columns(reactions)
+        if self.basis is None:
+            return np.ones(len(cols)) * np.nan, np.ones(len(cols)) * np.nan
+
+        problem = self._variability_problem(fraction)
+        chunks = [cols[i:i+chunk_size] for i in range(0, len(cols), chunk_size)]
+        if processes == 1:
+            solver = _variability_solver(problem)
+            results = [_variability_chunk(solver, problem, chunk)
+                       for chunk in chunks]
+        else:
+            shared = share(problem)
+            pool = multiprocessing.Pool(processes, _variability_init, (shared,))
+            try:
+                results = pool.map(_variability_task, chunks)
+            finally:
+                pool.close()
+                pool.join()
+
+        minimum = np.concatenate([r[0] for r in results])
+        maximum = np.concatenate([r[1] for r in results])
+        return minimum, maximum
+
+    def _variability_problem(self, fraction):
+        """
+        Arrays describing the flux variability LPs: the CSC parts of the
+        stoichiometric matrix, bounds, objective row limits and the starting
+        basis.
+        """
+        matrix = scipy.sparse.csc_matrix(self.smatrix.matrix, dtype=float)
+        lower, upper = self.bounds()
+        slack = self.tol * max(1.0, abs(self.objective))
+        floor = self.objective - (1.0 - fraction) * abs(self.objective)
+
+        # The objective row adds the last logical, which starts basic
+        basic, at_upper = self.basis
+        rows, cols = matrix.shape
+        return {
+            'data': matrix.data,
+            'indices': matrix.indices,
+            'indptr': matrix.indptr,
+            'shape': np.array(matrix.shape),
+            'objective': np.asarray(self.smatrix.objective, dtype=float),
+            'lower': lower,
+            'upper': upper,
+            'limits': np.array([floor, self.objective + slack]),
+            'basic': np.append(basic, cols + rows),
+            'at_upper': np.append(at_upper, False),
+            'tol': np.array([self.tol]),
+        }
+
+
+# Problem arrays and solver attached to by each variability worker
+_variability = {}
+
+
+def _variability_init(shared):
+    problem = attach(shared)
+    _variability['problem'] = problem
+    _variability['solver'] = _variability_solver(problem)
+
+
+def _variability_task(cols):
+    return _variability_chunk(_variability['solver'],
+                              _variability['problem'], cols)
+
+
+def _variability_solver(problem):
+    """
+    Simplex over the stoichiometric matrix with the objective row
+    appended and held within its limits.
+    """
+    rows, cols = problem['shape']
+    matrix = scipy.sparse.csc_matrix(
+        (problem['data'], problem['indices'], problem['indptr']),
+        shape=(rows, cols))
+    matrix = scipy.sparse.vstack(
+        [matrix, scipy.sparse.csr_matrix(problem['objective'])])
+    row_lower = np.append(np.zeros(rows), problem['limits'][0])
+    row_upper = np.append(np.zeros(rows), problem['limits'][1])
+    return Simplex(matrix, row_lower, row_upper, tol=problem['tol'][0])
+
+
+def _variability_chunk(solver, problem, cols):
+    """
+    Minimum and maximum flux of each column in cols.
+    """
+    basis = (problem['basic'], problem['at_upper'])
+    cost = np.zeros(solver.cols)
+    minimum = np.zeros(len(cols))
+    maximum = np.zeros(len(cols))
+    for i, col in enumerate(cols):
+        for sense, values in [(1.0, minimum), (-1.0, maximum)]:
+            cost[col] = sense
+            status = solver.solve(cost, problem['lower'], problem['upper'],
+                                  basis=basis)
+            values[i] = solver.x[col] if status == 'optimal' else np.nan
+        cost[col] = 0.0
+    return minimum, maximum
@@ -0,0 +1,427 @@
+# John Eargle
+# 2017
+
+import array
+import json
+import logging
+import xml.etree.cElementTree as ElementTree
+
+import numpy as np
+import scipy.sparse
+
+from sysbiokit.element import Molecule, Reaction, get_registry
+from sysbiokit.element import parse_formula
+from sysbiokit.matrix import StoichioMatrix, FLUX_LIMIT
+
+
+# Formulas dropped because the registry lacks their elements
+log = logging.getLogger(__name__)
+
+
+# Metabolic models read from SBML and JSON files into StoichioMatrices
+
+
+def read_sbml(source, registry=None, boundary=False):
+    """
+    StoichioMatrix for an SBML model (levels 2 and 3, with flux bounds and
+    objective from the fbc package or from COBRA kinetic law parameters).
+    Only the active fbc objective is read, with its coefficients negated
+    when it is minimized, since a StoichioMatrix objective is maximized.
+    source: file name or file object
+    boundary: whether to keep species with boundaryCondition="true" as
+      rows of the matrix; by default they are left out, as in COBRA,
+      so exchange reactions through them are not blocked
+
+    The document is streamed with iterparse and every element is removed
+    from its parent once read, so memory holds the model's arrays rather
+    than its XML tree.  Molecules are named by species id and use the
+    species name as their abbreviation; Reactions are named by reaction
+    id.
+    """
+    builder = _ModelBuilder(registry)
+    parameters = {}
+    objective = {}
+    objectives = {}
+    active = None
+    current = None
+    reaction = None
+    local = {}
+    side = None
+    external = set()
+    parents = []
+
+    for event, elem in ElementTree.iterparse(source, events=('start', 'end')):
+        tag = _local_name(elem.tag)
+        if event == 'start':
+            parents.append(elem)
+            if tag == 'reaction':
+                reaction = builder.reaction(_text(elem.get('id')))
+                reversible = elem.get('reversible', 'true') == 'true'
+                builder.set_bounds(reaction, -FLUX_LIMIT if reversible else 0.0,
+                                   FLUX_LIMIT)
+                local = {}
+            elif tag == 'listOfReactants':
+                side = -1.0
+            elif tag == 'listOfProducts':
+                side = 1.0
+            elif tag == 'listOfModifiers':
+                side = None
+            elif tag == 'listOfObjectives':
+                active = _attributes(elem).get('activeObjective')
+            elif tag == 'objective':
+                attrs = _attributes(elem)
+                current = attrs.get('id')
+                sign = -1.0 if attrs.get('type') == 'minimize' else 1.0
+                objectives[current] = (sign, {})
+            continue
+
+        # Done with this element and its children
+        parents.pop()
+        if parents:
+            parents[-1].remove(elem)
+
+        if tag == 'species':
+            attrs = _attributes(elem)
+            if attrs.get('boundaryCondition') == 'true' and not boundary:
+                external.add(attrs['id'])
+                continue
+            row = builder.molecule(_text(attrs['id']))
+            builder.describe(row, _text(attrs.get('name')),
+                             attrs.get('chemicalFormula'),
+                             attrs.get('charge'))
+        elif (tag == 'speciesReference' and reaction is not None and side and
+              elem.get('species') not in external):
+            builder.add(builder.molecule(_text(elem.get('species'))),
+                        reaction,
+                        side * float(elem.get('stoichiometry', 1.0)))
+        elif tag in ('parameter', 'localParameter'):
+            value = float(elem.get('value', 'nan'))
+            if reaction is None:
+                parameters[elem.get('id')] = value
+            else:
+                local[elem.get('id')] = value
+        elif tag == 'reaction':
+            attrs = _attributes(elem)
+            lower = attrs.get('lowerFluxBound')
+            upper = attrs.get('upperFluxBound')
+            if lower is not None:
+                builder.set_bounds(reaction, lower=parameters[lower])
+            elif 'LOWER_BOUND' in local:
+                builder.set_bounds(reaction, lower=local['LOWER_BOUND'])
+            if upper is not None:
+                builder.set_bounds(reaction, upper=parameters[upper])
+            elif 'UPPER_BOUND' in local:
+                builder.set_bounds(reaction, upper=local['UPPER_BOUND'])
+            if 'OBJECTIVE_COEFFICIENT' in local:
+                objective[reaction] = local['OBJECTIVE_COEFFICIENT']
+            builder.name_reaction(reaction, _text(attrs.get('name')))
+            reaction = None
+        elif tag == 'fluxObjective' and current in objectives:
+            attrs = _attributes(elem)
+            col = builder.reaction(_text(attrs['reaction']))
+            objectives[current][1][col] = float(attrs.get('coefficient', 1.0))
+        elif tag == 'objective':
+            if active is None:
+                active = current
+            current = None
+
+    # The active fbc objective replaces COBRA kinetic law coefficients;
+    # a minimized one is maximized with its coefficients negated
+    if active in objectives:
+        sign, coefficients = objectives[active]
+        objective = dict((col, sign * coefficient)
+                         for col, coefficient in coefficients.items())
+    for col, coefficient in objective.items():
+        builder.set_objective(col, coefficient)
+    return builder.build()
+
+
+def read_json(source, registry=None, chunk_size=1 << 16):
+    """
+    StoichioMatrix for a model in the COBRA JSON format: an object with
+    'metabolites' (id, name, formula, charge) and 'reactions' (id, name,
+    metabolites, lower_bound, upper_bound, objective_coefficient) lists.
+    source: file name or file object
+    chunk_size: bytes read at a time
+
+    Only one metabolite or reaction record is decoded at a time.
+    Molecules and Reactions are named as in read_sbml().
+    """
+    builder = _ModelBuilder(registry)
+    handle = open(source) if isinstance(source, basestring) else source
+    try:
+        for key, record in _JSONStream(handle, chunk_size).records():
+            if key == 'metabolites':
+                row = builder.molecule(_text(record['id']))
+                builder.describe(row, _text(record.get('name')),
+                                 record.get('formula'), record.get('charge'))
+            elif key == 'reactions':
+                col = builder.reaction(_text(record['id']))
+                builder.name_reaction(col, _text(record.get('name')))
+                for molecule, coefficient in record['metabolites'].items():
+                    builder.add(builder.molecule(_text(molecule)), col,
+                                coefficient)
+                builder.set_bounds(col, record.get('lower_bound', 0.0),
+                                   record.get('upper_bound', FLUX_LIMIT))
+                coefficient = record.get('objective_coefficient', 0.0)
+                if coefficient:
+                    builder.set_objective(col, coefficient)
+    finally:
+        if handle is not source:
+            handle.close()
+    return builder.build()
+
+
+def column_reactions(matrix, molecules, names):
+    """
+    Reactions named by names whose inputs (negative entries) and outputs
+    (positive entries) are read from the columns of a stoichiometric
+    matrix, dense or sparse, with rows labeled by molecules.
+    """
+    by_column = scipy.sparse.csc_matrix(matrix)
+    reactions = []
+    for col, name in enumerate(names):
+        start, stop = by_column.indptr[col], by_column.indptr[col+1]
+        entries = zip(by_column.indices[start:stop],
+                      by_column.data[start:stop])
+        inputs = [(molecules[i], -v) for i, v in entries if v < 0]
+        outputs = [(molecules[i], v) for i, v in entries if v > 0]
+        reactions.append(Reaction(name, inputs, outputs))
+    return reactions
+
+
+class _ModelBuilder():
+    """
+    Model data gathered while streaming a file: matrix coordinates in flat
+    arrays, and per-molecule and per-reaction columns of attributes.  Rows
+    and columns are numbered in order of first mention.
+    """
+
+    def __init__(self, registry):
+        self.registry = get_registry(registry)
+        self.rows = array.array('i')
+        self.cols = array.array('i')
+        self.values = array.array('d')
+
+        self.molecule_ids = {}
+        self.molecule_names = []
+        self.formulas = []
+        self.charges = []
+
+        self.reaction_ids = {}
+        self.reaction_names = []
+        self.lower = array.array('d')
+        self.upper = array.array('d')
+        self.objective = {}
+
+    def molecule(self, molecule_id):
+        row = self.molecule_ids.get(molecule_id)
+        if row is None:
+            row = len(self.molecule_names)
+            self.molecule_ids[molecule_id] = row
+            self.molecule_names.append(None)
+            self.formulas.append('')
+            self.charges.append(None)
+        return row
+
+    def describe(self, row, name, formula, charge):
+        self.molecule_names[row] = name
+        if formula:
+            self.formulas[row] = formula
+        if charge is not None:
+            self.charges[row] = int(charge)
+
+    def reaction(self, reaction_id):
+        col = self.reaction_ids.get(reaction_id)
+        if col is None:
+            col = len(self.reaction_names)
+            self.reaction_ids[reaction_id] = col
+            self.reaction_names.append(None)
+            self.lower.append(0.0)
+            self.upper.append(FLUX_LIMIT)
+        return col
+
+    def name_reaction(self, col, name):
+        self.reaction_names[col] = name
+
+    def add(self, row, col, value):
+        self.rows.append(row)
+        self.cols.append(col)
+        self.values.append(value)
+
+    def set_bounds(self, col, lower=None, upper=None):
+        if lower is not None:
+            self.lower[col] = lower
+        if upper is not None:
+            self.upper[col] = upper
+
+    def set_objective(self, col, coefficient):
+        self.objective[col] = coefficient
+
+    def build(self):
+        """
+        StoichioMatrix in CSR form with labels, bounds and objective.
+        """
+        shape = (len(self.molecule_names), len(self.reaction_names))
+        matrix = scipy.sparse.coo_matrix(
+            (np.frombuffer(self.values, dtype=float),
+             (np.frombuffer(self.rows, dtype=np.int32),
+              np.frombuffer(self.cols, dtype=np.int32))),
+            shape=shape).tocsr()
+
+        ids = _ordered_ids(self.molecule_ids)
+        formulas = [_known_formula(f, self.registry) for f in self.formulas]
+        blanked = sum(1 for f, known in zip(self.formulas, formulas)
+                      if f and not known)
+        if blanked:
+            log.warning('%d of %d species formulas left blank: they do not '
+                        'parse or use symbols missing from the registry '
+                        '(%d elements)',
+                        blanked, len(formulas),
+                        len(self.registry.symbol2index))
+        molecules = Molecule.bulk(ids, formulas, self.charges,
+                                  self.molecule_names, self.registry)
+
+        reactions = column_reactions(matrix, molecules,
+                                     _ordered_ids(self.reaction_ids))
+        smatrix = StoichioMatrix(matrix, molecules, reactions, sparse=True)
+        smatrix.lower_bounds = np.array(self.lower)
+        smatrix.upper_bounds = np.array(self.upper)
+        for col, coefficient in self.objective.items():
+            smatrix.objective[col] = coefficient
+        return smatrix
+
+
+class _JSONStream():
+    """
+    Incremental reader for a JSON object whose large members are arrays of
+    records.  Text is read in chunks and each record is decoded on its
+    own with JSONDecoder.raw_decode.
+    """
+
+    def __init__(self, handle, chunk_size):
+        self.handle = handle
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """
+        Read another chunk, dropping text already consumed.  Returns False
+        at the end of the file.
+        """
+        if self.eof:
+            return False
+        chunk = self.handle.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """
+        Next non-whitespace character, or '' at the end of the file.
+        """
+        while True:
+            while (self.pos < len(self.buffer) and
+                   self.buffer[self.pos] in ' \t\r\n'):
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._fill():
+                return self.buffer[self.pos:self.pos+1]
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char == '' or char not in chars:
+            raise ValueError('Expected one of %r in JSON, found %r' %
+                             (chars, char))
+        self.pos += 1
+        return char
+
+    def _value(self):
+        """
+        Decode the next complete JSON value.
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # A number or literal cut off by the chunk boundary may still
+            # decode, so values touching the end are only trusted at EOF
+            if end < len(self.buffer) or not self._fill():
+                self.pos = end
+                return value
+
+    def records(self):
+        """
+        Generator of (key, record) for each element of every array member
+        of the top-level object.  Other members are read and dropped.
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if self._peek() == '[':
+                self._expect('[')
+                if self._peek() == ']':
+                    self._expect(']')
+                else:
+                    while True:
+                        yield key, self._value()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                self._value()
+            if self._expect(',}') == '}':
+                return
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _attributes(elem):
+    """
+    Element attributes keyed by local name, dropping namespaces.
+    """
+    return dict((_local_name(k), v) for k, v in elem.attrib.items())
+
+
+def _text(value):
+    """
+    Byte string for names, which the registry interns.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _ordered_ids(index):
+    ids = [None] * len(index)
+    for key, i in index.items():
+        ids[i] = key
+    return ids
+
+
+def _known_formula(formula, registry):
+    """
+    The formula if it parses into elements the registry knows, else an
+    empty formula; models use placeholders like 'R' for generic groups.
+    """
+    try:
+        composition = parse_formula(formula)[0]
+    except ValueError:
+        return ''
+    for symbol, count in composition:
+        if symbol not in registry.symbol2index:
+            return ''
+    return formula
@@ -0,0 +1,131 @@
+# John Eargle
+# 2017
+
+import json
+import time
+
+
+# Instrumentation of transcription network solves
+
+
+# Profiles recording solves, innermost last
+_profiles = []
+
+
+def current_profile():
+    """
+    The innermost active SolveProfile, or None when solves are not being
+    recorded.
+    """
+    if _profiles:
+        return _profiles[-1]
+    return None
+
+
+def switch_name(switch):
+    """
+    Label for a Switch from its parent and child names, e.g. 'X->Y' for
+    an activator, 'X-|Y' for a repressor and 'input->Y' for fixed times.
+    """
+    parent = 'input' if switch.parent is None else switch.parent.name
+    child = '?' if switch.child is None else switch.child.name
+    arrow = '->' if switch.activate else '-|'
+    return parent + arrow + child
+
+
+class SolveProfile():
+    """
+    Record of the LogicProduct, Switch and SwitchBoard solves made while
+    the profile is active:
+
+      profile = SolveProfile()
+      with profile:
+          product.solve()
+      profile.report()
+
+    Each node or switch gets the number of times it was solved, the wall
+    time spent, the breaks produced and the closures (trajectory pieces)
+    evaluated.  Node times exclude the solves of their input Switches,
+    which are recorded on their own.
+    """
+
+    FIELDS = ('kind', 'name', 'solves', 'seconds', 'breaks', 'closures')
+
+    def __init__(self):
+        self.records = {}
+        self.order = []
+        self.start = None
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        _profiles.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed += time.time() - self.start
+        _profiles.remove(self)
+        return False
+
+    def record(self, kind, name, seconds, breaks, closures):
+        """
+        Add one solve of the node or switch called name.
+        kind: 'node', 'switch' or 'board'
+        """
+        key = (kind, name)
+        if key not in self.records:
+            self.records[key] = [0, 0.0, 0, 0]
+            self.order.append(key)
+        rec = self.records[key]
+        rec[0] += 1
+        rec[1] += seconds
+        rec[2] += breaks
+        rec[3] += closures
+
+    def rows(self, sort='seconds', kind=None):
+        """
+        One dict per node or switch, with the keys in FIELDS, largest
+        first by sort (or in solve order for sort=None).
+        kind: only rows of this kind
+        """
+        rows = [dict(zip(self.FIELDS, key + tuple(self.records[key])))
+                for key in self.order if kind is None or key[0] == kind]
+        if sort is not None:
+            rows.sort(key=lambda row: row[sort], reverse=True)
+        return rows
+
+    def totals(self):
+        """
+        Sums of solves, seconds, breaks and closures over all records,
+        by kind.
+        """
+        totals = {}
+        for (kind, name), rec in self.records.items():
+            total = totals.setdefault(kind, [0, 0.0, 0, 0])
+            for i in range(4):
+                total[i] += rec[i]
+        return dict((kind, dict(zip(self.FIELDS[2:], total)))
+                    for kind, total in totals.items())
+
+    def report(self, limit=20, sort='seconds'):
+        """
+        Print the totals and the top limit rows.
+        """
+        print 'SolveProfile: %.3fs elapsed' % (self.elapsed)
+        for kind, total in sorted(self.totals().items()):
+            print '  %-6s %6d solves %9.4fs %8d breaks %8d closures' % (
+                kind, total['solves'], total['seconds'], total['breaks'],
+                total['closures'])
+        print '  %-6s %-24s %6s %9s %8s %8s' % self.FIELDS
+        for row in self.rows(sort)[:limit]:
+            print '  %-6s %-24s %6d %9.4f %8d %8d' % tuple(
+                row[field] for field in self.FIELDS)
+
+    def save(self, path):
+        """
+        Write the rows, in solve order, and totals to a JSON file.
+        """
+        with open(path, 'w') as f:
+            json.dump({'elapsed': self.elapsed,
+                       'totals': self.totals(),
+                       'rows': self.rows(None)}, f, indent=1)
@@ -1,12 +1,23 @@
 # John Eargle
 # 2015-2016
 
+import heapq
+
 import numpy as np
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
+
+from sysbiokit.element import Element, ReactionIndex, get_registry
 
 
 # Metabolic networks represented and analyzed as various matrices
 
 
+# Default magnitude of flux bounds, standing in for unbounded fluxes
+FLUX_LIMIT = 1000.0
+
+
 class StoichioMatrix():
     """
     Matrix of reactants/products (rows) and reactions (columns).
@@ -17,11 +28,48 @@ class StoichioMatrix():
     dx/dt = Sv
     where x is the concentration vector and v is the flux vector
 
-    This class wraps numpy's matrix.
+    This class wraps numpy's matrix, or a scipy.sparse CSR matrix for large
+    networks where only a small fraction of S_ij are nonzero.
+
+    The four fundamental subspaces are computed from a single rank-revealing
+    factorization which is cached until self.matrix is replaced.  Reactions
+    and molecules added or removed in place keep a cached SVD current with
+    rank-one updates rather than refactoring.
+
+    Each reaction also carries flux bounds and an objective coefficient for
+    flux balance analysis (see sysbiokit.flux).  Reactions default to
+    irreversible, 0 <= v <= FLUX_LIMIT, with no objective.
     """
 
-    def __init__(self, matrix, molecules=None, reactions=None):
-        self.matrix = matrix
+    def __init__(self, matrix, molecules=None, reactions=None, sparse=None,
+                 method=None, tol=None, refactor=256):
+        """
+        matrix: dense matrix or scipy.sparse matrix of stoichiometries
+        molecules: list of Molecules labeling the rows
+        reactions: list of Reactions labeling the columns
+        sparse: store the matrix in CSR form; defaults to True when a
+          scipy.sparse matrix is passed in
+        method: factorization used for the subspaces; 'svd' or 'qr'
+          (column pivoted QR) for dense matrices, 'lu' (sparse Gauss-Jordan
+          elimination) for sparse ones
+        tol: cutoff below which singular values (or diagonal entries of R)
+          count as zero; defaults to max(m, n) * eps * largest value
+        refactor: number of in-place edits (add_reaction() etc.) whose
+          rank-one SVD updates are applied before the SVD is recomputed
+        """
+        if sparse is None:
+            sparse = scipy.sparse.issparse(matrix)
+        self.sparse = sparse
+        if self.sparse:
+            self.matrix = scipy.sparse.csr_matrix(matrix, dtype=float)
+        else:
+            self.matrix = matrix
+        if method is None:
+            method = 'lu' if self.sparse else 'svd'
+        self.method = method
+        self.tol = tol
+        self.refactor = refactor
+
         self.molecules = molecules
         if self.molecules is not None:
             self.mol2row = {m: i for i, m in enumerate(self.molecules)}
@@ -38,78 +86,785 @@ class StoichioMatrix():
             self.reaction2col = None
             self.name2col = None
 
+        self._participation = None
+
+        cols = self.matrix.shape[1]
+        self.lower_bounds = np.zeros(cols)
+        self.upper_bounds = np.ones(cols) * FLUX_LIMIT
+        self.objective = np.zeros(cols)
+
+        self.invalidate()
+
+    def __str__(self):
+        return str(self.matrix)
+
+    def reaction_index(self, reaction):
+        """
+        Column index for a Reaction, a Reaction name or a column index.
+        """
+        if isinstance(reaction, (int, np.integer)):
+            return reaction
+        if isinstance(reaction, basestring):
+            return self.name2col[reaction]
+        return self.reaction2col[reaction]
+
+    def set_bounds(self, reaction, lower=None, upper=None):
+        """
+        Set the lower and/or upper flux bound of a Reaction.
+        """
+        col = self.reaction_index(reaction)
+        if lower is not None:
+            self.lower_bounds[col] = lower
+        if upper is not None:
+            self.upper_bounds[col] = upper
+
+    def set_objective(self, reaction, coefficient=1.0):
+        """
+        Set the coefficient of a Reaction's flux in the objective.
+        """
+        self.objective[self.reaction_index(reaction)] = coefficient
+
+    @property
+    def participation(self):
+        """
+        ReactionIndex of the labeling Reactions, built on first use and
+        kept current by add_reaction() and remove_reaction().
+        """
+        if self._participation is None:
+            if self.reactions is None:
+                raise ValueError('Reactions are required for an index')
+            self._participation = ReactionIndex(self.reactions)
+        return self._participation
+
+    def molecule_index(self, molecule):
+        """
+        Row index for a Molecule, a Molecule name or a row index.
+        """
+        if isinstance(molecule, (int, np.integer)):
+            return molecule
+        if isinstance(molecule, basestring):
+            return self.name2row[molecule]
+        return self.mol2row[molecule]
+
+    def add_reaction(self, reaction=None, coefficients=None, lower=0.0,
+                     upper=FLUX_LIMIT, objective=0.0):
+        """
+        Append a reaction column.  Returns its column index.
+        reaction: Reaction labeling the column; required if the columns
+          are labeled
+        coefficients: stoichiometry of the column, either a sequence over
+          all rows or a dict keyed by Molecule, Molecule name or row;
+          defaults to the Reaction's inputs (negative) and outputs
+        lower, upper, objective: flux bounds and objective coefficient
+        """
+        rows, cols = self.matrix.shape
+        if coefficients is None:
+            coefficients = {}
+            for mol, count in reaction.inputs:
+                coefficients[mol] = coefficients.get(mol, 0) - count
+            for mol, count in reaction.outputs:
+                coefficients[mol] = coefficients.get(mol, 0) + count
+        column = _vector(coefficients, rows, self.molecule_index)
+        self._label(reaction, 'reactions', 'reaction2col', 'name2col', cols)
+        if self._participation is not None:
+            self._participation.add(reaction)
+
+        cached = self._svd_current()
+        if cached:
+            u, s, vt, left, right = self._svd_factors()
+        if self.sparse:
+            self.matrix = scipy.sparse.hstack(
+                [self.matrix, scipy.sparse.csr_matrix(column).T]).tocsr()
+        else:
+            self.matrix = np.hstack([self.matrix, column.reshape(rows, 1)])
+        self.lower_bounds = np.append(self.lower_bounds, lower)
+        self.upper_bounds = np.append(self.upper_bounds, upper)
+        self.objective = np.append(self.objective, objective)
+
+        if cached:
+            vt = np.hstack([vt, np.zeros((len(s), 1))])
+            right = scipy.linalg.block_diag(right, 1.0)
+            self._svd_update(u, s, vt, left, right,
+                             column, _unit(cols, cols + 1))
+        return cols
+
+    def remove_reaction(self, reaction):
+        """
+        Delete the column of a Reaction, Reaction name or column index.
+        """
+        col = self.reaction_index(reaction)
+        rows, cols = self.matrix.shape
+        cached = self._svd_current()
+        if cached:
+            u, s, vt, left, right = self._svd_factors()
+            column = _dense_column(self.matrix, col)
+            unit = _unit(col, cols)
+            u, s, vt, left, right = _rank_one_update(
+                u, s, vt, left, right.T, -column, unit, self._cutoff)
+            right = _deflate(right, unit).T
+
+        keep = np.arange(cols) != col
+        self.matrix = self.matrix[:,keep]
+        self.lower_bounds = self.lower_bounds[keep]
+        self.upper_bounds = self.upper_bounds[keep]
+        self.objective = self.objective[keep]
+        if self._participation is not None:
+            self._participation.remove(self.reactions[col])
+        self._unlabel('reactions', 'reaction2col', 'name2col', col)
+
+        if cached:
+            self._svd_set(u, s, vt[:,keep], left, right[:,keep])
+
+    def add_molecule(self, molecule=None, coefficients=None):
+        """
+        Append a molecule row.  Returns its row index.
+        molecule: Molecule labeling the row; required if the rows are
+          labeled
+        coefficients: stoichiometry of the molecule in each reaction,
+          either a sequence over all columns or a dict keyed by Reaction,
+          Reaction name or column; defaults to no participation
+        """
+        rows, cols = self.matrix.shape
+        if coefficients is None:
+            coefficients = {}
+        row = _vector(coefficients, cols, self.reaction_index)
+        self._label(molecule, 'molecules', 'mol2row', 'name2row', rows)
+
+        cached = self._svd_current()
+        if cached:
+            u, s, vt, left, right = self._svd_factors()
+        if self.sparse:
+            self.matrix = scipy.sparse.vstack(
+                [self.matrix, scipy.sparse.csr_matrix(row)]).tocsr()
+        else:
+            self.matrix = np.vstack([self.matrix, row.reshape(1, cols)])
+
+        if cached:
+            u = np.vstack([u, np.zeros((1, len(s)))])
+            left = scipy.linalg.block_diag(left, 1.0)
+            self._svd_update(u, s, vt, left, right, _unit(rows, rows + 1), row)
+        return rows
+
+    def remove_molecule(self, molecule):
+        """
+        Delete the row of a Molecule, Molecule name or row index.
+        """
+        row = self.molecule_index(molecule)
+        rows, cols = self.matrix.shape
+        cached = self._svd_current()
+        if cached:
+            u, s, vt, left, right = self._svd_factors()
+            unit = _unit(row, rows)
+            u, s, vt, left, right = _rank_one_update(
+                u, s, vt, left, right.T, unit,
+                -_dense_column(self.matrix.T, row), self._cutoff)
+            left = _deflate(left, unit)
+            right = right.T
+
+        keep = np.arange(rows) != row
+        self.matrix = self.matrix[keep,:]
+        self._unlabel('molecules', 'mol2row', 'name2row', row)
+
+        if cached:
+            self._svd_set(u[keep,:], s, vt, left[keep,:], right)
+
+    def _label(self, item, labels, index, names, position):
+        """
+        Register a new row or column label in the given list and maps.
+        """
+        if getattr(self, labels) is None:
+            return
+        if item is None:
+            raise ValueError('A label is required for %s' % (labels))
+        getattr(self, labels).append(item)
+        getattr(self, index)[item] = position
+        getattr(self, names)[item.name] = position
+
+    def _unlabel(self, labels, index, names, position):
+        """
+        Remove a row or column label and shift the labels after it.
+        """
+        items = getattr(self, labels)
+        if items is None:
+            return
+        item = items.pop(position)
+        del getattr(self, index)[item]
+        del getattr(self, names)[item.name]
+        for i in range(position, len(items)):
+            getattr(self, index)[items[i]] = i
+            getattr(self, names)[items[i].name] = i
+
+    def _svd_current(self):
+        """
+        True if a cached SVD is up to date and so can be updated in place
+        by the editing methods.  Other factorizations are recomputed on
+        the next lookup after an edit.
+        """
+        return (not self.sparse and self.method == 'svd' and
+                self._factored is self.matrix and
+                self._factor_key == (self.method, self.tol) and
+                self._updates < self.refactor)
+
+    def _svd_factors(self):
+        """
+        Cached SVD as arrays truncated to the rank, along with both null
+        spaces: (U, s, V, left null, right null).
+        """
+        rank = self._factors['rank']
+        s = np.diag(self.S)[0:rank]
+        left = np.asarray(self._subspace('left_null'))
+        right = np.asarray(self._subspace('right_null'))
+        return (np.asarray(self.U)[:,0:rank], s,
+                np.asarray(self.V)[0:rank,:], left, right)
+
+    def _svd_update(self, u, s, vt, left, right, a, b):
+        """
+        Update the cached SVD from the old matrix to self.matrix, which
+        differs from it by a b^T.
+        """
+        u, s, vt, left, right = _rank_one_update(u, s, vt, left, right.T,
+                                                 a, b, self._cutoff)
+        self._svd_set(u, s, vt, left, right.T)
+
+    def _svd_set(self, u, s, vt, left, right):
+        """
+        Cache a truncated SVD and its null spaces for self.matrix.  After an
+        edit U, S and V only keep the rank columns/rows.
+        """
+        self._updates += 1
+        self.U = u
+        self.S = np.diag(s)
+        self.V = vt
+        self._factors = {
+            'rank': len(s),
+            'column': u,
+            'row': vt,
+            'left_null': left,
+            'right_null': right,
+        }
+        self._factored = self.matrix
+        self._factor_key = (self.method, self.tol)
+
+    def invalidate(self):
+        """
+        Drop the cached factorization.  Replacing self.matrix is detected
+        automatically, but editing its entries in place is not.
+        """
         self.U = None
         self.S = None
         self.V = None
+        self._factors = {}
+        self._factored = None
+        self._factor_key = None
+        self._updates = 0
 
-    def __str__(self):
-        return str(self.matrix)
+    def factorize(self):
+        """
+        Compute the factorization selected by self.method and cache the
+        rank along with whichever subspaces it yields directly.  Only
+        economy-size factors are kept.
+        """
+        self.invalidate()
+        if self.sparse:
+            if self.method != 'lu':
+                raise ValueError('Sparse matrices are factorized with lu, '
+                                 'not %s' % self.method)
+            self.sparse_lu()
+        elif self.method == 'svd':
+            self.svd()
+        elif self.method == 'qr':
+            self.pivoted_qr()
+        elif self.method == 'lu':
+            raise ValueError('Factorization method lu needs a sparse matrix')
+        else:
+            raise ValueError('Unknown factorization method: %s' % self.method)
+        self._factored = self.matrix
+        self._factor_key = (self.method, self.tol)
+
+    def _subspace(self, name):
+        """
+        Cached subspace lookup, refactoring if the matrix, method or
+        tolerance changed since the last factorization.
+        """
+        if (self._factored is not self.matrix or
+            self._factor_key != (self.method, self.tol)):
+            self.factorize()
+        if name not in self._factors:
+            if name == 'left_null':
+                basis = _kernel(np.asarray(self.column_space).T)
+            elif name == 'right_null':
+                basis = _kernel(np.asarray(self.row_space)).T
+            self._factors[name] = basis
+        return self._factors[name]
+
+    def _cutoff(self, values, scale=None):
+        """
+        Rank tolerance for a decreasing sequence of nonnegative values.
+        Updated factorizations pass the scale of the update and, having
+        accumulated rounding error, get a looser sqrt(eps) relative cutoff.
+        """
+        if self.tol is not None:
+            return self.tol
+        if scale is not None:
+            return scale * np.sqrt(np.finfo(float).eps)
+        if len(values) == 0:
+            return 0.0
+        return values[0] * max(self.matrix.shape) * np.finfo(float).eps
 
     def svd(self):
-        self.U, s, self.V = np.linalg.svd(self.matrix)
-        self.S = np.zeros(self.matrix.shape)
-        for i in range(len(s)):
-            self.S[i,i] = s[i]
+        """
+        Economy singular value decomposition, matrix = U S V.
+        """
+        rows, cols = self.matrix.shape
+        self.U, s, self.V = np.linalg.svd(self.matrix, full_matrices=False)
+        self.S = np.diag(s)
+        rank = int(np.sum(s > self._cutoff(s)))
+
+        self._factors['rank'] = rank
+        self._factors['column'] = self.U[:,0:rank]
+        self._factors['row'] = self.V[0:rank,:]
+        if rows <= cols:
+            self._factors['left_null'] = self.U[:,rank:]
+        if cols <= rows:
+            self._factors['right_null'] = self.V[rank:,:]
+
+    def pivoted_qr(self):
+        """
+        Economy QR decomposition with column pivoting, matrix[:,P] = QR.
+        The right null space comes out of R in kernel form and is then
+        orthonormalized.
+        """
+        rows, cols = self.matrix.shape
+        a = np.asarray(self.matrix, dtype=float)
+        q, r, p = scipy.linalg.qr(a, mode='economic', pivoting=True)
+        diag = np.abs(np.diag(r))
+        rank = int(np.sum(diag > self._cutoff(diag)))
+
+        self._factors['rank'] = rank
+        self._factors['column'] = q[:,0:rank]
+        if rows <= cols:
+            self._factors['left_null'] = q[:,rank:]
+        unpivot = np.argsort(p)
+        self._factors['row'] = _orthonormal(r[0:rank,unpivot].T).T
+        self._factors['right_null'] = _orthonormal(
+            kernel_columns(rank, p, r[0:rank,:])).T
+
+    def sparse_lu(self):
+        """
+        Sparse Gauss-Jordan elimination of the matrix and its transpose,
+        reducing each to row echelon form with sparse pivot choices.
+        Memory scales with the number of nonzeros plus the size of the
+        resulting bases.  The column space and row space bases are
+        skeleton columns and rows of the matrix itself, and each null
+        space vector comes from one free column of the reduced matrix.
+        """
+        eps = self.tol
+        if eps is None:
+            scale = abs(self.matrix).max() if self.matrix.nnz else 0.0
+            eps = 1e-10 * max(scale, 1.0)
+        pivot_rows, pivot_cols, reduced = _sparse_echelon(self.matrix, eps)
+        left_cols, left_reduced = _sparse_echelon(self.matrix.T, eps)[1:]
+
+        self._factors['rank'] = len(pivot_cols)
+        self._factors['column'] = self.matrix.tocsc()[:,sorted(pivot_cols)]
+        self._factors['row'] = self.matrix[sorted(pivot_rows),:]
+        self._factors['left_null'] = _echelon_kernel(
+            self.matrix.shape[0], left_cols, left_reduced).T.tocsc()
+        self._factors['right_null'] = _echelon_kernel(
+            self.matrix.shape[1], pivot_cols, reduced)
+
+    @property
+    def rank(self):
+        return self._subspace('rank')
 
     @property
     def column_space(self):
-        if self.U is None:
-            self.svd()
-        dim = np.count_nonzero(self.S)
-        return self.U[:,0:dim]
+        return self._subspace('column')
 
     @property
     def row_space(self):
-        if self.V is None:
-            self.svd()
-        dim = np.count_nonzero(self.S)
-        return self.V[0:dim,:]
+        return self._subspace('row')
 
     @property
     def left_null_space(self):
-        if self.U is None:
-            self.svd()
-        dim = np.count_nonzero(self.S)
-        return self.U[:,dim:]
+        return self._subspace('left_null')
 
     @property
     def right_null_space(self):
-        if self.V is None:
-            self.svd()
-        dim = np.count_nonzero(self.S)
-        return self.V[dim:,:]
-        return self.V
+        return self._subspace('right_null')
+
+
+def _orthonormal(a):
+    """
+    Orthonormal basis for the columns of a full column rank matrix.
+    """
+    if a.shape[1] == 0:
+        return np.zeros(a.shape)
+    return np.linalg.qr(a)[0]
+
+
+def _vector(coefficients, size, index):
+    """
+    Dense vector from a sequence of values or a dict of values keyed by
+    anything the index function maps to a position.
+    """
+    if isinstance(coefficients, dict):
+        vector = np.zeros(size)
+        for key, value in coefficients.items():
+            vector[index(key)] += value
+        return vector
+    vector = np.asarray(coefficients, dtype=float).ravel()
+    if len(vector) != size:
+        raise ValueError('Expected %d coefficients, got %d' %
+                         (size, len(vector)))
+    return vector
+
+
+def _unit(i, size):
+    vector = np.zeros(size)
+    vector[i] = 1.0
+    return vector
+
+
+def _dense_column(matrix, j):
+    if scipy.sparse.issparse(matrix):
+        return matrix[:,j].toarray().ravel()
+    return np.asarray(matrix[:,j], dtype=float).ravel()
+
+
+def _rank_one_update(u, s, vt, left, right, a, b, cutoff):
+    """
+    Update a thin SVD, A = U diag(s) V, to A + a b^T (Brand, 2006).  The
+    orthonormal null space bases, left and right, hold one vector per
+    column and are updated alongside: the new directions a and b bring
+    in are taken out of them and directions whose singular values vanish
+    are added.  Costs O((m + n) r^2) instead of a full SVD.
+
+    Returns (U, s, V, left, right) for the updated matrix.
+    """
+    scale = max(s[0] if len(s) else 0.0,
+                np.linalg.norm(a) * np.linalg.norm(b))
+    rank = len(s)
+    ma = np.dot(u.T, a)
+    pa = a - np.dot(u, ma)
+    ra = np.linalg.norm(pa)
+    nb = np.dot(vt, b)
+    qb = b - np.dot(vt.T, nb)
+    rb = np.linalg.norm(qb)
+
+    # Components of a and b outside the current column and row spaces
+    small = np.sqrt(np.finfo(float).eps)
+    ubig, vbig = u, vt.T
+    if ra > small * max(1.0, np.linalg.norm(a)):
+        pa /= ra
+        ubig = np.column_stack([u, pa])
+        ma = np.append(ma, ra)
+        left = _deflate(left, pa)
+    if rb > small * max(1.0, np.linalg.norm(b)):
+        qb /= rb
+        vbig = np.column_stack([vbig, qb])
+        nb = np.append(nb, rb)
+        right = _deflate(right, qb)
+
+    k = np.outer(ma, nb)
+    k[np.arange(rank), np.arange(rank)] += s
+    c, sk, dk = np.linalg.svd(k)
+    rank = int(np.sum(sk > cutoff(sk, scale)))
+    left = np.column_stack([left, np.dot(ubig, c[:,rank:])])
+    right = np.column_stack([right, np.dot(vbig, dk[rank:,:].T)])
+    return (np.dot(ubig, c[:,0:rank]), sk[0:rank],
+            np.dot(dk[0:rank,:], vbig.T), left, right)
+
+
+def _deflate(basis, w):
+    """
+    Orthonormal basis for the complement of a unit vector w within the
+    span of basis (one vector per column), which must contain w.  A
+    Householder reflection maps w onto the first basis vector, which is
+    then dropped.
+    """
+    y = np.dot(basis.T, w)
+    if len(y) == 0:
+        return basis
+    h = y.copy()
+    h[0] += np.copysign(np.linalg.norm(y), y[0])
+    hh = np.dot(h, h)
+    if hh == 0.0:
+        return basis[:,1:]
+    return basis[:,1:] - np.outer(np.dot(basis, h), h[1:]) * (2.0 / hh)
+
+
+def kernel_columns(rank, perm, r):
+    """
+    Null space basis, one vector per column, from the leading rank rows
+    of a column pivoted triangular factor, a[:,perm] = QR.  The result is
+    [-R11^-1 R12; I] with the pivoting undone.
+    """
+    size = len(perm)
+    kern = np.zeros((size, size - rank))
+    kern[perm[rank:], np.arange(size - rank)] = 1.0
+    if rank > 0:
+        kern[perm[:rank], :] = -scipy.linalg.solve_triangular(
+            r[:,0:rank], r[:,rank:])
+    return kern
+
+
+def _kernel(a):
+    """
+    Orthonormal null space basis, one vector per column, of a dense matrix
+    with full row rank.
+    """
+    rank, size = a.shape
+    if rank == 0:
+        return np.eye(size)
+    _, r, p = scipy.linalg.qr(a, mode='economic', pivoting=True)
+    return _orthonormal(kernel_columns(rank, p, r))
+
+
+def _sparse_echelon(matrix, eps):
+    """
+    Reduced row echelon form of a sparse matrix by Gauss-Jordan
+    elimination over rows held as dicts.  Each step pivots on the
+    sparsest remaining row, at the entry within a factor of 10 of the
+    row's largest whose column touches the fewest rows, which keeps
+    fill-in low.  Entries at or below eps are dropped as zero.
+
+    Returns (pivot_rows, pivot_cols, reduced): the original row and the
+    column of each pivot in elimination order, and a CSR matrix with one
+    row per pivot, scaled so the pivot is 1 and zero in the other pivot
+    columns.
+    """
+    csr = scipy.sparse.csr_matrix(matrix)
+    size, cols = csr.shape
+    rows = []
+    col_rows = [set() for j in range(cols)]
+    for i in range(size):
+        start, stop = csr.indptr[i], csr.indptr[i+1]
+        row = dict((j, v) for j, v in zip(csr.indices[start:stop].tolist(),
+                                          csr.data[start:stop].tolist())
+                   if abs(v) > eps)
+        rows.append(row)
+        for j in row:
+            col_rows[j].add(i)
+
+    # Remaining rows by size; stale entries are skipped when popped
+    heap = [(len(row), i) for i, row in enumerate(rows) if row]
+    heapq.heapify(heap)
+    remaining = set(i for count, i in heap)
+    pivot_rows = []
+    pivot_cols = []
+    while heap:
+        count, p = heapq.heappop(heap)
+        if p not in remaining or count != len(rows[p]):
+            continue
+        pivot = rows[p]
+        largest = max(abs(v) for v in pivot.itervalues())
+        c = min((j for j, v in pivot.iteritems() if abs(v) >= 0.1 * largest),
+                key=lambda j: len(col_rows[j]))
+        scale = pivot[c]
+        for j in pivot:
+            pivot[j] /= scale
+        pivot[c] = 1.0
+
+        for r in list(col_rows[c]):
+            if r == p:
+                continue
+            row = rows[r]
+            factor = row[c]
+            for j, v in pivot.iteritems():
+                value = row.get(j, 0.0) - factor * v
+                if abs(value) > eps and j != c:
+                    if j not in row:
+                        col_rows[j].add(r)
+                    row[j] = value
+                elif j in row:
+                    del row[j]
+                    col_rows[j].discard(r)
+            if r in remaining:
+                if row:
+                    heapq.heappush(heap, (len(row), r))
+                else:
+                    remaining.discard(r)
+        remaining.discard(p)
+        pivot_rows.append(p)
+        pivot_cols.append(c)
+
+    data = []
+    indices = []
+    indptr = [0]
+    for p in pivot_rows:
+        indices.extend(rows[p].keys())
+        data.extend(rows[p].values())
+        indptr.append(len(indices))
+    reduced = scipy.sparse.csr_matrix(
+        (np.array(data, dtype=float), np.array(indices, dtype=int),
+         np.array(indptr)), shape=(len(pivot_rows), cols))
+    return pivot_rows, pivot_cols, reduced
+
+
+def _echelon_kernel(size, pivot_cols, reduced):
+    """
+    Sparse null space basis, one vector per row, from a reduced row
+    echelon form.  Each free column j contributes the vector e_j minus
+    column j of the reduced matrix placed at the pivot columns.
+    """
+    free = np.ones(size, dtype=bool)
+    free[pivot_cols] = False
+    position = np.cumsum(free) - 1
+    coo = reduced.tocoo()
+    keep = free[coo.col]
+    null_dim = int(free.sum())
+    rows = np.concatenate([np.arange(null_dim), position[coo.col[keep]]])
+    cols = np.concatenate([np.flatnonzero(free),
+                           np.array(pivot_cols, dtype=int)[coo.row[keep]]])
+    data = np.concatenate([np.ones(null_dim), -coo.data[keep]])
+    return scipy.sparse.csr_matrix((data, (rows, cols)),
+                                   shape=(null_dim, size))
 
 
 class StoichioBinMatrix():
     """
     Binary matrix of reactants/products (rows) and reactions (columns).
     Elements S_ij are 0 or 1 representing presence or absence of chemicals
-    involved in a reaction.  This class wraps numpy's matrix.
+    involved in a reaction.
+
+    The incidence is stored bit-packed, one bit per molecule/reaction pair,
+    both by molecule (self.rows) and by reaction (self.cols).  Each packed
+    row is padded to a whole number of 64-bit words so that shared counts
+    reduce to popcounts of word-wise ANDs.  A scipy.sparse CSR copy
+    (self.incidence) is kept for sparse products, and self.matrix unpacks
+    to a numpy matrix on demand.
     """
 
     def __init__(self, matrix):
-        self.matrix = matrix.copy()
-        rows, cols = self.matrix.shape
-        for row in range(rows):
-            for col in range(cols):
-                self.matrix[row,col] = 0 if self.matrix[row,col] == 0 else 1
+        """
+        matrix: dense matrix or scipy.sparse matrix of stoichiometries
+        """
+        self.shape = matrix.shape
+        if scipy.sparse.issparse(matrix):
+            coo = scipy.sparse.coo_matrix(matrix)
+            coo.sum_duplicates()
+            nonzero = coo.data != 0
+            rows, cols = coo.row[nonzero], coo.col[nonzero]
+        else:
+            rows, cols = np.nonzero(np.asarray(matrix))
+        self.rows = _pack_bits(rows, cols, self.shape)
+        self.cols = _pack_bits(cols, rows, self.shape[::-1])
+        self.incidence = scipy.sparse.csr_matrix(
+            (np.ones(len(rows), dtype=int), (rows, cols)), shape=self.shape)
+
+    @property
+    def matrix(self):
+        return np.matrix(_unpack_bits(self.rows, self.shape[1]))
 
     def __str__(self):
         return str(self.matrix)
 
 
+# Number of set bits in each possible byte
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(words):
+    """
+    Number of set bits in each row of an array of packed words, counted
+    over its last axis.
+    """
+    return _POPCOUNT[words.view(np.uint8)].sum(axis=-1)
+
+
+def _pack_bits(major, minor, shape):
+    """
+    Pack (major, minor) index pairs into rows of bits, one row per major
+    index, with bit order matching np.packbits.
+    """
+    width = 8 * ((shape[1] + 63) // 64)
+    packed = np.zeros((shape[0], width), dtype=np.uint8)
+    bits = np.left_shift(1, 7 - minor % 8).astype(np.uint8)
+    np.bitwise_or.at(packed, (major, minor // 8), bits)
+    return packed
+
+
+def _unpack_bits(packed, size):
+    """
+    Dense 0/1 integer array from rows packed by _pack_bits.
+    """
+    return np.unpackbits(packed, axis=1)[:,0:size].astype(int)
+
+
+def _popcount_products(a, b, block_words=1 << 22):
+    """
+    Integer matrix of shared set bits between every packed row of a and
+    every packed row of b, i.e. the product A B^T of the unpacked 0/1
+    matrices.  Rows of a are processed in blocks to bound the size of
+    the intermediate AND.
+    """
+    a64 = a.view(np.uint64)
+    b64 = b.view(np.uint64)
+    counts = np.zeros((a.shape[0], b.shape[0]), dtype=int)
+    block = max(1, block_words // max(1, b64.size))
+    for start in range(0, a.shape[0], block):
+        both = a64[start:start+block,np.newaxis,:] & b64[np.newaxis,:,:]
+        counts[start:start+block] = popcount(both)
+    return counts
+
+
+def _popcount_pairs(packed, index1, index2, block_words=1 << 22):
+    """
+    Shared set bits between packed rows index1[k] and index2[k] for
+    every k, in blocks of pairs.
+    """
+    packed64 = packed.view(np.uint64)
+    index1 = np.asarray(index1)
+    index2 = np.asarray(index2)
+    counts = np.zeros(len(index1), dtype=int)
+    block = max(1, block_words // max(1, packed64.shape[1]))
+    for start in range(0, len(index1), block):
+        both = (packed64[index1[start:start+block]] &
+                packed64[index2[start:start+block]])
+        counts[start:start+block] = popcount(both)
+    return counts
+
+
 class ReactionMatrix():
     """
     Binary reaction adjacency matrix based on a StoichioBinMatrix.
+    In lazy mode the product is never formed; counts are read straight
+    from the packed incidence of the StoichioBinMatrix.
     """
 
-    def __init__(self, matrix):
-        self.matrix = np.dot(matrix.transpose(), matrix)
+    def __init__(self, matrix, lazy=False):
+        """
+        matrix: StoichioBinMatrix, or its unpacked binary matrix
+        lazy: skip building the full reaction x reaction product
+        """
+        self.lazy = lazy
+        if self.lazy:
+            if not isinstance(matrix, StoichioBinMatrix):
+                matrix = StoichioBinMatrix(matrix)
+            self.bin_matrix = matrix
+            self.matrix = None
+        elif isinstance(matrix, StoichioBinMatrix):
+            self.matrix = np.matrix(_popcount_products(matrix.cols,
+                                                       matrix.cols))
+        else:
+            self.matrix = np.dot(matrix.transpose(), matrix)
 
     def __str__(self):
+        if self.matrix is None:
+            return str(self.materialize())
         return str(self.matrix)
 
+    def materialize(self):
+        """
+        Build the full product as a scipy.sparse CSR matrix.  Later
+        lookups read from it.
+        """
+        if self.matrix is None:
+            incidence = self.bin_matrix.incidence
+            self.matrix = (incidence.T * incidence).tocsr()
+        return self.matrix
+
     def molecule_count(self, row1, row2=None):
         """
         The number of Molecule types participating in a single
@@ -118,24 +873,66 @@ class ReactionMatrix():
         """
         count = 0
         if row2 is None:
-            count = self.matrix[row1, row1]
+            row2 = row1
+        if self.matrix is None:
+            count = _popcount_pairs(self.bin_matrix.cols, [row1], [row2])[0]
         else:
             count = self.matrix[row1, row2]
         return count
-    
+
+    def molecule_counts(self, rows1, rows2=None):
+        """
+        Array of molecule_count() over paired arrays of Reaction indices.
+        """
+        rows1 = np.asarray(rows1)
+        if rows2 is None:
+            rows2 = rows1
+        rows2 = np.asarray(rows2)
+        if self.matrix is None:
+            return _popcount_pairs(self.bin_matrix.cols, rows1, rows2)
+        return _pair_lookup(self.matrix, rows1, rows2)
+
 
 class MoleculeMatrix():
     """
     Binary molecule adjacency matrix based on a StoichioBinMatrix.
     Palsson refers to this as a "compound matrix".
+    In lazy mode the product is never formed; counts are read straight
+    from the packed incidence of the StoichioBinMatrix.
     """
 
-    def __init__(self, matrix):
-        self.matrix = np.dot(matrix, matrix.transpose())
+    def __init__(self, matrix, lazy=False):
+        """
+        matrix: StoichioBinMatrix, or its unpacked binary matrix
+        lazy: skip building the full molecule x molecule product
+        """
+        self.lazy = lazy
+        if self.lazy:
+            if not isinstance(matrix, StoichioBinMatrix):
+                matrix = StoichioBinMatrix(matrix)
+            self.bin_matrix = matrix
+            self.matrix = None
+        elif isinstance(matrix, StoichioBinMatrix):
+            self.matrix = np.matrix(_popcount_products(matrix.rows,
+                                                       matrix.rows))
+        else:
+            self.matrix = np.dot(matrix, matrix.transpose())
 
     def __str__(self):
+        if self.matrix is None:
+            return str(self.materialize())
         return str(self.matrix)
 
+    def materialize(self):
+        """
+        Build the full product as a scipy.sparse CSR matrix.  Later
+        lookups read from it.
+        """
+        if self.matrix is None:
+            incidence = self.bin_matrix.incidence
+            self.matrix = (incidence * incidence.T).tocsr()
+        return self.matrix
+
     def reaction_count(self, row1, row2=None):
         """
         The number of Reactions in which a Molecule type participates,
@@ -143,17 +940,44 @@ class MoleculeMatrix():
         """
         count = 0
         if row2 is None:
-            count = self.matrix[row1, row1]
+            row2 = row1
+        if self.matrix is None:
+            count = _popcount_pairs(self.bin_matrix.rows, [row1], [row2])[0]
         else:
             count = self.matrix[row1, row2]
         return count
 
+    def reaction_counts(self, rows1, rows2=None):
+        """
+        Array of reaction_count() over paired arrays of Molecule indices.
+        """
+        rows1 = np.asarray(rows1)
+        if rows2 is None:
+            rows2 = rows1
+        rows2 = np.asarray(rows2)
+        if self.matrix is None:
+            return _popcount_pairs(self.bin_matrix.rows, rows1, rows2)
+        return _pair_lookup(self.matrix, rows1, rows2)
+
+
+def _pair_lookup(matrix, rows1, rows2):
+    """
+    Entries matrix[rows1[k], rows2[k]] of a dense or sparse matrix.
+    """
+    if scipy.sparse.issparse(matrix):
+        return np.asarray(matrix[rows1, rows2]).ravel()
+    return np.asarray(matrix)[rows1, rows2]
+
 
 class ElementalMatrix():
     """
     Matrix of elements (rows) and the molecules containing them (columns).
     E_ij are positive counts for elements i within molecules j.  This class
-    wraps numpy's matrix.
+    wraps numpy's matrix, or a scipy.sparse CSR matrix when the
+    StoichioMatrix is sparse.
+
+    Along with the charge of each molecule, E checks that reactions balance:
+    every column of E*S and charges*S should be zero.
     """
 
     def __init__(self, smatrix, elements=None):
@@ -164,30 +988,108 @@ class ElementalMatrix():
         if len(smatrix.molecules) == 0:
             print 'Error: empty Molecule list'
 
+        self.smatrix = smatrix
         self.elements = elements
         self.molecules = smatrix.molecules
+        members = list(self.molecules) + list(self.elements or [])
+        if members:
+            self.registry = members[0].registry
+        else:
+            self.registry = get_registry()
+        # Composition lookups index the registry by Molecule and Element
+        if any(m.registry is not self.registry for m in members):
+            raise ValueError('Molecules and Elements come from different '
+                             'registries')
         if self.elements is None:
             self.build_elements()
         self.el2row = {e: i for i, e in enumerate(self.elements)}
         self.name2row = {e.name: i for i, e in enumerate(self.elements)}
 
-        matList = []  # list of lists to construct matrix
-        for molecule in self.molecules:
-            elementList = [0] * len(self.elements)  # list of element counts
-            for element, count in molecule.composition:
-                elementList[self.el2row[element]] += count
-            matList.append(elementList)
-
-        self.matrix = np.matrix(matList).transpose()
+        # Slice composition rows straight out of the molecules' registry
+        registry = self.registry
+        indices = np.array([m.index for m in self.molecules], dtype=int)
+        element_rows = -np.ones(len(registry.symbols), dtype=int)
+        element_rows[[e.index for e in self.elements]] = np.arange(
+            len(self.elements))
+        cols, used, counts = registry.compositions(indices)
+        rows = element_rows[used]
+        if np.any(rows < 0):
+            raise ValueError('Molecule contains an element not in the list')
+        shape = (len(self.elements), len(self.molecules))
+        matrix = scipy.sparse.coo_matrix((counts, (rows, cols)), shape=shape)
+        if smatrix.sparse:
+            self.matrix = matrix.tocsr()
+        else:
+            self.matrix = np.matrix(matrix.toarray())
+        self.charges = registry.charge_vector(indices).astype(float)
 
     def build_elements(self):
-        self.elements = []
-        used_elements = {}
-        for molecule in self.molecules:
-            for element in molecule.elements:
-                if element not in used_elements:
-                    used_elements[element] = True
-                    self.elements.append(element)
+        """
+        Elements of the molecules in order of first appearance.
+        """
+        registry = self.registry
+        indices = np.array([m.index for m in self.molecules], dtype=int)
+        used = registry.compositions(indices)[1]
+        first = np.unique(used, return_index=True)[1]
+        self.elements = [Element.view(registry, e)
+                         for e in used[np.sort(first)]]
 
     def __str__(self):
         return str(self.matrix)
+
+    def imbalances(self, smatrix=None, tol=1e-9):
+        """
+        Unbalanced reactions of a StoichioMatrix over the same molecules
+        (default: the one this ElementalMatrix was built from).  Elements
+        and charge are checked for every reaction with one matrix product.
+
+        Returns (columns, deficits, charges): the unbalanced columns, the
+        net count of each element made by each of them (products minus
+        reactants, one row per column) and their net charge.
+        """
+        if smatrix is None:
+            smatrix = self.smatrix
+        if scipy.sparse.issparse(self.matrix):
+            balance = scipy.sparse.vstack(
+                [self.matrix, scipy.sparse.csr_matrix(self.charges)]).tocsr()
+        else:
+            balance = np.vstack([np.asarray(self.matrix, dtype=float),
+                                 self.charges])
+
+        if scipy.sparse.issparse(balance):
+            net = balance * smatrix.matrix
+        elif scipy.sparse.issparse(smatrix.matrix):
+            net = (smatrix.matrix.T * balance.T).T
+        else:
+            net = np.dot(balance, np.asarray(smatrix.matrix, dtype=float))
+        if scipy.sparse.issparse(net):
+            net = net.tocsc()
+            net.data[np.abs(net.data) <= tol] = 0.0
+            net.eliminate_zeros()
+            columns = np.nonzero(np.diff(net.indptr))[0]
+            net = net[:,columns].toarray()
+        else:
+            net = np.asarray(net)
+            columns = np.nonzero(np.any(np.abs(net) > tol, axis=0))[0]
+            net = net[:,columns]
+        return columns, net[0:-1,:].T, net[-1,:]
+
+    def report(self, smatrix=None, tol=1e-9):
+        """
+        Print the unbalanced reactions of a StoichioMatrix with the element
+        and charge deficits of each.
+        """
+        if smatrix is None:
+            smatrix = self.smatrix
+        columns, deficits, charges = self.imbalances(smatrix, tol)
+        print '%d of %d reactions unbalanced' % (len(columns),
+                                                 smatrix.matrix.shape[1])
+        for col, deficit, charge in zip(columns, deficits, charges):
+            label = col
+            if smatrix.reactions is not None:
+                label = smatrix.reactions[col]
+            terms = ['%s %+g' % (self.elements[i].symbol, deficit[i])
+                     for i in np.nonzero(np.abs(deficit) > tol)[0]]
+            if abs(charge) > tol:
+                terms.append('charge %+g' % (charge))
+            print '  %s: %s' % (label, ', '.join(terms))
@@ -0,0 +1,569 @@
+# John Eargle
+# 2017
+
+from collections import deque
+import heapq
+import math
+
+import numpy as np
+import scipy.sparse
+
+
+# Transcription networks of LogicProducts compiled into flat arrays
+
+
+class Network():
+    """
+    LogicProduct nodes and Switch edges compiled into arrays for
+    simulating every node at once.
+
+    Each node i follows
+
+      dx_i/dt = const_rate_i * on_i(t) + self_rate_i * x_i
+
+    where on_i combines the states of its input Switches with 'and' or
+    'or'; a node without inputs is always on.  A Switch from a parent is
+    on while the parent's concentration is at or above its threshold (an
+    activator) or below it (a repressor).  A Switch without a parent
+    flips at its fixed times, on for activators from the first time.
+
+    Feedback loops are fine since all nodes advance together: between
+    switch changes every node relaxes exponentially toward its steady
+    state, which simulate() applies exactly over each time step.
+    solve() instead jumps from one Switch flip to the next, giving the
+    exact piecewise trajectories.
+    """
+
+    def __init__(self, products, logic='and'):
+        """
+        products: LogicProducts in the network; products connected to
+          them through Switches are included as well
+        logic: 'and' or 'or' combining each node's input Switches, or a
+          dict from product name to 'and'/'or' (default 'and')
+        """
+        self.products = _connected(products)
+        self.index = dict((p, i) for i, p in enumerate(self.products))
+        self.name2index = dict((p.name, i)
+                               for i, p in enumerate(self.products))
+        size = len(self.products)
+
+        self.const_rates = np.array([p.const_rate for p in self.products],
+                                    dtype=float)
+        self.self_rates = np.array([p.self_rate for p in self.products],
+                                   dtype=float)
+        self.initial_vals = np.array([p.initial_val for p in self.products],
+                                     dtype=float)
+        if isinstance(logic, dict):
+            names = [logic.get(p.name, 'and') for p in self.products]
+        else:
+            names = [logic] * size
+        for name in names:
+            if name not in ('and', 'or'):
+                raise ValueError('Unknown switch logic: %s' % (name))
+        self.logic_or = np.array([name == 'or' for name in names],
+                                 dtype=bool)
+
+        # Edges from parent nodes, sorted by child, and fixed-time inputs
+        edges = []
+        self.inputs = []
+        self.switch_index = {}
+        for child in self.products:
+            for switch in child.switches:
+                if switch.parent is None:
+                    self.inputs.append((self.index[child],
+                                        np.sort(np.asarray(switch.times,
+                                                           dtype=float)),
+                                        switch.activate))
+                else:
+                    self.switch_index[switch] = len(edges)
+                    edges.append((self.index[child],
+                                  self.index[switch.parent],
+                                  switch.threshold, switch.activate))
+        self.edge_child = np.array([e[0] for e in edges], dtype=int)
+        self.edge_parent = np.array([e[1] for e in edges], dtype=int)
+        self.thresholds = np.array([e[2] for e in edges], dtype=float)
+        self.activators = np.array([e[3] for e in edges], dtype=bool)
+        self.input_child = np.array([i[0] for i in self.inputs], dtype=int)
+        self.switch_child = np.concatenate([self.edge_child,
+                                            self.input_child])
+        self.input_counts = np.bincount(self.switch_child, minlength=size)
+
+        # Adjacency list of each node's outgoing edges
+        self.out_edges = np.argsort(self.edge_parent, kind='mergesort')
+        self.out_ptr = np.concatenate(
+            [[0], np.cumsum(np.bincount(self.edge_parent, minlength=size))])
+
+    def __len__(self):
+        return len(self.products)
+
+    def node_index(self, product):
+        """
+        Node index for a LogicProduct, its name or a node index.
+        """
+        if isinstance(product, basestring):
+            return self.name2index[product]
+        if isinstance(product, (int, np.integer)):
+            return product
+        return self.index[product]
+
+    def arrays(self):
+        """
+        Dict of the arrays describing the network's wiring, which is all
+        integrate() needs and, unlike the LogicProducts, can be sent to
+        worker processes.
+        """
+        lengths = [len(times) for child, times, activate in self.inputs]
+        return {
+            'edge_parent': self.edge_parent,
+            'activators': self.activators,
+            'switch_child': self.switch_child,
+            'input_counts': self.input_counts,
+            'logic_or': self.logic_or,
+            'input_times': np.concatenate(
+                [np.zeros(0)] + [times for child, times, activate
+                                 in self.inputs]),
+            'input_ptr': np.concatenate([[0], np.cumsum(lengths)]).astype(int),
+            'input_activate': np.array([activate for child, times, activate
+                                        in self.inputs], dtype=bool),
+        }
+
+    def input_states(self, t):
+        """
+        States of the fixed-time Switches at time t.
+        """
+        states = np.empty(len(self.inputs), dtype=bool)
+        for k, (child, times, activate) in enumerate(self.inputs):
+            flips = np.searchsorted(times, t, side='right')
+            states[k] = (flips % 2 == 1) == activate
+        return states
+
+    def active(self, x, t):
+        """
+        Boolean array of which nodes are on at concentrations x and time t.
+        """
+        edge_on = (x[self.edge_parent] >= self.thresholds) == self.activators
+        on = np.concatenate([edge_on, self.input_states(t)])
+        on_counts = np.bincount(self.switch_child, weights=on,
+                                minlength=len(self))
+        return np.where(self.logic_or,
+                        (on_counts > 0) | (self.input_counts == 0),
+                        on_counts == self.input_counts)
+
+    def rhs(self, x, t):
+        """
+        Time derivative of all concentrations, in the argument order of
+        scipy.integrate.odeint.  It is discontinuous where Switches flip,
+        which adaptive integrators handle with small steps there.
+        """
+        return self.const_rates * self.active(x, t) + self.self_rates * x
+
+    def simulate(self, times, initial=None):
+        """
+        Concentrations of all nodes at each of the increasing times, one
+        row per time.  The Switch states at the start of each interval
+        hold through it, so switching is resolved to the time spacing.
+        initial: concentrations at times[0]; defaults to the products'
+          initial values
+        """
+        if initial is None:
+            initial = self.initial_vals
+        x = integrate(self.arrays(), times, self.const_rates[np.newaxis,:],
+                      self.self_rates[np.newaxis,:],
+                      self.thresholds[np.newaxis,:],
+                      np.array(initial, dtype=float)[np.newaxis,:])
+        return x[0].T
+
+    def solve(self, end, start=0.0, initial=None, max_events=1000000):
+        """
+        Exact piecewise trajectories of all nodes from start to end.
+
+        Every edge gets the analytic time at which its parent's current
+        exponential segment crosses the edge's threshold, kept in a heap
+        along with the flips of fixed-time Switches.  Each event flips one
+        Switch; only when that turns its child on or off does the child
+        start a new segment and reschedule its own outgoing edges.  Edge
+        times made stale by a new segment of their parent are skipped as
+        they come off the heap.  The cost is O(events * log events), with
+        no time stepping.
+
+        initial: concentrations at start; defaults to the products'
+          initial values
+        max_events: limit guarding against Switches that flip
+          arbitrarily often, as in a node at its own threshold
+        Returns a PiecewiseTrajectory.
+        """
+        size = len(self)
+        x = self.initial_vals.copy() if initial is None else \
+            np.array(initial, dtype=float)
+        const = [float(c) for c in self.const_rates]
+        rates = [float(r) for r in self.self_rates]
+        parents = [int(p) for p in self.edge_parent]
+        children = [int(c) for c in self.edge_child]
+        thresholds = [float(h) for h in self.thresholds]
+        activators = [bool(a) for a in self.activators]
+        logic_or = [bool(l) for l in self.logic_or]
+        input_counts = [int(c) for c in self.input_counts]
+        out_edges = [[int(e) for e in
+                      self.out_edges[self.out_ptr[i]:self.out_ptr[i+1]]]
+                     for i in range(size)]
+
+        # Initial Switch states and the count of on Switches per node
+        above = [bool(x[p] >= h) for p, h in zip(parents, thresholds)]
+        on_counts = [0] * size
+        for e in range(len(parents)):
+            if above[e] == activators[e]:
+                on_counts[children[e]] += 1
+        input_on = []
+        for k, (child, times, activate) in enumerate(self.inputs):
+            flips = np.searchsorted(times, start, side='right')
+            input_on.append((flips % 2 == 1) == activate)
+            if input_on[k]:
+                on_counts[child] += 1
+
+        def is_on(i):
+            if logic_or[i]:
+                return on_counts[i] > 0 or input_counts[i] == 0
+            return on_counts[i] == input_counts[i]
+
+        # Current segment of each node: start time, start value, on
+        seg_start = [start] * size
+        seg_value = [float(v) for v in x]
+        seg_on = [is_on(i) for i in range(size)]
+        versions = [0] * size
+        segments = [[(start, seg_value[i], seg_on[i])] for i in range(size)]
+
+        heap = []
+        counter = [0]
+        def push(time, kind, index, version):
+            counter[0] += 1
+            heapq.heappush(heap, (time, counter[0], kind, index, version))
+
+        def schedule(i):
+            drive = const[i] if seg_on[i] else 0.0
+            for e in out_edges[i]:
+                delay = _crossing(seg_value[i], drive, rates[i],
+                                  thresholds[e], above[e])
+                if delay is not None and seg_start[i] + delay <= end:
+                    push(seg_start[i] + delay, 0, e, versions[i])
+
+        for i in range(size):
+            schedule(i)
+        for k, (child, times, activate) in enumerate(self.inputs):
+            for time in times[np.searchsorted(times, start, side='right'):]:
+                if time > end:
+                    break
+                push(float(time), 1, k, 0)
+
+        events = 0
+        while heap:
+            time, count, kind, index, version = heapq.heappop(heap)
+            if kind == 0:
+                parent = parents[index]
+                if version != versions[parent]:
+                    continue
+                above[index] = not above[index]
+                child = children[index]
+                flipped_on = above[index] == activators[index]
+            else:
+                input_on[index] = not input_on[index]
+                child = self.inputs[index][0]
+                flipped_on = input_on[index]
+            on_counts[child] += 1 if flipped_on else -1
+
+            events += 1
+            if events > max_events:
+                raise RuntimeError('More than %d switch events before t=%g'
+                                   % (max_events, end))
+
+            on = is_on(child)
+            if on != seg_on[child]:
+                drive = const[child] if seg_on[child] else 0.0
+                seg_value[child] = relax(seg_value[child], drive,
+                                         rates[child],
+                                         time - seg_start[child])
+                seg_start[child] = time
+                seg_on[child] = on
+                versions[child] += 1
+                segments[child].append((time, seg_value[child], on))
+                schedule(child)
+
+        return PiecewiseTrajectory(self, segments, start, end, events)
+
+    def successors(self):
+        """
+        List of the child node indices of each node.
+        """
+        return [self.edge_child[self.out_edges[
+                    self.out_ptr[i]:self.out_ptr[i+1]]].tolist()
+                for i in range(len(self))]
+
+    def components(self):
+        """
+        Strongly connected components as lists of node indices, in
+        topological order: every edge between components goes from an
+        earlier component to a later one.
+        """
+        return strongly_connected(self.successors())
+
+    def cycles(self):
+        """
+        Lists of LogicProducts forming feedback loops, one list per
+        strongly connected component with a cycle.
+        """
+        successors = self.successors()
+        return [[self.products[i] for i in component]
+                for component in strongly_connected(successors)
+                if _cyclic(component, successors)]
+
+    def trajectory(self, product, result):
+        """
+        Column of simulate() output for a LogicProduct or its name.
+        """
+        if isinstance(product, basestring):
+            return result[:,self.name2index[product]]
+        return result[:,self.index[product]]
+
+
+class PiecewiseTrajectory():
+    """
+    Exact trajectories from Network.solve(): for each node, the start
+    times of its exponential segments with the value at each start and
+    whether the node is on through it.
+    """
+
+    def __init__(self, network, segments, start, end, events):
+        self.network = network
+        self.start = start
+        self.end = end
+        self.events = events
+        self.times = [np.array([s[0] for s in node]) for node in segments]
+        self.values = [np.array([s[1] for s in node]) for node in segments]
+        self.on = [np.array([s[2] for s in node], dtype=bool)
+                   for node in segments]
+
+    def breaks(self, product):
+        """
+        List of (time, on) for the segments of a LogicProduct (or name
+        or node index), like LogicProduct.breaks.
+        """
+        i = self.network.node_index(product)
+        return zip(self.times[i].tolist(), self.on[i].tolist())
+
+    def evaluate(self, t, product=None):
+        """
+        Concentrations at the times t, one row per time and one column
+        per node, or a single column for product.
+        """
+        t = np.asarray(t, dtype=float)
+        if product is not None:
+            return self._evaluate(self.network.node_index(product), t)
+        result = np.empty(t.shape + (len(self.times),))
+        for i in range(len(self.times)):
+            result[...,i] = self._evaluate(i, t)
+        return result
+
+    def _evaluate(self, i, t):
+        segment = np.maximum(
+            np.searchsorted(self.times[i], t, side='right') - 1, 0)
+        drive = np.where(self.on[i][segment],
+                         self.network.const_rates[i], 0.0)
+        return relax(self.values[i][segment], drive,
+                     self.network.self_rates[i], t - self.times[i][segment])
+
+
+def integrate(arrays, times, const_rates, self_rates, thresholds, initial):
+    """
+    Simulate a batch of parameter sets for one network wiring at once.
+    arrays: Network.arrays()
+    times: increasing times
+    const_rates, self_rates, initial: (sets, nodes) arrays
+    thresholds: (sets, edges) array
+
+    Every interval is an exact exponential step for all sets and nodes,
+    with the Switch states at its start.  Returns a (sets, nodes, times)
+    array.
+    """
+    times = np.asarray(times, dtype=float)
+    x = np.array(initial, dtype=float)
+    sets, size = x.shape
+    result = np.empty((sets, size, len(times)))
+    if len(times) == 0:
+        return result
+    result[:,:,0] = x
+
+    incidence = switch_incidence(arrays, size)
+    inputs = input_states(arrays, times)
+
+    # Per-step decay factor and gain of the const_rate term, with the
+    # self_rate -> 0 limit for non-decaying nodes
+    rates = np.asarray(self_rates, dtype=float)
+    decaying = rates != 0.0
+    safe_rates = np.where(decaying, rates, 1.0)
+    for n in range(1, len(times)):
+        dt = times[n] - times[n-1]
+        decay = np.exp(rates * dt)
+        gain = np.where(decaying, (decay - 1.0) / safe_rates, dt)
+        active = active_nodes(arrays, incidence, x, thresholds,
+                              np.tile(inputs[n-1], (sets, 1)))
+        x = x * decay + const_rates * active * gain
+        result[:,:,n] = x
+    return result
+
+
+def switch_incidence(arrays, size):
+    """
+    Sparse (nodes, switches) matrix summing the Switches into each node,
+    edges first and then fixed-time inputs.
+    """
+    switch_child = arrays['switch_child']
+    return scipy.sparse.csr_matrix(
+        (np.ones(len(switch_child)),
+         (switch_child, np.arange(len(switch_child)))),
+        shape=(size, len(switch_child)))
+
+
+def active_nodes(arrays, incidence, x, thresholds, inputs):
+    """
+    Boolean (sets, nodes) array of which nodes are on, for (sets, nodes)
+    concentrations x, (sets, edges) thresholds and (sets, inputs) states
+    of the fixed-time Switches.
+    """
+    edge_on = (x[:,arrays['edge_parent']] >= thresholds) == \
+        arrays['activators']
+    on = np.hstack([edge_on, inputs])
+    on_counts = incidence.dot(on.T.astype(float)).T
+    input_counts = arrays['input_counts']
+    return np.where(arrays['logic_or'],
+                    (on_counts > 0) | (input_counts == 0),
+                    on_counts == input_counts)
+
+
+def input_states(arrays, times):
+    """
+    States of the fixed-time Switches at each time, one row per time.
+    """
+    ptr = arrays['input_ptr']
+    states = np.empty((len(times), len(ptr) - 1), dtype=bool)
+    for k in range(len(ptr) - 1):
+        flips = np.searchsorted(arrays['input_times'][ptr[k]:ptr[k+1]],
+                                times, side='right')
+        states[:,k] = (flips % 2 == 1) == arrays['input_activate'][k]
+    return states
+
+
+def relax(x0, drive, rate, dt):
+    """
+    Value after dt of dx/dt = drive + rate x starting from x0, elementwise
+    for arrays.
+    """
+    if np.ndim(rate) == 0 and rate == 0.0:
+        return x0 + drive * dt
+    steady = -drive / rate
+    return steady + (x0 - steady) * np.exp(rate * dt)
+
+
+def _crossing(x0, drive, rate, threshold, above):
+    """
+    Delay until dx/dt = drive + rate x, starting from x0, crosses the
+    threshold from above (or from below if not above), or None if it
+    never does.  A start just on the wrong side of the threshold from
+    roundoff gives a delay of 0.
+    """
+    slope = drive + rate * x0
+    if (slope < 0.0) != above or slope == 0.0:
+        return None
+    if rate == 0.0:
+        return max((threshold - x0) / slope, 0.0)
+    steady = -drive / rate
+    if rate < 0.0 and (steady >= threshold if above else
+                       steady <= threshold):
+        return None
+    ratio = (threshold - steady) / (x0 - steady)
+    if ratio <= 0.0:
+        return 0.0
+    return max(math.log(ratio) / rate, 0.0)
+
+
+def strongly_connected(successors):
+    """
+    Strongly connected components of a directed graph given as a list of
+    successor lists, by Tarjan's algorithm with an explicit stack so
+    that deep graphs do not hit the recursion limit.  Each node is
+    visited once.  Components are lists of nodes in topological order.
+    """
+    size = len(successors)
+    index = [None] * size
+    low = [0] * size
+    on_stack = [False] * size
+    stack = []
+    components = []
+    counter = 0
+    for root in range(size):
+        if index[root] is not None:
+            continue
+        work = [(root, 0)]
+        while work:
+            node, pos = work.pop()
+            if pos == 0:
+                index[node] = low[node] = counter
+                counter += 1
+                stack.append(node)
+                on_stack[node] = True
+            nodes = successors[node]
+            descended = False
+            while pos < len(nodes):
+                child = nodes[pos]
+                pos += 1
+                if index[child] is None:
+                    work.append((node, pos))
+                    work.append((child, 0))
+                    descended = True
+                    break
+                elif on_stack[child]:
+                    low[node] = min(low[node], index[child])
+            if descended:
+                continue
+            if low[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+            if work:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[node])
+    # Tarjan's algorithm finishes components in reverse topological order
+    components.reverse()
+    return components
+
+
+def _cyclic(component, successors):
+    """
+    True if a strongly connected component contains a cycle, which for
+    a single node means an edge to itself.
+    """
+    return len(component) > 1 or component[0] in successors[component[0]]
+
+
+def _connected(products):
+    """
+    The given products followed by every product reachable from them
+    through Switches, in breadth-first order.
+    """
+    found = []
+    seen = set()
+    queue = deque(products)
+    while queue:
+        product = queue.popleft()
+        if product in seen:
+            continue
+        seen.add(product)
+        found.append(product)
+        queue.extend(product.parents)
+        queue.extend(product.children)
+        queue.extend(s.parent for s in product.switches
+                     if s.parent is not None)
+    return found
@@ -0,0 +1,438 @@
+# John Eargle
+# 2017
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import scipy.linalg
+import scipy.sparse
+
+from sysbiokit.matrix import kernel_columns, popcount
+
+
+# Minimal routes through metabolic networks: elementary flux modes and
+# extreme pathways
+
+
+class FluxModes():
+    """
+    Elementary flux modes and extreme pathways of a StoichioMatrix.
+
+    Modes are the extreme rays of the steady state flux cone, enumerated
+    with the nullspace variant of the double description method.  The
+    network is first compressed: reactions that cannot carry steady state
+    flux are removed and enzyme subsets (reactions whose fluxes are always
+    in fixed ratio) are merged into single columns.  Reversible reactions
+    are then split into forward and backward halves so the cone is
+    pointed, and candidate rays are checked for elementarity with a
+    combinatorial test on bitset support patterns.
+    """
+
+    def __init__(self, smatrix, reversible=None, tol=1e-9):
+        """
+        smatrix: StoichioMatrix
+        reversible: boolean array over reactions (default: reactions
+          whose lower flux bound is negative)
+        tol: magnitude below which flux values count as zero
+        """
+        self.smatrix = smatrix
+        if reversible is None:
+            reversible = smatrix.lower_bounds < 0.0
+        self.reversible = np.asarray(reversible, dtype=bool)
+        self.tol = tol
+
+    def elementary_modes(self, processes=1, filename=None, workdir=None):
+        """
+        Elementary flux modes, one per row, over all reactions.  Each mode
+        is scaled so its smallest nonzero flux has magnitude one.
+        processes: worker processes for candidate generation and testing
+        filename: stream the modes into this file (raw float64, one row of
+          len(reactions) values per mode) and return a read-only memmap
+          of it instead of holding every mode in memory
+        workdir: directory for the intermediate ray files kept while
+          streaming (default: a temporary directory)
+        """
+        matrix = _dense(self.smatrix.matrix)
+        return _flux_modes(matrix, self.reversible, self.tol, processes,
+                           filename, workdir)
+
+    def extreme_pathways(self, processes=1, filename=None, workdir=None):
+        """
+        Extreme pathways, one per row, over all reactions.  Internal
+        reversible reactions are split into two irreversible ones, while
+        reversible exchange reactions (columns with a single molecule) are
+        left free and their fluxes computed from the internal ones.
+        Arguments are as for elementary_modes().
+        """
+        matrix = _dense(self.smatrix.matrix)
+        rows, cols = matrix.shape
+        entries = matrix != 0.0
+        exchange = self.reversible & (entries.sum(axis=0) == 1)
+        exchange_row = np.argmax(entries, axis=0)
+        # Only one free exchange may balance a given molecule
+        counts = np.bincount(exchange_row[exchange], minlength=rows)
+        exchange &= counts[exchange_row] == 1
+        free_rows = np.zeros(rows, dtype=bool)
+        free_rows[exchange_row[exchange]] = True
+
+        internal = np.nonzero(~exchange)[0]
+        exchanges = np.nonzero(exchange)[0]
+        sub = matrix[~free_rows][:,internal]
+        modes = _flux_modes(sub, self.reversible[internal], self.tol,
+                            processes, None, workdir)
+
+        pathways = np.zeros((len(modes), cols))
+        pathways[:,internal] = modes
+        rows_e = exchange_row[exchanges]
+        pathways[:,exchanges] = -(np.dot(modes, matrix[rows_e][:,internal].T) /
+                                  matrix[rows_e, exchanges])
+        pathways = _normalize(pathways, self.tol)
+        if filename is not None:
+            pathways.tofile(filename)
+            return np.memmap(filename, dtype=float, mode='r',
+                             shape=pathways.shape)
+        return pathways
+
+
+def _dense(matrix):
+    if scipy.sparse.issparse(matrix):
+        return matrix.toarray()
+    return np.asarray(matrix, dtype=float)
+
+
+def _normalize(modes, tol):
+    """
+    Scale each row so its smallest nonzero magnitude is one.
+    """
+    mags = np.abs(modes)
+    mags[mags <= tol] = np.inf
+    smallest = mags.min(axis=1)
+    smallest[~np.isfinite(smallest)] = 1.0
+    modes = modes / smallest[:,np.newaxis]
+    modes[np.abs(modes) <= tol] = 0.0
+    return modes
+
+
+def _kernel_basis(matrix, tol):
+    """
+    Kernel basis [-R11^-1 R12; I] of a dense matrix from a column pivoted
+    QR.  Returns (kernel, permutation, rank); the identity rows of the
+    kernel are the columns permutation[rank:].
+    """
+    rows, cols = matrix.shape
+    if rows == 0 or not np.any(matrix):
+        return np.eye(cols), np.arange(cols), 0
+    q, r, p = scipy.linalg.qr(matrix, mode='economic', pivoting=True)
+    diag = np.abs(np.diag(r))
+    rank = int(np.sum(diag > tol * max(1.0, diag[0])))
+    return kernel_columns(rank, p, r[0:rank,:]), p, rank
+
+
+def _compress(matrix, reversible, tol):
+    """
+    Remove blocked reactions and merge enzyme subsets.  Both are read off
+    the null space of the matrix: blocked reactions have all zero rows in
+    the kernel and reactions in a subset have parallel rows.
+
+    Returns (compressed, reversible, expansion) where fluxes of the
+    original network are expansion * (fluxes of the compressed one).
+    """
+    rows, cols = matrix.shape
+    kern, p, rank = _kernel_basis(matrix, tol)
+
+    groups = {}
+    order = []
+    for j in range(cols):
+        row = kern[j]
+        scale = np.max(np.abs(row)) if row.size else 0.0
+        if scale <= tol:
+            continue
+        pivot = np.argmax(np.abs(row))
+        unit = row / row[pivot]
+        key = (pivot, np.round(unit / tol ** 0.5).astype(np.int64).tobytes())
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append((j, row[pivot]))
+
+    columns = []
+    subset_rev = []
+    expansion = []
+    for key in order:
+        members = groups[key]
+        ref = members[0][1]
+        ratios = [(j, value / ref) for j, value in members]
+        forward = backward = True
+        for j, ratio in ratios:
+            if not reversible[j]:
+                if ratio > 0.0:
+                    backward = False
+                else:
+                    forward = False
+        if not forward and not backward:
+            continue
+        sign = 1.0 if forward else -1.0
+        column = np.zeros(rows)
+        mapping = np.zeros(cols)
+        for j, ratio in ratios:
+            column += sign * ratio * matrix[:,j]
+            mapping[j] = sign * ratio
+        columns.append(column)
+        subset_rev.append(forward and backward)
+        expansion.append(mapping)
+
+    if not columns:
+        return np.zeros((0, 0)), np.zeros(0, dtype=bool), np.zeros((cols, 0))
+    compressed = np.column_stack(columns)
+    compressed = compressed[np.any(np.abs(compressed) > tol, axis=1)]
+    return (compressed, np.array(subset_rev),
+            np.column_stack(expansion))
+
+
+def _flux_modes(matrix, reversible, tol, processes, filename, workdir):
+    """
+    Elementary modes of matrix with the given reversibilities, expanded
+    back to every column of the matrix.
+    """
+    compressed, rev, expansion = _compress(matrix, reversible, tol)
+    cols = matrix.shape[1]
+    width = compressed.shape[1]
+    rev_cols = np.nonzero(rev)[0]
+    split = np.hstack([compressed, -compressed[:,rev_cols]])
+
+    def finish(rays):
+        # Undo the split, drop forward/backward 2-cycles, then expand
+        net = rays[:,0:width].copy()
+        net[:,rev_cols] -= rays[:,width:]
+        net = net[np.any(np.abs(net) > tol, axis=1)]
+        return _normalize(np.dot(net, expansion.T), tol)
+
+    if width == 0:
+        return _RayStore(cols, filename).finish()
+
+    own_workdir = filename is not None and workdir is None
+    if own_workdir:
+        workdir = tempfile.mkdtemp()
+    try:
+        return _double_description(split, tol, processes, finish,
+                                   filename, workdir, cols)
+    finally:
+        if own_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+class _RayStore():
+    """
+    Growing collection of rays, kept in memory or appended to a file.
+    """
+
+    def __init__(self, width, filename=None):
+        self.width = width
+        self.filename = filename
+        self.count = 0
+        self.chunks = []
+        self.handle = None
+        if filename is not None:
+            self.handle = open(filename, 'wb')
+
+    def append(self, rays):
+        if len(rays) == 0:
+            return
+        self.count += len(rays)
+        if self.handle is None:
+            self.chunks.append(rays)
+        else:
+            np.ascontiguousarray(rays, dtype=float).tofile(self.handle)
+
+    def finish(self):
+        if self.handle is None:
+            if not self.chunks:
+                return np.zeros((0, self.width))
+            return np.vstack(self.chunks)
+        self.handle.close()
+        if self.count == 0:
+            return np.zeros((0, self.width))
+        return np.memmap(self.filename, dtype=float, mode='r',
+                         shape=(self.count, self.width))
+
+
+# Row state loaded by a double description worker, keyed by its path
+_dd = {}
+
+
+def _bitsets(flags):
+    """
+    Pack rows of booleans into rows of 64-bit words.
+    """
+    packed = np.packbits(flags, axis=1)
+    width = 8 * ((packed.shape[1] + 7) // 8)
+    padded = np.zeros((packed.shape[0], max(width, 8)), dtype=np.uint8)
+    padded[:,0:packed.shape[1]] = packed
+    return padded.view(np.uint64)
+
+
+def _double_description(matrix, tol, processes, finish, filename, workdir,
+                        out_width):
+    """
+    Extreme rays of {x >= 0 : matrix x = 0}, passed through finish() and
+    collected, or streamed to filename, chunk by chunk.
+
+    The rays start as the columns of a kernel basis [I; K] whose identity
+    rows are already nonnegative, and each remaining row constraint is
+    added in turn.  Rays with a positive and a negative entry in the new
+    row are combined only if they are adjacent: no other ray's support
+    lies within the union of their supports.
+
+    With more than one process, a single pool serves every row.  Each
+    row's rays and supports are written to .npy files that the workers
+    memory map, so they are shared rather than copied into every task.
+    """
+    rows, cols = matrix.shape
+    kern, p, rank = _kernel_basis(matrix, tol)
+    dim = cols - rank
+
+    pool = None
+    statedir = None
+    if processes != 1 and dim < cols:
+        statedir = tempfile.mkdtemp(dir=workdir)
+        pool = multiprocessing.Pool(processes)
+    try:
+        # Process the identity rows first; they hold no constraint
+        order = np.concatenate([p[rank:], p[0:rank]])
+        rays = kern[order].T
+        for i in range(dim, cols):
+            last = i == cols - 1
+            values = rays[:,i]
+            pos = np.nonzero(values > tol)[0]
+            neg = np.nonzero(values < -tol)[0]
+            keep = np.nonzero(values >= -tol)[0]
+
+            if last:
+                store = _RayStore(out_width, filename)
+                transform = lambda x: finish(_unorder(x, order))
+            else:
+                path = None
+                if workdir is not None:
+                    path = os.path.join(workdir, 'rays%d.bin' % (i))
+                store = _RayStore(cols, path)
+                transform = lambda x: x
+
+            store.append(transform(rays[keep]))
+
+            if len(pos) > 0 and len(neg) > 0:
+                state = {
+                    'rays': rays,
+                    'supports': _bitsets(np.abs(rays[:,0:i]) > tol),
+                    'neg': neg,
+                    'column': i,
+                    'dim': dim,
+                    'tol': tol,
+                }
+                chunks = np.array_split(pos, max(1, len(pos) // 16))
+                if pool is None:
+                    results = (_combine(state, chunk) for chunk in chunks)
+                else:
+                    row_path = _save_state(statedir, state)
+                    tasks = [(row_path, chunk) for chunk in chunks]
+                    results = pool.imap(_combine_task, tasks)
+                for new in results:
+                    store.append(transform(new))
+                if pool is not None:
+                    shutil.rmtree(row_path)
+
+            previous = rays
+            rays = store.finish()
+            if isinstance(previous, np.memmap):
+                os.remove(previous.filename)
+            if last:
+                return rays
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+            shutil.rmtree(statedir, ignore_errors=True)
+
+    # No constraints to add: the kernel basis is already the ray set
+    store = _RayStore(out_width, filename)
+    store.append(finish(_unorder(rays, order)))
+    return store.finish()
+
+
+def _save_state(directory, state):
+    """
+    Write a row's state to a new directory inside directory, one .npy
+    file per array plus one holding its scalars.  Returns the new
+    directory.
+    """
+    path = tempfile.mkdtemp(prefix='row%d-' % (state['column']),
+                            dir=directory)
+    for name in ('rays', 'supports', 'neg'):
+        np.save(os.path.join(path, name + '.npy'), state[name])
+    np.save(os.path.join(path, 'scalars.npy'),
+            np.array([state['column'], state['dim'], state['tol']]))
+    return path
+
+
+def _load_state(path):
+    """
+    Row state written by _save_state(), with its arrays memory mapped.
+    """
+    state = dict((name, np.load(os.path.join(path, name + '.npy'),
+                                mmap_mode='r'))
+                 for name in ('rays', 'supports', 'neg'))
+    column, dim, tol = np.load(os.path.join(path, 'scalars.npy'))
+    state['column'] = int(column)
+    state['dim'] = int(dim)
+    state['tol'] = float(tol)
+    return state
+
+
+def _combine_task(task):
+    path, pos = task
+    if _dd.get('path') != path:
+        _dd.clear()
+        _dd['path'] = path
+        _dd['state'] = _load_state(path)
+    return _combine(_dd['state'], pos)
+
+
+def _unorder(rays, order):
+    out = np.zeros(rays.shape)
+    out[:,order] = rays
+    return out
+
+
+def _combine(state, pos):
+    """
+    New rays from each positive ray in pos and every adjacent negative
+    ray, zeroing the current column of the row state.
+    """
+    rays = state['rays']
+    supports = state['supports']
+    neg = state['neg']
+    i = state['column']
+    tol = state['tol']
+    max_support = i - (state['dim'] - 2)
+
+    new = []
+    for p in pos:
+        union = supports[p] | supports[neg]
+        # Adjacent rays share at least dim - 2 zeros
+        candidates = np.nonzero(popcount(union) <= max_support)[0]
+        for k in candidates:
+            outside = supports & ~union[k]
+            inside = ~np.any(outside, axis=1)
+            if np.count_nonzero(inside) != 2:
+                continue
+            q = neg[k]
+            ray = rays[p] * -rays[q,i] + rays[q] * rays[p,i]
+            ray /= np.max(np.abs(ray))
+            ray[np.abs(ray) <= tol] = 0.0
+            ray[i] = 0.0
+            new.append(ray)
+    if not new:
+        return np.zeros((0, rays.shape[1]))
+    return np.array(new)
@@ -0,0 +1,40 @@
+# John Eargle
+# 2017
+
+import multiprocessing
+import multiprocessing.sharedctypes
+
+import numpy as np
+
+
+# Problem arrays handed to process pool workers through shared memory
+
+
+def share(arrays):
+    """
+    Copy a dict of arrays into shared memory.  Returns, for each name,
+    what a worker needs to view the array again: the raw buffer, dtype
+    and shape.  Pass the result to a pool initializer that calls
+    attach().
+    """
+    shared = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        raw = multiprocessing.sharedctypes.RawArray('b', max(1, array.nbytes))
+        view = np.frombuffer(raw, dtype=np.int8, count=array.nbytes)
+        view[:] = array.view(np.int8).ravel()
+        shared[name] = (raw, array.dtype.str, array.shape)
+    return shared
+
+
+def attach(shared):
+    """
+    Dict of arrays viewing the shared memory made by share(), without
+    copying it.
+    """
+    arrays = {}
+    for name, (raw, dtype, shape) in shared.items():
+        count = int(np.prod(shape))
+        arrays[name] = np.frombuffer(raw, dtype=dtype,
+                                     count=count).reshape(shape)
+    return arrays
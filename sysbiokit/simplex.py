@@ -0,0 +1,334 @@
+# John Eargle
+# 2017
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+
+# Linear programs solved with bounded primal and dual simplex methods
+
+
+class Simplex():
+    """
+    Simplex solver for linear programs with finite bounds on every
+    variable and every row.
+
+      minimize c.x  subject to  row_lower <= Ax <= row_upper
+                                lower <= x <= upper
+
+    Each row gets a logical variable s = Ax so the working system is
+    [A -I][x; s] = 0 and every solve can start from the all-logical basis.
+
+    Warm starts pick the method that keeps the given basis useful.  A basis
+    that is still primal feasible (the objective changed, as in flux
+    variability) is improved with the primal simplex.  Otherwise nonbasic
+    variables are moved to the bound matching the sign of their reduced
+    cost, which makes any basis dual feasible when every variable is boxed,
+    and the dual simplex restores primal feasibility (the bounds changed,
+    as in knockouts).  Neither case needs a phase one.
+
+    The basis matrix is factored with SuperLU and updated between
+    refactorizations in product form.
+    """
+
+    def __init__(self, matrix, row_lower=None, row_upper=None,
+                 tol=1e-9, refactor=64, max_iter=None):
+        """
+        matrix: constraint matrix A, dense or scipy.sparse
+        row_lower, row_upper: bounds on Ax (default 0, i.e. Ax = 0)
+        tol: feasibility, optimality and pivot tolerance
+        refactor: number of basis updates between LU factorizations
+        max_iter: iteration limit per solve (default 50 * (rows + cols))
+        """
+        matrix = scipy.sparse.csc_matrix(matrix, dtype=float)
+        self.rows, self.cols = matrix.shape
+        self.matrix = scipy.sparse.hstack(
+            [matrix, -scipy.sparse.identity(self.rows)]).tocsc()
+        self.matrix_t = self.matrix.T.tocsr()
+        if row_lower is None:
+            row_lower = np.zeros(self.rows)
+        if row_upper is None:
+            row_upper = np.zeros(self.rows)
+        self.row_lower = np.asarray(row_lower, dtype=float)
+        self.row_upper = np.asarray(row_upper, dtype=float)
+        self.tol = tol
+        self.refactor = refactor
+        if max_iter is None:
+            max_iter = 50 * (self.rows + self.cols)
+        self.max_iter = max_iter
+
+        self.status = None
+        self.x = None
+        self.objective = None
+        self.basis = None
+        self.iterations = 0
+        self._warm_key = None
+        self._warm_lu = None
+
+    def solve(self, cost, lower, upper, basis=None):
+        """
+        Solve for the given structural costs and bounds, starting from a
+        previous basis if one is given.  Returns the status, 'optimal',
+        'infeasible' or 'iteration limit'; the solution is left in self.x,
+        self.objective and self.basis.
+        """
+        size = self.cols + self.rows
+        c = np.zeros(size)
+        c[0:self.cols] = cost
+        l = np.concatenate([np.asarray(lower, dtype=float), self.row_lower])
+        u = np.concatenate([np.asarray(upper, dtype=float), self.row_upper])
+        if np.any(~np.isfinite(l)) or np.any(~np.isfinite(u)):
+            raise ValueError('Simplex requires finite bounds')
+
+        if basis is None:
+            basic = np.arange(self.cols, size)
+            at_upper = c < 0.0
+        else:
+            basic = np.array(basis[0])
+            at_upper = np.array(basis[1])
+
+        # The factorization of a repeated starting basis is reused
+        key = basic.tobytes()
+        if key != self._warm_key:
+            self._warm_key = key
+            self._warm_lu = self._factor(basic)
+        tab = _Basis(self, basic, at_upper, self._warm_lu)
+
+        x_basic = tab.basic_values(l, u)
+        feasible = np.all(x_basic >= l[basic] - self.tol) and \
+                   np.all(x_basic <= u[basic] + self.tol)
+        if basis is not None and feasible:
+            self.status = self._primal(tab, c, l, u)
+        else:
+            self.status = self._dual(tab, c, l, u)
+
+        x = np.where(tab.at_upper, u, l)
+        x[tab.basic] = tab.x_basic
+        self.x = x[0:self.cols]
+        self.objective = np.dot(c[0:self.cols], self.x)
+        self.basis = (tab.basic, tab.at_upper)
+        return self.status
+
+    def _factor(self, basic):
+        return scipy.sparse.linalg.splu(self.matrix[:,basic].tocsc())
+
+    def _primal(self, tab, c, l, u):
+        """
+        Bounded primal simplex from a primal feasible basis.
+        """
+        fixed = u - l <= self.tol
+        tab.basic_values(l, u)
+        degenerate = 0
+        self.iterations = 0
+        while self.iterations < self.max_iter:
+            self.iterations += 1
+            d = tab.reduced_costs(c)
+
+            # Entering variable: Dantzig pricing, or Bland's rule after a
+            # run of degenerate steps
+            improving = ~tab.is_basic & ~fixed & (
+                (~tab.at_upper & (d < -self.tol)) |
+                (tab.at_upper & (d > self.tol)))
+            candidates = np.nonzero(improving)[0]
+            if len(candidates) == 0:
+                return 'optimal'
+            if degenerate > 50:
+                entering = candidates[0]
+            else:
+                entering = candidates[np.argmax(np.abs(d[candidates]))]
+            direction = -1.0 if tab.at_upper[entering] else 1.0
+
+            # Ratio test over the basic variables and the entering bound
+            w = tab.ftran(entering)
+            dw = direction * w
+            x_basic = tab.x_basic
+            l_basic = l[tab.basic]
+            u_basic = u[tab.basic]
+            steps = np.ones(len(w)) * np.inf
+            down = dw > self.tol
+            up = dw < -self.tol
+            steps[down] = (x_basic[down] - l_basic[down]) / dw[down]
+            steps[up] = (u_basic[up] - x_basic[up]) / -dw[up]
+            steps = np.maximum(steps, 0.0)
+            r = np.argmin(steps)
+            step = steps[r]
+            span = u[entering] - l[entering]
+
+            degenerate = degenerate + 1 if min(step, span) <= self.tol else 0
+            if span <= step:
+                tab.x_basic -= span * dw
+                tab.at_upper[entering] = not tab.at_upper[entering]
+                continue
+
+            value = (u[entering] if tab.at_upper[entering]
+                     else l[entering]) + direction * step
+            tab.x_basic -= step * dw
+            tab.pivot(r, entering, w, value, dw[r] < 0.0)
+            if tab.stale():
+                tab.refresh(c, l, u, fixed, flip=False)
+        return 'iteration limit'
+
+    def _dual(self, tab, c, l, u):
+        """
+        Bounded dual simplex, first flipping nonbasic variables to make the
+        basis dual feasible.
+        """
+        fixed = u - l <= self.tol
+        d = tab.refresh(c, l, u, fixed, flip=True)
+        self.iterations = 0
+        while self.iterations < self.max_iter:
+            self.iterations += 1
+
+            # Leaving variable: the most infeasible basic variable
+            x_basic = tab.x_basic
+            below = l[tab.basic] - x_basic
+            above = x_basic - u[tab.basic]
+            infeas = np.maximum(below, above)
+            r = np.argmax(infeas)
+            if infeas[r] <= self.tol:
+                return 'optimal'
+            leaving = tab.basic[r]
+            sign = 1.0 if above[r] > 0.0 else -1.0
+
+            # Pivot row of the tableau
+            alpha = tab.pivot_row(r)
+
+            # Entering variable: Harris two-pass dual ratio test
+            salpha = sign * alpha
+            eligible = ~tab.is_basic & ~fixed & (
+                (~tab.at_upper & (salpha > self.tol)) |
+                (tab.at_upper & (salpha < -self.tol)))
+            candidates = np.nonzero(eligible)[0]
+            if len(candidates) == 0:
+                return 'infeasible'
+            abs_alpha = np.abs(alpha[candidates])
+            abs_d = np.abs(d[candidates])
+            max_step = np.min((abs_d + self.tol) / abs_alpha)
+            within = abs_d / abs_alpha <= max_step
+            entering = candidates[within][np.argmax(abs_alpha[within])]
+            theta = d[entering] / alpha[entering]
+
+            # Primal update
+            w = tab.ftran(entering)
+            bound = u[leaving] if sign > 0.0 else l[leaving]
+            delta = (x_basic[r] - bound) / w[r]
+            value = (u[entering] if tab.at_upper[entering]
+                     else l[entering]) + delta
+            tab.x_basic -= delta * w
+
+            # Dual update and basis change
+            d -= theta * alpha
+            d[entering] = 0.0
+            d[leaving] = -theta
+            tab.pivot(r, entering, w, value, sign > 0.0)
+            if tab.stale():
+                d = tab.refresh(c, l, u, fixed, flip=True)
+        return 'iteration limit'
+
+
+class _Basis():
+    """
+    Working basis of a Simplex solve: basic columns, nonbasic bound
+    status, basic values and the factored basis matrix with its product
+    form updates.
+    """
+
+    def __init__(self, simplex, basic, at_upper, lu):
+        self.simplex = simplex
+        self.basic = basic
+        self.at_upper = at_upper
+        self.is_basic = np.zeros(len(at_upper), dtype=bool)
+        self.is_basic[basic] = True
+        self.lu = lu
+        self.etas = []
+        self.x_basic = None
+
+    def column(self, j):
+        matrix = self.simplex.matrix
+        start, stop = matrix.indptr[j], matrix.indptr[j+1]
+        col = np.zeros(self.simplex.rows)
+        col[matrix.indices[start:stop]] = matrix.data[start:stop]
+        return col
+
+    def ftran(self, j):
+        """
+        Solve B w = a_j for the current basis B = B0 F1 ... Fk.
+        """
+        w = self.lu.solve(self.column(j))
+        for r, eta in self.etas:
+            wr = w[r] / eta[r]
+            w -= wr * eta
+            w[r] = wr
+        return w
+
+    def btran(self, v):
+        """
+        Solve B^T z = v for the current basis.
+        """
+        v = v.copy()
+        for r, eta in reversed(self.etas):
+            v[r] -= (np.dot(eta, v) - v[r]) / eta[r]
+        return self.lu.solve(v, trans='T')
+
+    def pivot_row(self, r):
+        """
+        Row r of B^-1 [A -I], zeroed on the basic columns.
+        """
+        e = np.zeros(self.simplex.rows)
+        e[r] = 1.0
+        alpha = self.simplex.matrix_t.dot(self.btran(e))
+        alpha[self.is_basic] = 0.0
+        return alpha
+
+    def reduced_costs(self, c):
+        y = self.btran(c[self.basic])
+        d = c - self.simplex.matrix_t.dot(y)
+        d[self.is_basic] = 0.0
+        return d
+
+    def basic_values(self, l, u):
+        x_nonbasic = np.where(self.at_upper, u, l)
+        x_nonbasic[self.basic] = 0.0
+        rhs = -self.simplex.matrix.dot(x_nonbasic)
+        self.x_basic = self.lu.solve(rhs)
+        for r, eta in self.etas:
+            xr = self.x_basic[r] / eta[r]
+            self.x_basic -= xr * eta
+            self.x_basic[r] = xr
+        return self.x_basic
+
+    def pivot(self, r, entering, w, value, leaving_upper):
+        """
+        Replace basic column r by entering, which takes the given value,
+        with the leaving variable moving to its upper or lower bound.
+        """
+        leaving = self.basic[r]
+        self.basic[r] = entering
+        self.x_basic[r] = value
+        self.is_basic[entering] = True
+        self.is_basic[leaving] = False
+        self.at_upper[entering] = False
+        self.at_upper[leaving] = leaving_upper
+        self.etas.append((r, w))
+
+    def stale(self):
+        return len(self.etas) >= self.simplex.refactor
+
+    def refresh(self, c, l, u, fixed, flip):
+        """
+        Refactor if updates have built up, then recompute reduced costs
+        and basic values, optionally flipping nonbasic variables to their
+        dual feasible bounds.  Returns the reduced costs.
+        """
+        if self.etas:
+            self.lu = self.simplex._factor(self.basic)
+            self.etas = []
+        d = self.reduced_costs(c)
+        if flip:
+            tol = self.simplex.tol
+            flips = ~self.is_basic & ~fixed & (
+                (~self.at_upper & (d < -tol)) | (self.at_upper & (d > tol)))
+            self.at_upper[flips] = ~self.at_upper[flips]
+        self.basic_values(l, u)
+        return d
@@ -0,0 +1,195 @@
+# John Eargle
+# 2017
+
+import multiprocessing
+
+import numpy as np
+
+from sysbiokit.sharedmem import share, attach
+from sysbiokit.network import active_nodes, input_states, switch_incidence
+
+
+# Stochastic simulation of transcription networks
+
+
+def ensemble(network, times, runs, method='ssa', volume=1.0, seed=0,
+             epsilon=0.03, processes=1, chunk_size=256):
+    """
+    Molecule counts of every node in an ensemble of stochastic
+    trajectories of a Network.
+
+    Each node is a birth-death process: molecules are made with
+    propensity volume * const_rate while the node is on and degraded
+    with propensity -self_rate per molecule, matching the deterministic
+    model at large volume.  Thresholds and initial values are scaled by
+    volume into counts.
+
+    times: increasing sample times, starting at the initial state
+    runs: number of trajectories
+    method: 'ssa' for Gillespie's exact direct method, or 'tau' for
+      adaptive tau-leaping (Cao, Gillespie and Petzold, 2006), which takes
+      exact steps where a leap would be too short to pay off
+    volume: molecules per unit of concentration
+    seed: base seed; trajectories are simulated in chunks of chunk_size
+      and chunk k draws from its own stream seeded with (seed, k), so
+      results do not depend on the number of processes
+    epsilon: tau-leaping error control, the largest relative change in
+      any propensity allowed in a leap
+    processes: size of the process pool (None for one per CPU); 1 runs
+      in this process
+
+    Each chunk advances all of its trajectories together, one reaction
+    (or leap) per trajectory per vectorized step.  Returns a (run, node,
+    time) array of counts.
+    """
+    if method not in ('ssa', 'tau'):
+        raise ValueError('Unknown stochastic method: %s' % (method))
+    problem = network.arrays()
+    problem['times'] = np.asarray(times, dtype=float)
+    problem['births'] = volume * network.const_rates
+    problem['deaths'] = -network.self_rates
+    problem['thresholds'] = volume * network.thresholds
+    problem['initial'] = np.round(volume * network.initial_vals)
+    problem['epsilon'] = np.array([epsilon if method == 'tau' else 0.0])
+    problem['input_flips'] = np.unique(problem['input_times'])
+
+    chunks = [(k, min(chunk_size, runs - start), seed)
+              for k, start in enumerate(range(0, runs, chunk_size))]
+    if processes == 1:
+        results = [_ensemble_chunk(problem, chunk) for chunk in chunks]
+    else:
+        shared = share(problem)
+        pool = multiprocessing.Pool(processes, _ensemble_init, (shared,))
+        try:
+            results = pool.map(_ensemble_task, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    if not results:
+        return np.empty((0, len(network), len(problem['times'])))
+    return np.concatenate(results)
+
+
+# Ensemble arrays attached to by each worker
+_ensemble = {}
+
+
+def _ensemble_init(shared):
+    _ensemble['problem'] = attach(shared)
+
+
+def _ensemble_task(chunk):
+    return _ensemble_chunk(_ensemble['problem'], chunk)
+
+
+def _ensemble_chunk(problem, chunk):
+    """
+    Trajectories for one chunk of the ensemble.
+
+    Every trajectory has its own clock.  A step draws the time to its
+    next reaction (or takes a leap) given the current Switch states,
+    records the samples the state held through, and applies the change.
+    A step never runs past the next flip of a fixed-time Switch; it
+    stops there without a reaction instead, which is exact for the
+    memoryless direct method.
+    """
+    index, runs, seed = chunk
+    random = np.random.RandomState([seed, index])
+    times = problem['times']
+    births = problem['births']
+    deaths = problem['deaths']
+    thresholds = problem['thresholds']
+    epsilon = problem['epsilon'][0]
+    flips = np.append(problem['input_flips'], np.inf)
+    samples = np.append(times, np.inf)
+    size = len(births)
+
+    x = np.tile(problem['initial'], (runs, 1))
+    t = np.ones(runs) * (times[0] if len(times) else 0.0)
+    sample = np.zeros(runs, dtype=int)
+    result = np.empty((runs, size, len(times)))
+    incidence = switch_incidence(problem, size)
+    alive = np.arange(runs)
+
+    while len(alive):
+        xa = x[alive]
+        ta = t[alive]
+        count = len(alive)
+        inputs = input_states(problem, ta)
+        active = active_nodes(problem, incidence, xa,
+                              np.tile(thresholds, (count, 1)), inputs)
+        up = births * active
+        down = deaths * xa
+        total = up.sum(axis=1) + down.sum(axis=1)
+        barrier = flips[np.searchsorted(flips, ta, side='right')]
+
+        # Exact steps: time to the next reaction, unless a flip comes first
+        with np.errstate(divide='ignore'):
+            step = -np.log(random.random_sample(count)) / total
+        leap = np.zeros(count, dtype=bool)
+        if epsilon > 0.0:
+            # Leaps also stop at sample times, so samples are exact states
+            tau = _leap_size(xa, up, down, epsilon)
+            with np.errstate(divide='ignore'):
+                leap = tau > 10.0 / total
+            limit = samples[np.searchsorted(times, ta, side='right')]
+            step = np.where(leap, np.minimum(tau, limit - ta), step)
+        end = np.minimum(ta + step, barrier)
+        fire = ~leap & (ta + step < barrier)
+        leap &= end > ta
+
+        # The current state holds for samples in [t, end)
+        _record(result, sample, alive, times, xa, end)
+        t[alive] = end
+
+        if fire.any():
+            rows = np.nonzero(fire)[0]
+            propensities = np.hstack([up[rows], down[rows]])
+            target = random.random_sample(len(rows)) * total[rows]
+            cumulative = np.cumsum(propensities, axis=1)
+            # Round-off can put the target past the cumulative sum; fall
+            # back to the last reaction that can fire
+            last = 2 * size - 1 - np.argmax(propensities[:,::-1] > 0.0,
+                                            axis=1)
+            reaction = np.minimum((cumulative < target[:,np.newaxis]).sum(
+                axis=1), last)
+            node = reaction % size
+            xa[rows, node] += np.where(reaction < size, 1.0, -1.0)
+        if leap.any():
+            rows = np.nonzero(leap)[0]
+            dt = (end - ta)[rows, np.newaxis]
+            change = (random.poisson(up[rows] * dt) -
+                      random.poisson(down[rows] * dt))
+            xa[rows] = np.maximum(xa[rows] + change, 0.0)
+        x[alive] = xa
+        alive = alive[sample[alive] < len(times)]
+    return result
+
+
+def _leap_size(x, up, down, epsilon):
+    """
+    Largest leap for each trajectory keeping the expected change in, and
+    the standard deviation of, every count within epsilon of it (at
+    least one molecule).
+    """
+    mean = np.abs(up - down)
+    variance = up + down
+    bound = np.maximum(epsilon * x, 1.0)
+    with np.errstate(divide='ignore'):
+        tau = np.minimum(bound / mean, bound * bound / variance)
+    return tau.min(axis=1)
+
+
+def _record(result, sample, alive, times, x, end):
+    """
+    Store x as the state at every pending sample time before end.
+    """
+    while True:
+        pending = sample[alive] < len(times)
+        due = np.zeros(len(alive), dtype=bool)
+        due[pending] = times[sample[alive][pending]] < end[pending]
+        if not due.any():
+            return
+        rows = alive[due]
+        result[rows, :, sample[rows]] = x[due]
+        sample[rows] += 1
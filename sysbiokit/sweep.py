@@ -0,0 +1,114 @@
+# John Eargle
+# 2017
+
+import multiprocessing
+
+import numpy as np
+
+from sysbiokit.sharedmem import share, attach
+from sysbiokit.network import integrate
+
+
+# Parameter sweeps over transcription networks
+
+
+# Parameter arrays of a sweep, named after the Network attributes they
+# default to
+PARAMETERS = ('const_rates', 'self_rates', 'thresholds', 'initial_vals')
+
+
+def combinations(network, variations):
+    """
+    Parameter arrays for every combination of the varied values, with
+    all other parameters as in the network.
+    network: Network
+    variations: list of (target, parameter, values), where parameter is
+      'const_rate', 'self_rate' or 'initial_val' for a target
+      LogicProduct (or its name), or 'threshold' for a target Switch
+
+    Returns a dict from 'const_rates', 'self_rates', 'initial_vals' (one
+    column per node) and 'thresholds' (one column per edge) to arrays with
+    one row per combination, ordered as itertools.product of the values.
+    """
+    values = [np.asarray(v, dtype=float) for target, parameter, v
+              in variations]
+    grids = np.meshgrid(*values, indexing='ij') if values else []
+    count = int(np.prod([len(v) for v in values]))
+    parameters = dict((name, np.tile(getattr(network, name), (count, 1)))
+                      for name in PARAMETERS)
+
+    for (target, parameter, v), grid in zip(variations, grids):
+        if parameter == 'threshold':
+            name, column = 'thresholds', network.switch_index[target]
+        elif parameter in ('const_rate', 'self_rate', 'initial_val'):
+            name, column = parameter + 's', network.node_index(target)
+        else:
+            raise ValueError('Unknown parameter: %s' % (parameter))
+        parameters[name][:,column] = grid.ravel()
+    return parameters
+
+
+def sweep(network, times, parameters, processes=1, chunk_size=256):
+    """
+    Trajectories of a network for many parameter sets, integrated
+    together (see network.integrate).
+    network: Network
+    times: increasing times
+    parameters: dict with any of 'const_rates', 'self_rates',
+      'initial_vals' and 'thresholds', each an array with one row per
+      parameter set (see combinations()); missing ones are the network's
+    processes: size of the process pool (None for one per CPU); 1 runs
+      in this process
+    chunk_size: parameter sets per pool task
+
+    Returns a (parameter set, node, time) array.
+    """
+    count = max([len(parameters[name]) for name in parameters] or [1])
+    problem = {}
+    for name in PARAMETERS:
+        default = getattr(network, name)
+        value = np.asarray(parameters.get(name, default), dtype=float)
+        problem[name] = np.ascontiguousarray(
+            np.broadcast_to(value, (count, len(default))))
+    problem.update(network.arrays())
+    problem['times'] = np.asarray(times, dtype=float)
+
+    chunks = [(start, min(start + chunk_size, count))
+              for start in range(0, count, chunk_size)]
+    if processes == 1:
+        results = [_sweep_chunk(problem, chunk) for chunk in chunks]
+    else:
+        shared = share(problem)
+        pool = multiprocessing.Pool(processes, _sweep_init, (shared,))
+        try:
+            results = pool.map(_sweep_task, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    if not results:
+        return np.empty((0, len(network), len(problem['times'])))
+    return np.concatenate(results)
+
+
+# Sweep arrays attached to by each worker
+_sweep = {}
+
+
+def _sweep_init(shared):
+    _sweep['problem'] = attach(shared)
+
+
+def _sweep_task(chunk):
+    return _sweep_chunk(_sweep['problem'], chunk)
+
+
+def _sweep_chunk(problem, chunk):
+    """
+    Trajectories for the parameter sets in rows start to stop.
+    """
+    start, stop = chunk
+    return integrate(problem, problem['times'],
+                     problem['const_rates'][start:stop],
+                     problem['self_rates'][start:stop],
+                     problem['thresholds'][start:stop],
+                     problem['initial_vals'][start:stop])
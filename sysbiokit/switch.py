@@ -1,21 +1,38 @@
 # John Eargle
 # 2015-2016
 
-from collections import deque
-import sys
-import json
+import heapq
+from itertools import groupby
+import logging
+from timeit import default_timer as timer
 
-import matplotlib.pyplot as plt
 import numpy as np
+
+from sysbiokit.export import render
+from sysbiokit.instrument import current_profile, switch_name
+from sysbiokit.network import relax, strongly_connected
 # import sympy
 
 
+# Solve traces, off unless DEBUG logging is enabled for sysbiokit.switch
+log = logging.getLogger(__name__)
+
+
 # Regulation networks modeled as graphs of functional nodes connected
 # through switched input/output edges.
 #   negative: repression (gene), inhibition (protein)
 #   positive: induction (gene), activation (protein)
 
 
+def _pyplot():
+    """
+    matplotlib.pyplot, imported on the first plot since loading it and
+    its backend dominates the import time of this module.
+    """
+    import matplotlib.pyplot
+    return matplotlib.pyplot
+
+
 def heaviside(x, theta, on=True):
     """
     Zero out values of x<theta.
@@ -27,9 +44,13 @@ def heaviside(x, theta, on=True):
     return np.piecewise(x, [x<theta, x>=theta], vals)
 
 
-def time_plot(duration):
+def time_plot(duration, path=None):
     x = np.arange(0, duration, 0.1)
     y = heaviside(x, duration/5.0) * np.sin(x) * np.exp(-x/20.0) * 5.0
+    if path is not None:
+        render([('y', x, y)], path)
+        return
+    plt = _pyplot()
     plt.plot(x, y)
     plt.grid()
     plt.show()
@@ -62,19 +83,33 @@ class SimpleProduct():
             print '  steady state = %.2f' % (-self.const_rate/self.self_rate)
             print '  reaction time = %.2f' % (-np.log(2.0)/self.self_rate)
             
-    def plot(self):
+    def evaluate(self, t):
+        """
+        Concentration of SimpleProduct at the times t, a number or an
+        array, starting from zero at time 0.
+        """
+        t = np.asarray(t, dtype=float)
+        if self.self_rate > -0.00001 and self.self_rate < 0.00001:
+            return self.const_rate * t
+        steady_rate = -self.const_rate/self.self_rate
+        return steady_rate * (1.0 - np.exp(self.self_rate*t))
+
+    def plot(self, path=None):
         """
         Calculate and plot the concentration of SimpleProduct over time.
+        path: image file to write instead of showing the plot
         """
         if self.self_rate > -0.00001 and self.self_rate < 0.00001:
             t = np.arange(0, 10, 0.1)
-            y = self.const_rate * t
         else:
-            steady_rate = -self.const_rate/self.self_rate
             rx_t = -np.log(2.0)/self.self_rate
             duration = rx_t*4.0
             t = np.arange(0, duration, duration/50.0)
-            y = steady_rate * (1.0 - np.exp(self.self_rate*t))
+        y = self.evaluate(t)
+        if path is not None:
+            render([(self.name, t, y)], path)
+            return
+        plt = _pyplot()
         plt.plot(t, y)
         plt.grid()
         plt.show()
@@ -97,6 +132,8 @@ class LogicProduct():
         product_type: RNA, protein (just a label)
         breaks: array of switch times
         vals: array of functions
+        segment_values: concentration at the start of each break
+        segment_on: whether the product is on after each break
         """
         self.name = name
         self.const_rate = const_rate
@@ -110,6 +147,8 @@ class LogicProduct():
         self.solved = False
         self.breaks = []
         self.vals = []
+        self.segment_values = np.empty(0)
+        self.segment_on = np.empty(0, dtype=bool)
 
     def add_child(self, child, threshold, activate=True):
         """
@@ -129,21 +168,41 @@ class LogicProduct():
 
     def solve(self):
         """
-        Check that the parents are solved and then generate needed
-        parameters for plotting the trajectory of this product's
-        concentration.
+        Solve the upstream network in topological order and then
+        generate needed parameters for plotting the trajectory of this
+        product's concentration.  Each unsolved ancestor and Switch is
+        solved exactly once, without recursion, so cascades of any depth
+        work.  Feedback loops have no solution in this closed form and
+        raise a ValueError naming them; sysbiokit.network.Network.solve()
+        handles them.
         """
-        # TODO - handle cyclic dependencies (choose starting nodes)
-        for p in self.parents:
-            if not p.solved:
-                p.solve()
+        for product in _solve_order(self):
+            if not product.solved:
+                product._solve_self()
 
+    def _solve_self(self):
+        """
+        Generate this product's breaks and trajectory pieces, with its
+        parents already solved.
+        """
         for s in self.switches:
             if not s.solved:
                 s.solve()
-
-        for s in self.switches:
-            self.breaks = s.get_breaks()
+        profile = current_profile()
+        if profile is not None:
+            start = timer()
+        debug = log.isEnabledFor(logging.DEBUG)
+        closures = 0
+
+        if len(self.switches) > 1:
+            # Inputs combine with 'and', as in sysbiokit.network.Network
+            board = SwitchBoard(self.switches)
+            self.breaks = board.get_breaks()
+            if len(self.breaks) == 0:
+                self.breaks = [(0.0, board.initial)]
+        else:
+            for s in self.switches:
+                self.breaks = s.get_breaks()
         if len(self.breaks) == 0:
             self.breaks = [(0.0, True)]
 
@@ -160,25 +219,39 @@ class LogicProduct():
             active = self.breaks[0][1]
             self.vals = [self.initial_val]
             last_val = self.initial_val
+            starts = []
             for i, brk in enumerate(self.breaks[0:-1]):
-                print 'i:', i
-                print 'brk:', brk[0]
+                if debug:
+                    log.debug('%s piece %d from %g', self.name, i, brk[0])
+                starts.append(last_val)
                 if active:
                     self.vals.append(on_func(last_val, brk[0]))
                     last_val = on_func(last_val, brk[0])(self.breaks[i+1][0])
                 else:
                     self.vals.append(off_func(last_val, brk[0]))
                     last_val = off_func(last_val, brk[0])(self.breaks[i+1][0])
+                closures += 1
                 active = not active
                 # print 'last_val:', last_val
+            starts.append(last_val)
             if active:
                 self.vals.append(on_func(last_val, self.breaks[-1][0]))
             else:
                 self.vals.append(off_func(last_val, self.breaks[-1][0]))
 
-        print 'len(breaks):', len(self.breaks)
-        print 'len(vals):', len(self.vals)
+            # The same pieces as arrays for evaluate()
+            self.segment_values = np.array(starts)
+            self.segment_on = np.arange(len(starts)) % 2 == 0
+            if not self.breaks[0][1]:
+                self.segment_on = ~self.segment_on
+
+        if debug:
+            log.debug('%s: %d breaks, %d vals', self.name, len(self.breaks),
+                      len(self.vals))
         self.solved = True
+        if profile is not None:
+            profile.record('node', self.name, timer() - start,
+                           len(self.breaks), closures)
 
     def report(self):
         """
@@ -196,30 +269,87 @@ class LogicProduct():
             print '  steady state = %.2f' % (-self.const_rate/self.self_rate)
             print '  reaction time = %.2f' % (-np.log(2.0)/self.self_rate)
 
-    def plot(self, start, end, step):
+    def evaluate(self, t):
         """
-        Plot the concentration of LogicProduct over time.
+        Concentration of LogicProduct at the times t, a number or an
+        array.  Each time is located among the breaks with a binary
+        search and the closed-form pieces are evaluated for all times
+        at once.  A number gives back a float, an array an array.
         """
         if not self.solved:
             self.solve()
-        
-        t = np.arange(start, end, step)
+
+        t = np.asarray(t, dtype=float)
         if self.self_rate > -0.00001 and self.self_rate < 0.00001:
-            y = self.const_rate * t
-        else:
-            # Build ranges
-            ranges = [t<self.breaks[0][0]]
-            for i in range(1, len(self.breaks)):
-                ranges.append((t>=self.breaks[i-1][0]) * (t<self.breaks[i][0]))
-            ranges.append(t>=self.breaks[-1][0])
-            
-            y = np.piecewise(t, ranges, self.vals)
-            
+            return (self.const_rate * t)[()]
+        times = np.array([brk[0] for brk in self.breaks])
+        segment = np.searchsorted(times, t, side='right') - 1
+        piece = np.maximum(segment, 0)
+        drive = np.where(self.segment_on[piece], self.const_rate, 0.0)
+        y = relax(self.segment_values[piece], drive, self.self_rate,
+                  t - times[piece])
+        # [()] turns the 0-d result for a scalar time into a float
+        return np.where(segment < 0, self.initial_val, y)[()]
+
+    def plot(self, start, end, step, path=None):
+        """
+        Plot the concentration of LogicProduct over time.
+        path: image file to write instead of showing the plot
+        """
+        t = np.arange(start, end, step)
+        y = self.evaluate(t)
+        if path is not None:
+            render([(self.name, t, y)], path)
+            return
+
+        plt = _pyplot()
         plt.plot(t, y)
         plt.grid()
         plt.show()
 
 
+def evaluate(products, t):
+    """
+    Concentrations of LogicProducts at the times t, one row per time and
+    one column per product.
+    """
+    t = np.asarray(t, dtype=float)
+    result = np.empty(t.shape + (len(products),))
+    for i, product in enumerate(products):
+        result[...,i] = product.evaluate(t)
+    return result
+
+
+def _solve_order(product):
+    """
+    The product and its unsolved ancestors, in an order where parents
+    come before their children.
+    """
+    # Unsolved upstream nodes, found iteratively through Switch parents
+    nodes = [product]
+    index = {product: 0}
+    successors = [[]]
+    for node in nodes:
+        for switch in node.switches:
+            parent = switch.parent
+            if parent is None or parent.solved:
+                continue
+            if parent not in index:
+                index[parent] = len(nodes)
+                nodes.append(parent)
+                successors.append([])
+            successors[index[parent]].append(index[node])
+
+    order = []
+    for component in strongly_connected(successors):
+        member = component[0]
+        if len(component) > 1 or member in successors[member]:
+            raise ValueError('Feedback loop through %s' % (
+                ', '.join(nodes[i].name for i in component)))
+        order.append(nodes[member])
+    return order
+
+
 class SwitchBoard():
     """
     Combines signals from Switches to produce a single trace of breaks.
@@ -229,61 +359,131 @@ class SwitchBoard():
         """
         switches: list of Switches
         combName: 'and', 'or', 'custom'
-        combFunc: logic function that takes switch values and returns
-          True or False
+        combFunc: for 'custom', either a logic function that takes an
+          array of switch values and returns True or False, or a truth
+          table: a sequence of 2**len(switches) outputs indexed by the
+          switch values packed into an integer, bit i for switch i
         """
         self.switches = switches
+        self.combName = combName
 
         if combName == 'and':
             self.combFunc = lambda x: np.all(x)
         elif combName == 'or':
             self.combFunc = lambda x: np.any(x)
         else:
+            if combFunc is None:
+                raise ValueError('SwitchBoard %s logic needs a combFunc' % (
+                    combName))
+            if not callable(combFunc) and \
+               len(combFunc) != 2**len(switches):
+                raise ValueError('Truth table has %d rows for %d switches' % (
+                    len(combFunc), len(switches)))
             self.combFunc = combFunc
 
+        self.initial = False
         self.times = []
         self.solved = False
 
     def solve(self):
-        all_breaks = []
-        all_times = []
+        """
+        Find the times where the combined output flips.  The sorted
+        break streams of the Switches are merged with a heap, and the
+        switch values are kept packed, with a count of the ones on, so
+        'and' and 'or' boards and truth tables take constant time per
+        break.  Breaks at the same time are applied together before the
+        output is checked.
+        """
+        streams = []
+        states = []
         for s in self.switches:
+            if not s.solved:
+                s.solve()
+        profile = current_profile()
+        if profile is not None:
+            start = timer()
+        for i, s in enumerate(self.switches):
             breaks = s.get_breaks()
-            all_breaks.append(deque(breaks))
-            for b in breaks:
-                all_times.append(b[0])
-        all_times.sort()
-
-        break_mat = []  # matrix with rows (time) and cols (break dirs)
-        curr_dirs = [True] * len(all_breaks)
-        for t in all_times:
-            new_breaks = []
-            for i, bs in enumerate(all_breaks):
-                if bs[0][0] <= t:
-                    curr_dirs[i] = bs.popleft()[1]
-                new_breaks.append(curr_dirs[i])
-            break_mat.append(new_breaks)
-            
+            states.append(_initial_state(s, breaks))
+            streams.append(_stream(i, breaks))
+        packed = sum(1 << i for i, on in enumerate(states) if on)
+        count = sum(states)
+
+        self.initial = self._combine(states, packed, count)
+        self.times = []
+        output = self.initial
+        for t, group in groupby(heapq.merge(*streams), lambda b: b[0]):
+            for _, i, on in group:
+                if on != states[i]:
+                    states[i] = on
+                    packed ^= 1 << i
+                    count += 1 if on else -1
+            new_output = self._combine(states, packed, count)
+            if new_output != output:
+                self.times.append(t)
+                output = new_output
+
         self.solved = True
+        if profile is not None:
+            profile.record('board', ' '.join(switch_name(s) for s in
+                                             self.switches),
+                           timer() - start, len(self.times), 0)
+
+    def _combine(self, states, packed, count):
+        """
+        Board output for the current switch values.
+        """
+        if self.combName == 'and':
+            return count == len(states)
+        elif self.combName == 'or':
+            return count > 0
+        elif callable(self.combFunc):
+            return bool(self.combFunc(np.array(states)))
+        return bool(self.combFunc[packed])
 
     def get_breaks(self):
         """
         Return the break times and directions for all Switches
         combined.
         """
+        if not self.solved:
+            self.solve()
         breaks = []
-        flip = self.activate
+        flip = not self.initial
         for t in self.times:
             breaks.append((t, flip))
             flip = not flip
-        print 'breaks:', breaks
         return breaks
         
     def __str__(self):
         str1 = 'SwitchBoard\n'
+        str1 += '  logic: ' + self.combName + '\n'
+        str1 += '  solved: ' + str(self.solved) + '\n'
+        if self.solved:
+            str1 += '  breaks:\n'
+            str1 += '  ' + str(self.get_breaks()) + '\n'
         return str1
 
 
+def _initial_state(switch, breaks):
+    """
+    Whether a Switch is on before its first break.
+    """
+    if breaks:
+        return not breaks[0][1]
+    if switch.parent is None:
+        return not switch.activate
+    return (switch.parent.initial_val >= switch.threshold) == switch.activate
+
+
+def _stream(i, breaks):
+    """
+    Breaks of switch i as (time, i, on), for merging.
+    """
+    for t, on in breaks:
+        yield t, i, on
+
+
 class Switch():
     """
     Switch that turns a LogicProduct on or off depending on the
@@ -324,12 +524,17 @@ class Switch():
         return np.log(self.threshold/start_val)/r_sf + brk
             
     def solve(self):
-        print '>Switch.solve()'
         if self.parent is None:
             return
 
         if not self.parent.solved:
             self.parent.solve()
+        profile = current_profile()
+        if profile is not None:
+            start = timer()
+        debug = log.isEnabledFor(logging.DEBUG)
+        if debug:
+            log.debug('Switch %s solve', switch_name(self))
 
         # Get switching times based on parent functional form
         self.times = []
@@ -338,11 +543,10 @@ class Switch():
         if start_val > self.threshold:
             up = False
         for i, brk in enumerate(self.parent.breaks[0:-1]):
-            print 'i:', i
-            print 'brk:', brk[0]
             end_val = self.parent.vals[i+1](self.parent.breaks[i+1][0])
-            print 'start_val:', start_val
-            print 'end_val:', end_val
+            if debug:
+                log.debug('%s parent piece %d from %g: %g to %g',
+                          switch_name(self), i, brk[0], start_val, end_val)
             if up:
             # if start_val < end_val:
                 time = self.solve_on(start_val, brk[0])
@@ -354,8 +558,6 @@ class Switch():
                 up = not up
             start_val = end_val
 
-        end_val = self.parent.vals[i+1](self.parent.breaks[-1][0])
-
         brk = self.parent.breaks[-1]
         if up:
         # if start_val < end_val:
@@ -367,6 +569,9 @@ class Switch():
             self.times.append(time)
 
         self.solved = True
+        if profile is not None:
+            profile.record('switch', switch_name(self), timer() - start,
+                           len(self.times), len(self.parent.breaks) - 1)
 
     def get_breaks(self):
         breaks = []
@@ -374,7 +579,8 @@ class Switch():
         for t in self.times:
             breaks.append((t, flip))
             flip = not flip
-        print 'breaks:', breaks
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s breaks: %s', switch_name(self), breaks)
         return breaks
 
     def __str__(self):
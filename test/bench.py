@@ -0,0 +1,78 @@
+# John Eargle
+# 2017
+
+import subprocess
+import sys
+import time
+
+
+# Benchmarks for costs that tests of correctness do not catch
+
+
+# Modules a short-lived batch worker imports
+WORKER_MODULES = ['sysbiokit.switch', 'sysbiokit.element', 'sysbiokit.matrix',
+                  'sysbiokit.flux', 'sysbiokit.importer', 'sysbiokit.cache',
+                  'sysbiokit.instrument', 'sysbiokit.export',
+                  'sysbiokit.network', 'sysbiokit.sweep',
+                  'sysbiokit.stochastic', 'sysbiokit.pathway',
+                  'sysbiokit.conservation', 'sysbiokit.sharedmem',
+                  'sysbiokit.simplex']
+
+# Seconds sysbiokit may add to the import of numpy and scipy it relies on
+IMPORT_BUDGET = 0.1
+
+
+def import_time(modules, repeat=5):
+    """
+    Best of repeat wall clock times to import modules in a fresh
+    interpreter.
+    """
+    statement = 'import %s' % ', '.join(modules)
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', statement])
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def import_bench1():
+    """
+    Import overhead of sysbiokit beyond numpy and scipy.
+    """
+    print '\n*** Import time ***'
+    base = import_time(['numpy', 'scipy.sparse', 'scipy.linalg',
+                        'scipy.sparse.linalg'])
+    full = import_time(WORKER_MODULES)
+    print '  numpy/scipy: %.3fs' % (base)
+    print '  sysbiokit:   %.3fs (+%.3fs)' % (full, full - base)
+    assert full - base < IMPORT_BUDGET, \
+        'sysbiokit import overhead %.3fs over budget %.3fs' % (
+            full - base, IMPORT_BUDGET)
+
+
+def import_bench2():
+    """
+    Importing must not load matplotlib or build the built-in tables.
+    """
+    print '\n*** Lazy imports ***'
+    statement = '; '.join([
+        'import sys',
+        'import %s' % ', '.join(WORKER_MODULES),
+        'from sysbiokit import element',
+        'print int("matplotlib" in sys.modules), '
+        'int(element.elements._table is not None), '
+        'int(element.molecules._table is not None)'])
+    output = subprocess.check_output([sys.executable, '-c', statement])
+    pyplot, elements, molecules = [int(x) for x in output.split()]
+    print '  matplotlib loaded:', bool(pyplot)
+    print '  tables built:', bool(elements or molecules)
+    assert not (pyplot or elements or molecules)
+
+
+if __name__=='__main__':
+
+    import_bench1()
+    import_bench2()
@@ -1,12 +1,35 @@
 # John Eargle
 # 2015-2017
 
+import StringIO
+import functools
+import json
+import logging
+import os
+import shutil
+import tempfile
+
 import numpy as np
+import scipy.sparse
 
-from sysbiokit.switch import SimpleProduct, LogicProduct, Switch
+from sysbiokit.switch import SimpleProduct, LogicProduct, Switch, evaluate
+from sysbiokit.switch import SwitchBoard
+from sysbiokit.instrument import SolveProfile
+from sysbiokit.export import lttb, column_traces, product_traces
+from sysbiokit.export import render, save_npz, load_npz
+from sysbiokit.network import Network
+from sysbiokit.sweep import combinations, sweep
+from sysbiokit.stochastic import ensemble
 from sysbiokit.matrix import StoichioMatrix, StoichioBinMatrix
 from sysbiokit.matrix import ReactionMatrix, MoleculeMatrix, ElementalMatrix
 from sysbiokit.element import elements, molecules, reactions
+from sysbiokit.element import Registry, Element, Molecule, parse_formula
+from sysbiokit.element import Reaction, ReactionIndex
+from sysbiokit.flux import FluxBalance
+from sysbiokit.pathway import FluxModes
+from sysbiokit.conservation import ConservationLaws
+from sysbiokit.importer import read_sbml, read_json
+from sysbiokit.cache import save_model, load_model, cached_model
 
 
 def simple_product_test1():
@@ -34,6 +57,28 @@ def logic_product_test1():
     lp1.report()
     # lp1.plot(-1.0, 20.0, 0.2)
 
+def logic_product_test2():
+    print '\n*** LogicProduct (evaluate) ***'
+    # Input pulse X -> Y -| Z; X and Y are checked against the event
+    # solver, while Z holds its initial value until its first break
+    lp1 = LogicProduct('X', 2.0, -0.5)
+    lp1.add_switch(Switch(child=lp1, times=[1.0, 6.0]))
+    lp2 = LogicProduct('Y', 1.0, -1.0)
+    lp3 = LogicProduct('Z', 1.0, -1.0)
+    lp1.add_child(lp2, 2.0)
+    lp2.add_child(lp3, 0.5, activate=False)
+    lp3.solve()
+    t = np.linspace(2.0, 12.0, 6)
+    print 'X:', np.round(lp1.evaluate(t), 3)
+    print 'X(3.0): %.3f' % (lp1.evaluate(3.0))
+    print 'scalar type:', type(lp1.evaluate(3.0)).__name__, \
+        isinstance(lp1.evaluate(3.0), float)
+    x = evaluate([lp1, lp2, lp3], t)
+    print np.round(x, 3)
+    traj1 = Network([lp1]).solve(12.0)
+    print 'max difference: %.2e' % (
+        np.abs(x[:,:2] - traj1.evaluate(t)[:,:2]).max())
+
 def switch_test1():
     """
     """
@@ -57,6 +102,223 @@ def switch_test1():
     lp2.report()
     lp2.plot(-1.0, 40.0, 0.1)
 
+def switchboard_test1():
+    print '\n*** SwitchBoard ***'
+    s1 = Switch(times=[1.0, 5.0, 8.0, 12.0])
+    s2 = Switch(times=[3.0, 5.0, 10.0], activate=False)
+    s3 = Switch(times=[2.0, 9.0])
+    sb1 = SwitchBoard([s1, s2], 'and')
+    sb2 = SwitchBoard([s1, s2], 'or')
+    # s1 xor s3
+    sb3 = SwitchBoard([s1, s3], 'custom', [False, True, True, False])
+    sb4 = SwitchBoard([s1, s2, s3], 'custom', lambda x: x.sum() == 2)
+    for sb in [sb1, sb2, sb3, sb4]:
+        brks = sb.get_breaks()
+        print '%s initial: %s breaks: %s' % (sb.combName, sb.initial, brks)
+
+    # Product with two inputs
+    lp1 = LogicProduct('Y', 1.0, -1.0)
+    lp1.add_switch(Switch(child=lp1, times=[1.0, 6.0]))
+    lp1.add_switch(Switch(child=lp1, times=[4.0], activate=False))
+    lp1.solve()
+    print 'Y breaks:', lp1.breaks
+
+def instrument_test1():
+    print '\n*** SolveProfile ***'
+    # Input pulse X -> Y -| Z with a second input on Z
+    lp1 = LogicProduct('X', 2.0, -0.5)
+    lp1.add_switch(Switch(child=lp1, times=[1.0, 6.0]))
+    lp2 = LogicProduct('Y', 1.0, -1.0)
+    lp3 = LogicProduct('Z', 1.0, -1.0)
+    lp1.add_child(lp2, 2.0)
+    lp2.add_child(lp3, 0.5, activate=False)
+    lp3.add_switch(Switch(child=lp3, times=[0.5]))
+
+    # Solve traces go to a logging handler instead of stdout
+    trace = StringIO.StringIO()
+    handler = logging.StreamHandler(trace)
+    logger = logging.getLogger('sysbiokit.switch')
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    profile1 = SolveProfile()
+    try:
+        with profile1:
+            lp3.solve()
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(logging.NOTSET)
+    print 'trace lines:', len(trace.getvalue().splitlines())
+
+    for row in profile1.rows(None):
+        print '  %-6s %-24s solves: %d breaks: %d closures: %d' % (
+            row['kind'], row['name'], row['solves'], row['breaks'],
+            row['closures'])
+    print 'nodes:', profile1.totals()['node']['solves']
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'profile.json')
+        profile1.save(path)
+        with open(path) as f:
+            print 'saved rows:', len(json.load(f)['rows'])
+    finally:
+        shutil.rmtree(directory)
+
+def export_test1():
+    print '\n*** Export ***'
+    # Long trace with a spike and a step
+    x = np.linspace(0.0, 100.0, 100001)
+    y = np.sin(x) + (x > 50.0) + 5.0 * (np.abs(x - 25.0) < 0.001)
+    x1, y1 = lttb(x, y, 400)
+    print 'kept:', len(x1), 'ends:', x1[0], x1[-1]
+    print 'max: %.2f min: %.2f' % (y1.max(), y1.min())
+
+    lp1 = LogicProduct('X', 2.0, -0.5)
+    lp1.add_switch(Switch(child=lp1, times=[1.0, 6.0]))
+    lp2 = LogicProduct('Y', 1.0, -1.0)
+    lp1.add_child(lp2, 2.0)
+    net1 = Network([lp1])
+    t = np.linspace(0.0, 12.0, 1201)
+    traces = column_traces([p.name for p in net1.products], t,
+                           net1.simulate(t))
+    traces += product_traces([SimpleProduct('S', 2.0, -0.5)], t)
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'traces.png')
+        render(traces, path, max_points=100, title='X -> Y')
+        print 'png written:', os.path.getsize(path) > 0
+        lp2.plot(0.0, 12.0, 0.1, path=os.path.join(directory, 'Y.png'))
+        print 'Y.png written:', os.path.exists(os.path.join(directory,
+                                                            'Y.png'))
+
+        path = os.path.join(directory, 'traces.npz')
+        save_npz(path, traces)
+        for name, t1, y1 in load_npz(path):
+            print '  %s: %d points, final %.3f' % (name, len(t1), y1[-1])
+    finally:
+        shutil.rmtree(directory)
+
+def network_test1():
+    print '\n*** Network ***'
+    # Input pulse X -> Y -| Z
+    lp1 = LogicProduct('X', 2.0, -0.5)
+    lp1.add_switch(Switch(child=lp1, times=[1.0, 6.0]))
+    lp2 = LogicProduct('Y', 1.0, -1.0)
+    lp3 = LogicProduct('Z', 1.0, -1.0)
+    lp1.add_child(lp2, 2.0)
+    lp2.add_child(lp3, 0.5, activate=False)
+    net1 = Network([lp1])
+    print 'nodes:', [p.name for p in net1.products]
+    t = np.linspace(0.0, 12.0, 1201)
+    x = net1.simulate(t)
+    for i in range(0, len(t), 200):
+        print '  t=%5.2f  %s' % (t[i], np.round(x[i], 3))
+
+    # Repressilator: A -| B -| C -| A
+    lp4 = LogicProduct('A', 1.0, -1.0, initial_val=0.8)
+    lp5 = LogicProduct('B', 1.0, -1.0)
+    lp6 = LogicProduct('C', 1.0, -1.0, initial_val=0.3)
+    lp4.add_child(lp5, 0.5, activate=False)
+    lp5.add_child(lp6, 0.5, activate=False)
+    lp6.add_child(lp4, 0.5, activate=False)
+    net2 = Network([lp4])
+    x = net2.simulate(np.linspace(0.0, 20.0, 2001))
+    print 'A:', np.round(net2.trajectory('A', x)[::250], 3)
+
+def network_test2():
+    print '\n*** Network (events) ***'
+    lp1 = LogicProduct('X', 2.0, -0.5)
+    lp1.add_switch(Switch(child=lp1, times=[1.0, 6.0]))
+    lp2 = LogicProduct('Y', 1.0, -1.0)
+    lp3 = LogicProduct('Z', 1.0, -1.0)
+    lp1.add_child(lp2, 2.0)
+    lp2.add_child(lp3, 0.5, activate=False)
+    net1 = Network([lp1])
+    traj1 = net1.solve(12.0)
+    print 'events:', traj1.events
+    for name in ['X', 'Y', 'Z']:
+        print '%s breaks: %s' % (name, [(round(t, 4), on) for t, on in
+                                        traj1.breaks(name)])
+    t = np.linspace(0.0, 12.0, 7)
+    print np.round(traj1.evaluate(t), 3)
+
+    # Repressilator
+    lp4 = LogicProduct('A', 1.0, -1.0, initial_val=0.8)
+    lp5 = LogicProduct('B', 1.0, -1.0)
+    lp6 = LogicProduct('C', 1.0, -1.0, initial_val=0.3)
+    lp4.add_child(lp5, 0.5, activate=False)
+    lp5.add_child(lp6, 0.5, activate=False)
+    lp6.add_child(lp4, 0.5, activate=False)
+    traj2 = Network([lp4]).solve(20.0)
+    print 'events:', traj2.events
+    print 'A breaks:', [round(t, 4) for t, on in traj2.breaks('A')][0:6]
+
+def network_test3():
+    print '\n*** Network (scheduling) ***'
+    # Cascade deeper than the recursion limit
+    lps1 = [LogicProduct('g%d' % (i), 1.0, -1.0) for i in range(2000)]
+    for i in range(len(lps1) - 1):
+        lps1[i].add_child(lps1[i+1], 0.5)
+    print 'components:', len(Network([lps1[0]]).components())
+    lps1[-1].solve()
+    print 'last break: %.4f (expected %.4f)' % (lps1[-1].breaks[0][0],
+                                               1999 * np.log(2.0))
+
+    # Feedback loop A -| B -| C -| A feeding D
+    lp1 = LogicProduct('A', 1.0, -1.0)
+    lp2 = LogicProduct('B', 1.0, -1.0)
+    lp3 = LogicProduct('C', 1.0, -1.0)
+    lp4 = LogicProduct('D', 1.0, -1.0)
+    lp1.add_child(lp2, 0.5, activate=False)
+    lp2.add_child(lp3, 0.5, activate=False)
+    lp3.add_child(lp1, 0.5, activate=False)
+    lp3.add_child(lp4, 0.5)
+    net1 = Network([lp4])
+    print 'cycles:', [sorted(p.name for p in c) for c in net1.cycles()]
+    try:
+        lp4.solve()
+    except ValueError as e:
+        print 'ValueError:', e
+
+def sweep_test1():
+    print '\n*** Sweep ***'
+    # Response time of Y to a step in X over Y's degradation rate
+    lp1 = LogicProduct('X', 2.0, -0.5)
+    lp1.add_switch(Switch(child=lp1, times=[0.0]))
+    lp2 = LogicProduct('Y', 1.0, -1.0)
+    lp1.add_child(lp2, 2.0)
+    net1 = Network([lp1])
+    rates = [-0.25, -0.5, -1.0, -2.0]
+    thresholds = [1.0, 2.0, 3.0]
+    params = combinations(net1, [(lp2, 'self_rate', rates),
+                                 (lp2.switches[0], 'threshold', thresholds)])
+    t = np.linspace(0.0, 20.0, 2001)
+    x = sweep(net1, t, params)
+    print 'shape:', x.shape
+    for k in range(len(x)):
+        y = x[k,1]
+        half = t[np.argmax(y >= 0.5 * y[-1])]
+        print '  self_rate=%5.2f threshold=%.1f  Y(20)=%.3f  t_half=%.2f' % (
+            params['self_rates'][k,1], params['thresholds'][k,0], y[-1], half)
+
+def stochastic_test1():
+    print '\n*** Stochastic ensemble ***'
+    lp1 = LogicProduct('X', 2.0, -0.5)
+    lp1.add_switch(Switch(child=lp1, times=[1.0, 6.0]))
+    lp2 = LogicProduct('Y', 1.0, -1.0)
+    lp1.add_child(lp2, 2.0)
+    net1 = Network([lp1])
+    t = np.linspace(0.0, 12.0, 7)
+    volume = 20.0
+    print 'deterministic:'
+    print np.round(net1.simulate(np.linspace(0.0, 12.0, 1201))[::200].T *
+                   volume, 1)
+    for method in ['ssa', 'tau']:
+        counts = ensemble(net1, t, 500, method=method, volume=volume, seed=1)
+        print '%s mean:' % (method)
+        print np.round(counts.mean(axis=0), 1)
+        print '%s P(Y on at t=4): %.3f' % (
+            method, np.mean(counts[:,1,2] >= 0.5 * volume))
+
 def stoichiomatrix_test1():
     print '\n*** StoichioMatrix ***'
     m1 = np.matrix([[1, -1,  0,  0, -1,  0],
@@ -94,6 +356,91 @@ def stoichiomatrix_test1():
     
     print np.allclose(sm1.matrix, np.dot(sm1.U,np.dot(sm1.S,sm1.V)))
 
+def stoichiomatrix_test2():
+    print '\n*** StoichioMatrix (sparse) ***'
+    m1 = scipy.sparse.csr_matrix([[1, -1,  0,  0, -1,  0],
+                                  [0,  1, -1,  0,  0,  0],
+                                  [0,  0,  1, -1,  0,  1],
+                                  [0,  0,  0,  0,  1, -1],
+                                  [-1, 0,  0,  1,  0,  0]])
+    sm1 = StoichioMatrix(m1)
+    print sm1
+
+    print 'column space:'
+    print sm1.column_space.toarray()
+    print 'left null space:'
+    print sm1.left_null_space.toarray()
+    print 'row space:'
+    print sm1.row_space.toarray()
+    print 'right null space:'
+    print sm1.right_null_space.toarray()
+
+    print np.allclose((sm1.matrix * sm1.right_null_space.T).toarray(), 0.0)
+    print np.allclose((sm1.left_null_space.T * sm1.matrix).toarray(), 0.0)
+
+    # Exact rank and null spaces with dependent rows and columns
+    m2 = scipy.sparse.random(40, 60, density=0.05, format='lil',
+                             random_state=np.random.RandomState(1))
+    m2[:,5] = m2[:,1] + 2 * m2[:,3]
+    m2[7,:] = m2[2,:] - m2[9,:]
+    sm2 = StoichioMatrix(m2.tocsr())
+    print sm2.rank == np.linalg.matrix_rank(m2.toarray())
+    print np.allclose((sm2.matrix * sm2.right_null_space.T).toarray(), 0.0)
+    print np.allclose((sm2.left_null_space.T * sm2.matrix).toarray(), 0.0)
+
+def stoichiomatrix_test3():
+    print '\n*** StoichioMatrix (rank tolerance) ***'
+    m1 = np.matrix([[1, -1,  0,  0, -1,  0],
+                    [0,  1, -1,  0,  0,  0],
+                    [0,  0,  1, -1,  0,  1],
+                    [0,  0,  0,  0,  1, -1],
+                    [-1, 0,  0,  1,  0,  0]])
+    for method in ['svd', 'qr']:
+        sm1 = StoichioMatrix(m1, method=method)
+        print method, 'rank:', sm1.rank
+        print 'left null space:'
+        print sm1.left_null_space
+        print 'right null space:'
+        print sm1.right_null_space
+        print np.allclose(sm1.matrix * sm1.right_null_space.T, 0.0)
+        print np.allclose(sm1.left_null_space.T * sm1.matrix, 0.0)
+
+    # Noise from upstream round-off is treated as zero with a looser cutoff
+    m2 = m1 + 1e-12 * np.random.rand(*m1.shape)
+    sm2 = StoichioMatrix(m2)
+    print 'noisy rank:', sm2.rank
+    sm2.tol = 1e-9
+    print 'loose tolerance rank:', sm2.rank
+
+def stoichiomatrix_test4():
+    print '\n*** StoichioMatrix (editing) ***'
+    mols1 = [molecules[name]
+             for name in ['glucose', 'glucose-6-phosphate',
+                          'fructose-6-phosphate']]
+    m1 = np.matrix([[1, -1,  0],
+                    [0,  1, -1],
+                    [0,  0,  1]])
+    sm1 = StoichioMatrix(m1, molecules=mols1)
+    print 'rank:', sm1.rank
+
+    # Drain on fructose-6-phosphate, then a fourth molecule
+    sm1.add_reaction(coefficients={'fructose-6-phosphate': -1}, lower=-10.0)
+    print 'rank:', sm1.rank, 'bounds:', sm1.lower_bounds
+    sm1.add_molecule(molecules['pyruvate'], [0, 0, 0, 1])
+    print sm1.matrix
+    print 'rank:', sm1.rank, 'rows:', sm1.name2row['pyruvate']
+
+    sm1.remove_molecule('glucose-6-phosphate')
+    sm1.remove_reaction(1)
+    print sm1.matrix
+    print 'rank:', sm1.rank, 'rows:', sm1.name2row
+
+    # The updated subspaces agree with a fresh factorization
+    sm2 = StoichioMatrix(sm1.matrix)
+    print sm1.rank == sm2.rank
+    print np.allclose(sm1.matrix * sm1.right_null_space.T, 0.0)
+    print np.allclose(sm1.left_null_space.T * sm1.matrix, 0.0)
+
 def stoichiobinmatrix_test1():
     print '\n*** StoichioBinMatrix ***'
     m1 = np.matrix([[1, -1,  0,  0, -1,  0],
@@ -131,6 +478,161 @@ def stoichiobinmatrix_test1():
     print 'Molecule Matrix:'
     print cm2
 
+def stoichiobinmatrix_test2():
+    print '\n*** StoichioBinMatrix (bit-packed) ***'
+    m1 = scipy.sparse.random(300, 500, density=0.01, format='csr',
+                             random_state=np.random.RandomState(1))
+    sbm1 = StoichioBinMatrix(m1)
+    print 'packed bytes:', sbm1.rows.nbytes + sbm1.cols.nbytes
+    dense = (m1.toarray() != 0).astype(int)
+    print np.array_equal(sbm1.matrix, dense)
+
+    rm1 = ReactionMatrix(sbm1)
+    cm1 = MoleculeMatrix(sbm1)
+    print np.array_equal(rm1.matrix, np.dot(dense.T, dense))
+    print np.array_equal(cm1.matrix, np.dot(dense, dense.T))
+
+def stoichiobinmatrix_test3():
+    print '\n*** Lazy ReactionMatrix/MoleculeMatrix ***'
+    m1 = scipy.sparse.random(300, 500, density=0.01, format='csr',
+                             random_state=np.random.RandomState(1))
+    sbm1 = StoichioBinMatrix(m1)
+    rm1 = ReactionMatrix(sbm1, lazy=True)
+    cm1 = MoleculeMatrix(sbm1, lazy=True)
+    dense = (m1.toarray() != 0).astype(int)
+    rprod = np.dot(dense.T, dense)
+    cprod = np.dot(dense, dense.T)
+
+    print 'Molecules in Reaction 3:', rm1.molecule_count(3), rprod[3,3]
+    print 'Reactions for Molecule 0,7:', cm1.reaction_count(0,7), cprod[0,7]
+
+    rng = np.random.RandomState(2)
+    r1, r2 = rng.randint(500, size=1000), rng.randint(500, size=1000)
+    c1, c2 = rng.randint(300, size=1000), rng.randint(300, size=1000)
+    print np.array_equal(rm1.molecule_counts(r1, r2), rprod[r1, r2])
+    print np.array_equal(cm1.reaction_counts(c1, c2), cprod[c1, c2])
+
+    print 'nonzeros in Reaction Matrix:', rm1.materialize().nnz
+    print np.array_equal(rm1.matrix.toarray(), rprod)
+    print np.array_equal(rm1.molecule_counts(r1, r2), rprod[r1, r2])
+
+def toy_flux_model():
+    """
+    Uptake of A, two routes A->B->D and A->C->D, and a drain on D.
+    """
+    m1 = np.matrix([[1, -1, -1,  0,  0,  0],
+                    [0,  1,  0, -1,  0,  0],
+                    [0,  0,  1,  0, -1,  0],
+                    [0,  0,  0,  1,  1, -1]])
+    sm1 = StoichioMatrix(m1)
+    sm1.set_bounds(0, upper=10.0)
+    sm1.set_bounds(2, upper=4.0)
+    sm1.set_objective(5)
+    return sm1
+
+def fluxbalance_test1():
+    print '\n*** FluxBalance ***'
+    sm1 = toy_flux_model()
+    fb1 = FluxBalance(sm1)
+    print 'objective:', fb1.solve()
+    print 'fluxes:', fb1.fluxes
+    print np.allclose(sm1.matrix * np.matrix(fb1.fluxes).T, 0.0)
+
+    print 'single knockouts:', fb1.knockouts()
+    pairs, values = fb1.double_knockouts()
+    for pair, value in zip(pairs, values):
+        print 'knockout %d,%d: %.2f' % (pair[0], pair[1], value)
+
+    # Warm-started screen agrees with solving each knockout from scratch
+    values = fb1.knockouts()
+    for col in range(sm1.matrix.shape[1]):
+        lower = sm1.lower_bounds[col]
+        upper = sm1.upper_bounds[col]
+        sm1.set_bounds(col, 0.0, 0.0)
+        print np.isclose(FluxBalance(sm1).solve(), values[col]),
+        sm1.set_bounds(col, lower, upper)
+    print
+
+    # Knocking out the uptake alone is infeasible with a forced drain,
+    # but not together with the drain
+    sm1.set_bounds(5, lower=1.0)
+    pairs, values = FluxBalance(sm1).double_knockouts()
+    for pair, value in zip(pairs, values):
+        if pair[0] == 0:
+            print 'knockout %d,%d: %.2f' % (pair[0], pair[1], value)
+
+    # An infeasible wild type, since the uptake cannot feed reaction 3,
+    # is still screened; knocking out reaction 3 restores a solution
+    sm2 = toy_flux_model()
+    sm2.set_bounds(3, lower=20.0)
+    fb2 = FluxBalance(sm2)
+    print 'infeasible objective:', fb2.solve()
+    print 'single knockouts:', fb2.knockouts()
+    pairs, values = fb2.double_knockouts()
+    print 'feasible pairs:', [tuple(pair) for pair in pairs[~np.isnan(values)]]
+
+def fluxbalance_test2():
+    print '\n*** Flux variability ***'
+    sm1 = toy_flux_model()
+    fb1 = FluxBalance(sm1)
+    print 'objective:', fb1.solve()
+    for fraction in [1.0, 0.5]:
+        minimum, maximum = fb1.variability(fraction, processes=2,
+                                           chunk_size=2)
+        print 'fraction %.1f' % (fraction)
+        print '  minimum:', minimum
+        print '  maximum:', maximum
+        serial = fb1.variability(fraction, processes=1)
+        print np.allclose(serial[0], minimum), np.allclose(serial[1], maximum)
+
+def conservation_test1():
+    print '\n*** ConservationLaws ***'
+    # Hexokinase, ADP -> ATP, adenylate kinase, G6P -> glucose, ATP -> ADP
+    m1 = np.matrix([[-1,  0,  0,  1,  0],
+                    [ 1,  0,  0, -1,  0],
+                    [-1,  1,  1,  0, -1],
+                    [ 1, -1, -2,  0,  1],
+                    [ 0,  0,  1,  0,  0]])
+    mols1 = [molecules[name]
+             for name in ['glucose', 'glucose-6-phosphate',
+                          'adenosine triphosphate', 'adenosine diphosphate',
+                          'adenosine monophosphate']]
+    sm1 = StoichioMatrix(m1, mols1)
+    cl1 = ConservationLaws(sm1)
+    print 'conservation matrix:'
+    print cl1.matrix
+    print 'dependent:', [str(mols1[i]) for i in cl1.dependent]
+    print 'independent:', [str(mols1[i]) for i in cl1.independent]
+    print 'link matrix:'
+    print cl1.link
+    print np.allclose(cl1.link * sm1.matrix[cl1.independent,:], sm1.matrix)
+
+    x0 = np.array([1.0, 0.0, 2.0, 0.5, 0.1])
+    totals = cl1.totals(x0)
+    print 'totals:', totals
+    print np.allclose(cl1.expand(cl1.reduce(x0), totals), x0)
+
+def fluxmodes_test1():
+    print '\n*** FluxModes ***'
+    sm1 = toy_flux_model()
+    fm1 = FluxModes(sm1)
+    modes = fm1.elementary_modes()
+    print 'elementary modes:'
+    print modes
+    print np.allclose(sm1.matrix * np.matrix(modes).T, 0.0)
+
+    # Reversible drain on D with a reversible uptake: the exchange is left
+    # free for extreme pathways
+    sm1.set_bounds(5, lower=-10.0)
+    sm1.set_bounds(0, lower=-10.0)
+    fm2 = FluxModes(sm1)
+    print 'elementary modes:'
+    print fm2.elementary_modes()
+    print 'extreme pathways:'
+    print fm2.extreme_pathways()
+    print np.allclose(fm2.elementary_modes(),
+                      fm2.elementary_modes(processes=2))
+
 def print_element(symbol):
     e = elements[symbol]
     print '%s %s' % (e, e.symbol)
@@ -163,6 +665,258 @@ def molecule_test1():
     print_molecule('adenine')
     print_molecule('adenosine triphosphate')
 
+def molecule_test2():
+    print '\n*** Molecule (registry) ***'
+    reg1 = Registry()
+    for name, symbol, number in [('carbon', 'C', 6), ('hydrogen', 'H', 1),
+                                 ('oxygen', 'O', 8)]:
+        Element(name, symbol, number, registry=reg1)
+    m1 = Molecule('acetate', [('C', 2), ('H', 3), ('O', 2)], charge=-1,
+                  abbr='ac', registry=reg1)
+    m2 = Molecule('ethanol', [('C', 2), ('H', 6), ('O', 1)], registry=reg1)
+    print '%s %s %s %s' % (m1, m1.abbr, m1.formula, m1.charge_str)
+    print '%s %s %s' % (m2, m2.formula, [(str(e), c) for e, c in m2.composition])
+    print 'cached formulas:', sorted(reg1.formulas.values())
+    print m1 == Molecule.view(reg1, m1.index), m1 == m2
+    print reg1.compositions([1, 0])
+
+    # A failed add leaves the registry as it was
+    try:
+        reg1.add_molecule('glutamate', [('C', 5), ('N', 1), ('R', 1)])
+    except KeyError as e:
+        print 'KeyError:', e
+    m3 = Molecule('water', [('H', 2), ('O', 1)], registry=reg1)
+    print '%s %s %d' % (m3, m3.formula, len(reg1.names))
+    try:
+        reg1.add_molecules(['a', 'b'], ['H2', 'O2'], charges=[0])
+    except ValueError as e:
+        print 'ValueError:', e
+
+def molecule_test3():
+    print '\n*** Molecule (formulas) ***'
+    for formula in ['C6H12O6', 'NH4+', 'HPO4-2', 'Fe^2+', 'Ca(OH)2',
+                    'CuSO4.5H2O', 'K4[Fe(CN)6]']:
+        print formula, parse_formula(formula)
+
+    m1 = Molecule('acetate ion', 'C2H3O2-')
+    print '%s %s %s' % (m1, m1.formula, m1.charge_str)
+    mols1 = Molecule.bulk(['D-glucose', 'D-fructose', 'lactate ion'],
+                          ['C6H12O6', 'C6H12O6', 'C3H5O3-'],
+                          abbrs=['glc', 'fru', None])
+    for m in mols1:
+        print '%s %s %s %s' % (m, m.abbr, m.formula, m.charge_str)
+    reg1 = mols1[0].registry
+    print 'shared composition:', (reg1.composition_ids[mols1[0].index] ==
+                                  reg1.composition_ids[mols1[1].index])
+
+def importer_test1():
+    print '\n*** Model importers ***'
+    sbml1 = StringIO.StringIO("""<?xml version="1.0" encoding="UTF-8"?>
+<sbml xmlns="http://www.sbml.org/sbml/level3/version1/core"
+      xmlns:fbc="http://www.sbml.org/sbml/level3/version1/fbc/version2"
+      level="3" version="1">
+  <model id="lactate">
+    <listOfSpecies>
+      <species id="glc_e" name="D-glucose" fbc:chemicalFormula="C6H12O6"/>
+      <species id="glc_c" name="D-glucose" fbc:chemicalFormula="C6H12O6"/>
+      <species id="lac_c" name="lactate" fbc:charge="-1"
+               fbc:chemicalFormula="C3H5O3"/>
+      <species id="h_c" name="proton" fbc:charge="1" fbc:chemicalFormula="H"/>
+    </listOfSpecies>
+    <listOfParameters>
+      <parameter id="zero" value="0"/>
+      <parameter id="glc_max" value="10"/>
+      <parameter id="ub" value="1000"/>
+    </listOfParameters>
+    <listOfReactions>
+      <reaction id="GLCt" reversible="false"
+                fbc:lowerFluxBound="zero" fbc:upperFluxBound="glc_max">
+        <listOfReactants><speciesReference species="glc_e"/></listOfReactants>
+        <listOfProducts><speciesReference species="glc_c"/></listOfProducts>
+      </reaction>
+      <reaction id="LDH" reversible="false"
+                fbc:lowerFluxBound="zero" fbc:upperFluxBound="ub">
+        <listOfReactants><speciesReference species="glc_c"/></listOfReactants>
+        <listOfProducts>
+          <speciesReference species="lac_c" stoichiometry="2"/>
+          <speciesReference species="h_c" stoichiometry="2"/>
+        </listOfProducts>
+      </reaction>
+    </listOfReactions>
+    <fbc:listOfObjectives fbc:activeObjective="obj">
+      <fbc:objective fbc:id="obj" fbc:type="maximize">
+        <fbc:listOfFluxObjectives>
+          <fbc:fluxObjective fbc:reaction="LDH" fbc:coefficient="1"/>
+        </fbc:listOfFluxObjectives>
+      </fbc:objective>
+    </fbc:listOfObjectives>
+  </model>
+</sbml>""")
+    sm1 = read_sbml(sbml1)
+    print sm1.matrix.toarray()
+    for m in sm1.molecules:
+        print '%s %s %s %s' % (m, m.abbr, m.formula, m.charge_str)
+    for r in sm1.reactions:
+        print '%s: %s' % (r, r.equation_str)
+    print 'bounds:', sm1.lower_bounds, sm1.upper_bounds
+    print 'objective:', sm1.objective
+
+    json1 = StringIO.StringIO("""{"id": "lactate",
+  "metabolites": [
+    {"id": "glc_e", "name": "D-glucose", "formula": "C6H12O6", "charge": 0},
+    {"id": "glc_c", "name": "D-glucose", "formula": "C6H12O6", "charge": 0},
+    {"id": "lac_c", "name": "lactate", "formula": "C3H5O3", "charge": -1},
+    {"id": "h_c", "name": "proton", "formula": "H", "charge": 1}],
+  "reactions": [
+    {"id": "GLCt", "metabolites": {"glc_e": -1, "glc_c": 1},
+     "lower_bound": 0, "upper_bound": 10},
+    {"id": "LDH", "metabolites": {"glc_c": -1, "lac_c": 2, "h_c": 2},
+     "lower_bound": 0, "upper_bound": 1000, "objective_coefficient": 1}],
+  "genes": []}""")
+    sm2 = read_json(json1, chunk_size=16)
+    print 'same matrix:', (sm1.matrix != sm2.matrix).nnz == 0
+    print 'same bounds:', (np.all(sm1.lower_bounds == sm2.lower_bounds) and
+                           np.all(sm1.upper_bounds == sm2.upper_bounds))
+    print 'same objective:', np.all(sm1.objective == sm2.objective)
+
+    # Formulas a registry cannot represent are blanked with a warning
+    trace = StringIO.StringIO()
+    handler = logging.StreamHandler(trace)
+    logger = logging.getLogger('sysbiokit.importer')
+    logger.addHandler(handler)
+    try:
+        json1.seek(0)
+        sm2 = read_json(json1, Registry())
+    finally:
+        logger.removeHandler(handler)
+    print 'formulas:', [m.formula for m in sm2.molecules]
+    print trace.getvalue().strip()
+
+    # Boundary species A_e feeding A_c -> sink
+    sbml2 = """<?xml version="1.0" encoding="UTF-8"?>
+<sbml xmlns="http://www.sbml.org/sbml/level3/version1/core"
+      xmlns:fbc="http://www.sbml.org/sbml/level3/version1/fbc/version2"
+      level="3" version="1">
+  <model id="boundary">
+    <listOfSpecies>
+      <species id="A_e" boundaryCondition="true"/>
+      <species id="A_c" boundaryCondition="false"/>
+    </listOfSpecies>
+    <listOfParameters>
+      <parameter id="zero" value="0"/>
+      <parameter id="ub" value="10"/>
+    </listOfParameters>
+    <listOfReactions>
+      <reaction id="EX_A" reversible="false"
+                fbc:lowerFluxBound="zero" fbc:upperFluxBound="ub">
+        <listOfReactants>
+          <speciesReference species="A_e" stoichiometry="1"/>
+        </listOfReactants>
+        <listOfProducts>
+          <speciesReference species="A_c" stoichiometry="1"/>
+        </listOfProducts>
+      </reaction>
+      <reaction id="sink" reversible="false">
+        <listOfReactants>
+          <speciesReference species="A_c" stoichiometry="1"/>
+        </listOfReactants>
+      </reaction>
+    </listOfReactions>
+    <fbc:listOfObjectives fbc:activeObjective="obj">
+      <fbc:objective fbc:id="obj" fbc:type="maximize">
+        <fbc:listOfFluxObjectives>
+          <fbc:fluxObjective fbc:reaction="sink" fbc:coefficient="1"/>
+        </fbc:listOfFluxObjectives>
+      </fbc:objective>
+    </fbc:listOfObjectives>
+  </model>
+</sbml>"""
+    sm3 = read_sbml(StringIO.StringIO(sbml2))
+    print 'molecules:', [str(m) for m in sm3.molecules]
+    print 'sink flux:', FluxBalance(sm3).solve()
+    sm4 = read_sbml(StringIO.StringIO(sbml2), boundary=True)
+    print 'with boundary:', [str(m) for m in sm4.molecules]
+
+    # Only the active objective is read, negated when minimized
+    sbml3 = sbml2.replace("""<fbc:listOfObjectives fbc:activeObjective="obj">""",
+                          """<fbc:listOfObjectives fbc:activeObjective="min">
+      <fbc:objective fbc:id="min" fbc:type="minimize">
+        <fbc:listOfFluxObjectives>
+          <fbc:fluxObjective fbc:reaction="EX_A" fbc:coefficient="2"/>
+        </fbc:listOfFluxObjectives>
+      </fbc:objective>""")
+    sm5 = read_sbml(StringIO.StringIO(sbml3))
+    print 'active objective:', sm5.objective
+
+def cache_test1():
+    print '\n*** Model cache ***'
+    m1 = np.matrix([[-1,  0,  1],
+                    [ 1, -1,  0],
+                    [ 0,  1, -1]])
+    mols1 = [molecules[name] for name in ['glucose', 'pyruvate', 'lactate']]
+    sm1 = StoichioMatrix(m1, mols1)
+    sm1.set_bounds(0, lower=-10.0)
+    print 'rank:', sm1.rank
+
+    directory = tempfile.mkdtemp()
+    try:
+        save_model(sm1, directory + '/model', 'key1')
+        print 'stale:', load_model(directory + '/model', 'key2')
+        sm2 = load_model(directory + '/model', 'key1')
+        print sm2
+        print 'molecules:', [str(m) for m in sm2.molecules]
+        print 'lower bounds:', sm2.lower_bounds
+        print 'cached rank:', sm2._factored is sm2.matrix, sm2.rank
+        print 'right null space:', sm2.right_null_space.T
+
+        # Repeated loads reuse the registry's molecules
+        registry = sm2.molecules[0].registry
+        size = len(registry.names)
+        sm3 = load_model(directory + '/model', 'key1')
+        print 'registry grew:', len(registry.names) - size, \
+            sm3.molecules == sm2.molecules
+
+        # Replacing a cache swaps the link to it
+        target = os.path.realpath(directory + '/model')
+        save_model(sm1, directory + '/model', 'key1')
+        print 'same key kept:', \
+            os.path.realpath(directory + '/model') == target
+        sm1.set_bounds(0, lower=-5.0)
+        save_model(sm1, directory + '/model', 'key3')
+        print 'replaced:', load_model(directory + '/model',
+                                      'key3').lower_bounds
+        print 'cache dirs:', len(os.listdir(directory))
+
+        # Models read another way are cached separately
+        path = os.path.join(directory, 'boundary.xml')
+        with open(path, 'w') as f:
+            f.write("""<?xml version="1.0" encoding="UTF-8"?>
+<sbml xmlns="http://www.sbml.org/sbml/level3/version1/core"
+      level="3" version="1">
+  <model id="boundary">
+    <listOfSpecies>
+      <species id="A_e" boundaryCondition="true"/>
+      <species id="A_c" boundaryCondition="false"/>
+    </listOfSpecies>
+    <listOfReactions>
+      <reaction id="EX_A" reversible="false">
+        <listOfReactants><speciesReference species="A_e"/></listOfReactants>
+        <listOfProducts><speciesReference species="A_c"/></listOfProducts>
+      </reaction>
+    </listOfReactions>
+  </model>
+</sbml>""")
+        sm4 = cached_model(path)
+        sm5 = cached_model(path, functools.partial(read_sbml, boundary=True))
+        print 'rows:', sm4.matrix.shape[0], sm5.matrix.shape[0]
+        print 'cached rows:', cached_model(path).matrix.shape[0]
+        try:
+            cached_model(path, lambda s, r: read_sbml(s, r, boundary=True))
+        except ValueError as e:
+            print 'lambda reader:', e
+    finally:
+        shutil.rmtree(directory)
+
 def print_reaction(name):
     m = reactions[name]
     print '%s: %s' % (m, m.equation_str)
@@ -174,6 +928,30 @@ def reaction_test1():
     print_reaction('reaction3')
     print_reaction('reaction4')
 
+def reaction_test2():
+    print '\n*** ReactionIndex ***'
+    ri1 = ReactionIndex(reactions.values())
+    for name in ['molecule1', 'molecule3', 'water']:
+        m = molecules[name]
+        print '%s produced by %s, consumed by %s' % (
+            m, sorted((str(r), c) for r, c in ri1.producers(m)),
+            sorted((str(r), c) for r, c in ri1.consumers(m)))
+
+    print 'neighbors:', sorted(str(m) for m in
+                               ri1.neighbors(molecules['molecule2']))
+    print 'forward:', sorted(str(m) for m in
+                             ri1.neighbors(molecules['molecule2'], 'forward'))
+    hood = ri1.neighborhood(molecules['molecule1'], 2, 'forward')
+    print 'neighborhood:', sorted((str(m), d) for m, d in hood.items())
+
+    r1 = Reaction('reaction5', [(molecules['molecule5'], 1)],
+                  [(molecules['water'], 1)])
+    ri1.add(r1)
+    hood = ri1.neighborhood(molecules['molecule1'], 2, 'forward')
+    print 'with reaction5:', sorted((str(m), d) for m, d in hood.items())
+    ri1.remove(r1)
+    print 'producers after removal:', ri1.producers(molecules['water'])
+
 def elementalmatrix_test1():
     # 2H2 + O2 -> 2H2O
     m1 = np.matrix([[-2], [-1], [2]])
@@ -205,6 +983,47 @@ def elementalmatrix_test1():
     for molecule in em2.molecules:
         print molecule, molecule.formula
 
+def elementalmatrix_test2():
+    print '\n*** ElementalMatrix (balance) ***'
+    # 2H2 + O2 -> 2H2O, NH3 -> NH4+ (missing a proton), NH3 + H+ -> NH4+
+    m1 = np.matrix([[-2,  0,  0],
+                    [-1,  0,  0],
+                    [ 2,  0,  0],
+                    [ 0, -1, -1],
+                    [ 0,  1,  1],
+                    [ 0,  0, -1]])
+    mols1 = [molecules[name]
+             for name in ['hydrogen', 'oxygen', 'water',
+                          'ammonia', 'ammonium', 'proton']]
+    sm1 = StoichioMatrix(m1, mols1)
+    em1 = ElementalMatrix(sm1)
+    print em1
+    print 'charges:', em1.charges
+    columns, deficits, charges = em1.imbalances()
+    print 'unbalanced:', columns
+    print 'deficits:', deficits
+    print 'charge deficits:', charges
+    em1.report()
+
+    sm2 = StoichioMatrix(scipy.sparse.csr_matrix(m1), mols1)
+    em2 = ElementalMatrix(sm2)
+    print np.array_equal(em2.imbalances()[0], columns)
+
+    # No molecules gives an empty matrix
+    em3 = ElementalMatrix(StoichioMatrix(np.matrix(np.zeros((0, 2))), []))
+    print 'empty:', em3.matrix.shape, len(em3.imbalances()[0])
+
+    # Molecules from another registry would index the wrong compositions
+    reg1 = Registry()
+    for name, symbol, number in [('hydrogen', 'H', 1), ('oxygen', 'O', 8)]:
+        Element(name, symbol, number, registry=reg1)
+    m2 = Molecule('peroxide', [('H', 2), ('O', 2)], registry=reg1)
+    sm3 = StoichioMatrix(np.matrix([[-1], [1]]), [molecules['water'], m2])
+    try:
+        ElementalMatrix(sm3)
+    except ValueError as e:
+        print 'ValueError:', e
+
 
 if __name__=='__main__':
 
@@ -221,15 +1040,39 @@ if __name__=='__main__':
     # simple_product_test1()
     # simple_product_test2()
     # logic_product_test1()
+    # logic_product_test2()
     # switch_test1()
+    # switchboard_test1()
+    # instrument_test1()
+    # export_test1()
+    # network_test1()
+    # network_test2()
+    # network_test3()
+    # sweep_test1()
+    # stochastic_test1()
 
     # ====================
     # Matrix tests
     # ====================
     
     # stoichiomatrix_test1()
+    # stoichiomatrix_test2()
+    # stoichiomatrix_test3()
+    # stoichiomatrix_test4()
     # stoichiobinmatrix_test1()
+    # stoichiobinmatrix_test2()
+    # stoichiobinmatrix_test3()
     elementalmatrix_test1()
+    # elementalmatrix_test2()
+
+    # ====================
+    # Flux tests
+    # ====================
+
+    # fluxbalance_test1()
+    # fluxbalance_test2()
+    # fluxmodes_test1()
+    # conservation_test1()
 
     # ====================
     # Chemical tests
@@ -237,5 +1080,10 @@ if __name__=='__main__':
 
     element_test1()
     molecule_test1()
+    # molecule_test2()
+    # molecule_test3()
+    # importer_test1()
+    # cache_test1()
     reaction_test1()
+    # reaction_test2()
     